@@ -1,5 +1,9 @@
+import sqlite3
+
 from sengoku.api import API
 from sengoku.middleware import Middleware
+from sengoku.params import Resource
+from sengoku.pool import ResourcePool
 
 app = API()
 
@@ -23,10 +27,11 @@ def greeting(request, response, name):
 
 
 @app.route('/sub/{num_1:d}/{num_2:d}')
-def sub(request, response, num_1, num_2):
+def sub(request, response, num_1: int, num_2: int):
     """
     Testing route whose params are given the type.
     If you pass in a non-digit, it will not be able to parse it and our default_response will do its job.
+    The annotations are compiled when the route is added, the handler gets ints (see sengoku.params).
 
     :param request:
     :param response:
@@ -35,7 +40,7 @@ def sub(request, response, num_1, num_2):
     :return:
 
     """
-    diff = int(num_1) - int(num_2)
+    diff = num_1 - num_2
     response.text = f'{num_1} - {num_2} = {diff}'
 
 
@@ -69,6 +74,18 @@ def exception_throwing_handler(request, response):
     raise AssertionError('This handler should not be used.')
 
 
+# a pool of database connections, opened by every worker when it starts serving
+db = ResourcePool(lambda: sqlite3.connect(':memory:', check_same_thread=False), min_size=1, max_size=4,
+                  health_check=lambda connection: connection.execute('SELECT 1'))
+app.on_startup(db.open)
+app.on_shutdown(db.close)
+
+
+@app.route('/now')
+def now(request, response, connection=Resource(db)):
+    response.text = connection.execute("SELECT datetime('now')").fetchone()[0]
+
+
 # class-based handlers
 
 @app.route('/book')
@@ -0,0 +1,54 @@
+"""
+Measure the requests per second of the /text and /json handlers from app.py through the WSGI callable,
+with the lean response path and with the previous WebOb-only path.
+
+Run it from the repository root:
+    python -m benchmarks.bench_response
+"""
+import contextlib
+import os
+import time
+
+from sengoku.response import Response
+from sengoku.testing import make_environ
+
+REQUESTS = 20000
+PATHS = ('/text', '/json')
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def requests_per_second(app, path):
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        b''.join(app(make_environ(path), start_response))
+    return REQUESTS / (time.perf_counter() - started)
+
+
+def webob_call(self, environ, start_response):
+    return self.to_webob()(environ, start_response)
+
+
+def main():
+    # app.py registers a middleware that prints every request
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        from app import app
+
+        lean_call = Response.__call__
+        results = {}
+        for path in PATHS:
+            Response.__call__ = webob_call
+            before = requests_per_second(app, path)
+            Response.__call__ = lean_call
+            after = requests_per_second(app, path)
+            results[path] = before, after
+
+    print(f'{"path":<8} {"webob (req/s)":>14} {"lean (req/s)":>14} {"speedup":>8}')
+    for path, (before, after) in results.items():
+        print(f'{path:<8} {before:14.0f} {after:14.0f} {after / before:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Measure how long API.find_handler takes to resolve a path as the number of registered routes grows.
+The compiled route tree should stay flat from 10 to 10,000 routes, while the old linear parse() scan grows
+with every added route.
+
+Run it from the repository root:
+    python -m benchmarks.bench_routing
+"""
+import timeit
+
+from parse import parse
+
+from sengoku.api import API
+
+ROUTE_COUNTS = (10, 100, 1000, 10000)
+# the linear scan gets too slow to measure comfortably past this number of routes
+LINEAR_SCAN_LIMIT = 1000
+
+
+def handler(req, res, **kwargs):
+    pass
+
+
+def build_api(route_count):
+    api = API()
+    for index in range(route_count):
+        if index % 2:
+            api.add_route(f'/resource{index}/{{item_id:d}}/detail', handler)
+        else:
+            api.add_route(f'/resource{index}/list', handler)
+    return api
+
+
+def linear_find_handler(api, request_path):
+    for path, handler_data in api.routes.items():
+        parse_result = parse(path, request_path)
+        if parse_result is not None:
+            return handler_data, parse_result.named
+    return None, None
+
+
+def measure(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print(f'{"routes":>8} {"case":<12} {"tree (us)":>12} {"linear (us)":>12}')
+    for route_count in ROUTE_COUNTS:
+        api = build_api(route_count)
+        cases = {
+            'static': f'/resource{route_count - 2}/list',
+            'typed': f'/resource{route_count - 1}/42/detail',
+            'not found': '/does/not/exist',
+        }
+        for case, request_path in cases.items():
+            tree = measure(lambda: api.find_handler(request_path), 10000)
+            if route_count <= LINEAR_SCAN_LIMIT:
+                linear = f'{measure(lambda: linear_find_handler(api, request_path), 10):12.2f}'
+            else:
+                linear = f'{"-":>12}'
+            print(f'{route_count:>8} {case:<12} {tree:12.2f} {linear}')
+
+
+if __name__ == '__main__':
+    main()
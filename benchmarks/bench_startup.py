@@ -0,0 +1,70 @@
+"""
+Measure the cold start of a worker, each sample in a fresh interpreter:
+    - import: how long `import sengoku.api` takes, and the RSS of the process after it. It is measured as it is
+      (the dependencies are imported lazily) and with the dependencies imported upfront, as they used to be.
+    - app: importing app.py and precompiling it (see API.precompile), as a prefork master does before forking.
+    - first request: the first request of a worker that was not precompiled, which pays for the lazy imports.
+
+Run it from the repository root:
+    python -m benchmarks.bench_startup
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+SAMPLES = 10
+DEPENDENCIES = ('requests', 'wsgiadapter', 'jinja2', 'whitenoise', 'parse', 'webob')
+
+PRELUDE = '''
+import contextlib, json, os, resource, time
+def rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+'''
+
+SCENARIOS = {
+    'import (lazy)': '''
+import sengoku.api
+result = {'seconds': time.perf_counter() - started, 'rss_kb': rss_kb()}
+''',
+    'import (eager)': f'''
+for module_name in {DEPENDENCIES!r}:
+    __import__(module_name)
+import sengoku.api
+result = {{'seconds': time.perf_counter() - started, 'rss_kb': rss_kb()}}
+''',
+    'app + precompile': '''
+with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    from app import app
+    app.precompile()
+result = {'seconds': time.perf_counter() - started, 'rss_kb': rss_kb()}
+''',
+    'first request': '''
+with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    from app import app
+    from sengoku.testing import make_environ, run_wsgi
+    started = time.perf_counter()
+    run_wsgi(app, make_environ('/hello/sengoku'))
+result = {'seconds': time.perf_counter() - started, 'rss_kb': rss_kb()}
+''',
+}
+
+
+def sample(code):
+    output = subprocess.run([sys.executable, '-c', PRELUDE + code + '\nprint(json.dumps(result))'],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    print(f'{"scenario":<20}{"median ms":>12}{"max RSS MB":>12}')
+    for name, code in SCENARIOS.items():
+        results = [sample(code) for _ in range(SAMPLES)]
+        seconds = statistics.median(result['seconds'] for result in results)
+        rss = statistics.median(result['rss_kb'] for result in results) / 1024
+        print(f'{name:<20}{seconds * 1000:>12.1f}{rss:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
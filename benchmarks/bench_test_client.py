@@ -0,0 +1,56 @@
+"""
+Measure the requests per second of the test clients on a small app: api.test_session (requests and the WSGI
+adapter) against api.test_client (the environ is built directly), with a GET and a POST of a JSON body.
+
+Run it from the repository root:
+    python -m benchmarks.bench_test_client
+"""
+import time
+
+from sengoku.api import API
+
+REQUESTS = 5000
+
+
+def build_app():
+    api = API()
+
+    @api.route('/books/{book_id}')
+    def book(req, res, book_id):
+        res.json = {'id': book_id}
+
+    @api.route('/books', allowed_methods=['post'])
+    def create_book(req, res):
+        res.status_code = 201
+        res.json = req.json
+
+    return api
+
+
+def requests_per_second(send):
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        send()
+    return REQUESTS / (time.perf_counter() - started)
+
+
+def main():
+    api = build_app()
+    clients = {'test_session': api.test_session(), 'test_client': api.test_client()}
+    results = {}
+    for name, client in clients.items():
+        results[name] = (
+            requests_per_second(lambda: client.get('http://testserver/books/7')),
+            requests_per_second(lambda: client.post('http://testserver/books', json={'title': 'Dune'})),
+        )
+
+    print(f'{"client":<14}{"GET rps":>12}{"POST rps":>12}')
+    for name, (get, post) in results.items():
+        print(f'{name:<14}{get:>12.0f}{post:>12.0f}')
+    session_get, session_post = results['test_session']
+    client_get, client_post = results['test_client']
+    print(f'speedup: GET x{client_get / session_get:.1f}, POST x{client_post / session_post:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Replay a request log against an API in-process, to compare the latency of real traffic shapes
+between two versions of the framework (or of the app) before deploying.
+The log is a JSONL file, one request per line:
+    {"method": "GET", "path": "/hello/matthew?lang=en", "headers": {"Accept": "text/html"}}
+    {"method": "POST", "path": "/book", "headers": {"Content-Type": "application/json"}, "body": "{\\"id\\": 1}"}
+Only path is required, method defaults to GET. The lines that are not a request (no path) are skipped and counted.
+The file is streamed, so logs larger than the memory can be replayed.
+---
+Run it from the repository root, with the app as module:attribute:
+    python -m benchmarks.replay app:app traffic.jsonl --workers 8
+    python -m benchmarks.replay app:app traffic.jsonl --workers 4 --processes --json replay.json
+The requests are spread over a pool of threads (the default) or of processes, every process importing its own app.
+The report gives, per route, the number of requests, the p50/p90/p99/max latency and the error rate:
+an error is an exception raised by the app or a 5xx status.
+"""
+import argparse
+import collections
+import contextlib
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from sengoku.instrumentation import UNMATCHED_ROUTE
+from sengoku.server import load_app
+from sengoku.testing import make_environ, run_wsgi
+
+BATCH_SIZE = 64
+
+_app = None
+
+
+def _init_worker(target, quiet):
+    global _app
+    if quiet:
+        # e.g. app.py registers a middleware that prints every request
+        sys.stdout = open(os.devnull, 'w')
+    _app = load_app(target)
+
+
+def read_log(file):
+    """
+    Parse the lines of the log into request dicts.
+
+    :param file:
+    :return: the requests and, once exhausted, the number of skipped lines in skipped[0]
+    """
+    skipped = [0]
+
+    def requests():
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                skipped[0] += 1
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get('path'), str):
+                skipped[0] += 1
+                continue
+            yield entry
+
+    return requests(), skipped
+
+
+def to_environ(entry):
+    url = urlsplit(entry['path'])
+    body = entry.get('body') or ''
+    return make_environ(
+        url.path or '/',
+        method=entry.get('method', 'GET').upper(),
+        query_string=url.query,
+        body=body.encode() if isinstance(body, str) else bytes(body),
+        headers=entry.get('headers'),
+    )
+
+
+def route_of(app, path):
+    route, _ = app.find_handler(urlsplit(path).path or '/')
+    return route['path'] if route is not None else UNMATCHED_ROUTE
+
+
+def replay_one(entry, app=None):
+    """
+    Replay a request.
+
+    :param entry:
+    :param app: the app of the worker process when None
+    :return: (route, latency in ns, error)
+    """
+    app = app or _app
+    environ = to_environ(entry)
+    started = time.perf_counter_ns()
+    try:
+        status, _, _ = run_wsgi(app, environ)
+        error = status >= 500
+    except Exception:
+        error = True
+    # before route_of, whose lookup is not part of the request
+    latency = time.perf_counter_ns() - started
+    return route_of(app, entry['path']), latency, error
+
+
+def _replay_batch(entries, app=None):
+    return [replay_one(entry, app) for entry in entries]
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def replay(target, entries, workers=1, processes=False, quiet=True):
+    """
+    Replay the requests against the app and collect the results per route.
+
+    :param target: the app as module:attribute, or the API itself with a pool of threads
+    :param entries: the requests, see read_log
+    :param workers: the size of the pool
+    :param processes: use a pool of processes instead of threads
+    :param quiet: silence what the app prints
+    :return: {route: [(latency in ns, error), ...]}
+    """
+    if processes:
+        executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(target, quiet))
+        app = None
+    else:
+        executor = ThreadPoolExecutor(workers)
+
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.ExitStack() as stack:
+        stack.enter_context(executor)
+        if quiet:
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        if not processes:
+            app = load_app(target) if isinstance(target, str) else target
+
+        # at most 2 batches per worker are in flight, so the whole log is never held in memory
+        pending = collections.deque()
+        for batch in batches(entries, BATCH_SIZE):
+            pending.append(executor.submit(_replay_batch, batch, app))
+            if len(pending) >= 2 * workers:
+                _collect(pending.popleft(), results)
+        while pending:
+            _collect(pending.popleft(), results)
+
+    return results
+
+
+def _collect(future, results):
+    for route, latency, error in future.result():
+        results.setdefault(route, []).append((latency, error))
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(results):
+    """
+    :param results: see replay
+    :return: {route: {'requests': ..., 'p50_ms': ..., 'p90_ms': ..., 'p99_ms': ..., 'max_ms': ..., 'error_rate': ...}}
+    """
+    summary = {}
+    for route, samples in sorted(results.items()):
+        latencies = sorted(latency for latency, _ in samples)
+        summary[route] = {
+            'requests': len(samples),
+            'p50_ms': percentile(latencies, 0.5) / 1e6,
+            'p90_ms': percentile(latencies, 0.9) / 1e6,
+            'p99_ms': percentile(latencies, 0.99) / 1e6,
+            'max_ms': latencies[-1] / 1e6,
+            'error_rate': sum(error for _, error in samples) / len(samples),
+        }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.replay', description=__doc__.split('---')[0])
+    parser.add_argument('app', help='the app to replay the requests against, as module:attribute')
+    parser.add_argument('log', help='the JSONL request log, - for stdin')
+    parser.add_argument('--workers', type=int, default=1, help='the size of the pool')
+    parser.add_argument('--processes', action='store_true', help='use a pool of processes instead of threads')
+    parser.add_argument('--json', dest='json_path', help='write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help="don't silence what the app prints")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    with contextlib.ExitStack() as stack:
+        file = sys.stdin if args.log == '-' else stack.enter_context(open(args.log))
+        entries, skipped = read_log(file)
+        started = time.perf_counter()
+        results = replay(args.app, entries, args.workers, args.processes, quiet=not args.verbose)
+        elapsed = time.perf_counter() - started
+
+    summary = summarize(results)
+    total = sum(route['requests'] for route in summary.values())
+    print(f'{"route":<32} {"requests":>9} {"p50 (ms)":>9} {"p90 (ms)":>9} {"p99 (ms)":>9} {"max (ms)":>9} '
+          f'{"errors":>7}')
+    for route, stats in summary.items():
+        print(f'{route:<32} {stats["requests"]:>9} {stats["p50_ms"]:>9.3f} {stats["p90_ms"]:>9.3f} '
+              f'{stats["p99_ms"]:>9.3f} {stats["max_ms"]:>9.3f} {stats["error_rate"]:>7.1%}')
+    print(f'{total} requests in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f} req/s), '
+          f'{skipped[0]} lines skipped')
+
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump({'requests': total, 'skipped': skipped[0], 'seconds': elapsed, 'routes': summary}, file,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+The benchmark suite of the hot paths. Every scenario builds an API and drives its WSGI callable in-process
+with synthetic environs (see sengoku.testing), no server and no network, and reports:
+    - the requests per second,
+    - the p50 and p99 latency of a request,
+    - the memory allocated per request, the average peak traced by tracemalloc while a request is handled.
+---
+Run it from the repository root:
+    python -m benchmarks.suite
+    python -m benchmarks.suite --filter routing --json results.json
+    python -m benchmarks.suite --compare baseline.json --tolerance 0.15
+With --compare, the scenarios whose throughput dropped, or whose p99 latency grew, by more than the tolerance
+are reported and the exit status is 1, so a CI job can fail the changes that regress performance.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from sengoku.api import API
+from sengoku.middleware import Middleware
+from sengoku.testing import make_environ
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTE_COUNTS = (10, 100, 1000, 10000)
+MIDDLEWARE_DEPTHS = (0, 1, 5, 10)
+ALLOCATION_SAMPLES = 200
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def text_handler(req, resp, **kwargs):
+    resp.text = 'Hello'
+
+
+class BookHandler:
+    def get(self, req, resp):
+        resp.text = 'Book Page'
+
+
+class PassMiddleware(Middleware):
+    def process_request(self, req):
+        pass
+
+    def process_response(self, req, res):
+        pass
+
+
+def build_api(route_count=1):
+    api = API(templates_dir=os.path.join(ROOT, 'templates'), static_dir=os.path.join(ROOT, 'static'))
+    for index in range(route_count):
+        api.add_route(f'/static{index}/list', text_handler)
+        api.add_route(f'/param{index}/{{item_id:d}}/detail', text_handler)
+    return api
+
+
+def routing_scenarios():
+    for route_count in ROUTE_COUNTS:
+        api = build_api(route_count)
+        # the last registered routes, the worst case of a linear scan
+        yield f'routing-{route_count}-static', api, make_environ(f'/static{route_count - 1}/list')
+        yield f'routing-{route_count}-param', api, make_environ(f'/param{route_count - 1}/42/detail')
+
+
+def handler_scenarios():
+    api = build_api()
+    api.add_route('/book', BookHandler)
+    yield 'handler-function', api, make_environ('/static0/list')
+    yield 'handler-class', api, make_environ('/book')
+
+
+def middleware_scenarios():
+    for depth in MIDDLEWARE_DEPTHS:
+        api = build_api()
+        for _ in range(depth):
+            api.add_middleware(PassMiddleware)
+        yield f'middleware-{depth}', api, make_environ('/static0/list')
+
+
+def response_scenarios():
+    api = build_api()
+
+    @api.route('/json')
+    def json_handler(req, resp):
+        resp.json = {'name': 'data', 'type': 'JSON', 'items': list(range(20))}
+
+    @api.route('/template')
+    def template_handler(req, resp):
+        resp.html = api.template('index.html', context={'name': 'Sengoku', 'title': 'Benchmark'})
+
+    yield 'response-text', api, make_environ('/static0/list')
+    yield 'response-json', api, make_environ('/json')
+    yield 'response-template', api, make_environ('/template')
+    yield 'not-found', api, make_environ('/nowhere/to/go')
+
+
+SCENARIOS = (routing_scenarios, handler_scenarios, middleware_scenarios, response_scenarios)
+
+
+def call(api, environ):
+    # the environ is modified while handling the request and its body stream is consumed, every request gets a copy
+    environ = {**environ, 'wsgi.input': io.BytesIO()}
+    app_iter = api(environ, start_response)
+    try:
+        for _ in app_iter:
+            pass
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def run_scenario(api, environ, requests, warmup):
+    for _ in range(warmup):
+        call(api, environ)
+
+    latencies = []
+    started = time.perf_counter_ns()
+    for _ in range(requests):
+        request_started = time.perf_counter_ns()
+        call(api, environ)
+        latencies.append(time.perf_counter_ns() - request_started)
+    elapsed = time.perf_counter_ns() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'rps': requests / (elapsed / 1e9),
+        'p50_us': latencies[len(latencies) // 2] / 1e3,
+        'p99_us': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] / 1e3,
+        'alloc_bytes': allocated_per_request(api, environ),
+    }
+
+
+def allocated_per_request(api, environ):
+    # tracemalloc slows everything down, so the allocations are measured apart from the timings
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(ALLOCATION_SAMPLES):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            call(api, environ)
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - baseline
+    finally:
+        tracemalloc.stop()
+    return total / ALLOCATION_SAMPLES
+
+
+def run(requests=5000, warmup=200, name_filter=None, log=print):
+    results = {}
+    for scenarios in SCENARIOS:
+        for name, api, environ in scenarios():
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = run_scenario(api, environ, requests, warmup)
+            log(format_row(name, results[name]))
+    return results
+
+
+def format_row(name, result):
+    return (f'{name:<24} {result["rps"]:>10.0f} {result["p50_us"]:>9.1f} {result["p99_us"]:>9.1f} '
+            f'{result["alloc_bytes"]:>11.0f}')
+
+
+def compare(results, baseline, tolerance):
+    """
+    The scenarios of results that regressed from the baseline by more than tolerance (a fraction, e.g. 0.1).
+
+    :param results:
+    :param baseline:
+    :param tolerance:
+    :return: [(name, description), ...]
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append((name, f'{before["rps"]:.0f} -> {result["rps"]:.0f} req/s'))
+        if result['p99_us'] > before['p99_us'] * (1 + tolerance):
+            regressions.append((name, f'p99 {before["p99_us"]:.1f} -> {result["p99_us"]:.1f} us'))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite', description=__doc__.split('---')[0])
+    parser.add_argument('--requests', type=int, default=5000, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=200, help='untimed requests per scenario')
+    parser.add_argument('--filter', dest='name_filter', help='only run the scenarios whose name contains it')
+    parser.add_argument('--json', dest='json_path', help='write the results to this file')
+    parser.add_argument('--compare', dest='baseline_path', help='the results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='the accepted regression, 0.1 is 10%%')
+    args = parser.parse_args(argv)
+
+    print(f'{"scenario":<24} {"req/s":>10} {"p50 (us)":>9} {"p99 (us)":>9} {"alloc (B)":>11}')
+    results = run(args.requests, args.warmup, args.name_filter)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, file, indent=2)
+
+    if args.baseline_path:
+        with open(args.baseline_path) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, description in regressions:
+            print(f'REGRESSION {name}: {description}')
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""
+The sengoku command line.
+    python -m sengoku compress-static [static_dir]
+    python -m sengoku serve app:app [--bind 127.0.0.1:8000] [--workers N] [--threads N] [--max-requests N]
+Once the package is installed, it is also the sengoku command.
+"""
+import argparse
+import os
+import sys
+
+from .compression import compress_static
+from .server import serve
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='sengoku')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compress_parser = commands.add_parser('compress-static', help='pre-generate the .gz/.br variants of the static files')
+    compress_parser.add_argument('static_dir', nargs='?', default='static')
+
+    serve_parser = commands.add_parser('serve', help='serve the app with a preforking server')
+    serve_parser.add_argument('app', help='the app to serve, as module:attribute, e.g. app:app')
+    serve_parser.add_argument('--bind', default='127.0.0.1:8000', help='host:port')
+    serve_parser.add_argument('--workers', type=int, help='the number of workers, one per core by default')
+    serve_parser.add_argument('--threads', type=int, default=0, help='the number of threads of every worker')
+    serve_parser.add_argument('--queue-size', type=int, default=64,
+                              help='with threads, how many connections can wait before getting a 503')
+    serve_parser.add_argument('--max-requests', type=int, default=0,
+                              help='restart a worker after that many requests')
+    serve_parser.add_argument('--max-requests-jitter', type=int, default=0)
+    serve_parser.add_argument('--graceful-timeout', type=float, default=30)
+    serve_parser.add_argument('--access-log', action='store_true')
+    serve_parser.add_argument('--max-boot-failures', type=int, default=5,
+                              help='stop when that many workers in a row fail to boot')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compress-static':
+        compress_static(args.static_dir, log=print)
+    elif args.command == 'serve':
+        # like gunicorn, the app module is looked up from the current directory
+        sys.path.insert(0, os.getcwd())
+        serve(args.app, args.bind, workers=args.workers, threads=args.threads, queue_size=args.queue_size,
+              max_requests=args.max_requests, max_requests_jitter=args.max_requests_jitter,
+              graceful_timeout=args.graceful_timeout, access_log=args.access_log,
+              max_boot_failures=args.max_boot_failures)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,54 @@
+import functools
+import importlib
 import inspect
 import os
-import requests
-from parse import parse
-from webob import Request
-from wsgiadapter import WSGIAdapter
-from jinja2 import Environment, FileSystemLoader
-from whitenoise import WhiteNoise
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter_ns
+from types import MappingProxyType
+from .asgi import (declared_content_length, encode_headers, read_body_file, run_coroutine, run_in_threadpool, run_wsgi,
+                   scope_to_environ)
+from .background import BackgroundPool
+from .cache import LRUCache
+from .compression import compress_static, load_brotli
+from .dispatch import build_dispatch_table
+from .exceptions import HTTPError, RequestEntityTooLarge
+from .instrumentation import Instrumentation, current_timings
 from .middleware import Middleware
-from .response import Response
+from .request import Request
+from .response import Response, default_json_serializer, load_json_serializer
+from .router import Router, path_fields
+from .static import StaticFiles
+from .templating import buffer_chunks, buffer_chunks_async, make_bytecode_cache, render_cache_key
+
+STATIC_PREFIX = '/static'
+# imported on first use, and ahead of time by API.precompile
+LAZY_DEPENDENCIES = ('webob', 'jinja2', 'whitenoise')
+# the pid of the process, kept up to date in the forked children, so the requests don't need a getpid() call
+_pid = os.getpid()
+
+
+def _update_pid():
+    global _pid
+    _pid = os.getpid()
+
+
+os.register_at_fork(after_in_child=_update_pid)
+
+
+def cache_policy(cache):
+    # sengoku.caching is only imported by the apps that cache
+    if cache is None:
+        return None
+    from .caching import CachePolicy
+
+    return CachePolicy.from_option(cache)
+
+
+def is_static_path(path_info):
+    # /static and /static/... but not /staticfoo
+    return path_info == STATIC_PREFIX or path_info.startswith(f'{STATIC_PREFIX}/')
 
 
 def default_response(response):
@@ -16,7 +57,9 @@ def default_response(response):
 
 
 class API:
-    def __init__(self, templates_dir='templates', static_dir='static'):
+    def __init__(self, templates_dir='templates', static_dir='static', max_threads=None,
+                 json_serializer=None, bytecode_cache=None, render_cache_size=256, render_cache_ttl=None,
+                 max_body_size=None, background=None):
         """
         Define a dict called self. routes where the framework will store paths as keys and handlers as value.
         Values of that dict will look something like this
@@ -30,34 +73,376 @@ class API:
         FileSystemLoader loads templates from the file system. This loader can find templates in folders
         on the file system and is the preferred way to load them. It takes the path t the templates directory
         as a parameter
+        bytecode_cache is a jinja2.BytecodeCache (e.g. sengoku.templating.MemoryBytecodeCache) or the path
+        of a directory where the compiled templates are stored and shared by all the workers.
+        The Environment (and Jinja2 itself) is only loaded with the first template, see templates_env.
+        Rendered templates can be kept in an LRU cache of render_cache_size entries, which expire after
+        render_cache_ttl seconds, see API.template
         ---
         To configure WhiteNoise, wrap the WSGI app and give WhiteNoise the static folder path as a parameter.
+        In front of WhiteNoise, self.static serves the fingerprinted (content-hashed) names of the static files
+        with a far-future cache, the templates get their URLs with {{ static('css/main.css') }}.
+        WhiteNoise is loaded with the first static file, see whitenoise.
+        ---
+        Every route is also compiled into self.router, a prefix tree used by find_handler, so the lookup
+        does not have to go through all the registered routes.
+        ---
+        When the app is served through its ASGI interface (API.asgi), sync handlers run in a thread pool
+        bounded by max_threads, so they don't block the event loop. The pool is created on first use.
+        ---
+        json_serializer is the callable that turns response.json into bytes (e.g. orjson.dumps).
+        By default, orjson is used when it is installed and the stdlib json otherwise.
+        ---
+        max_body_size (in bytes) is the default size limit of the request bodies, the routes can set their own.
+        A request whose body is larger gets a 413 before its body is read, see check_body_size.
+        ---
+        background is the BackgroundPool that runs the tasks added with response.add_background,
+        once the responses are sent, see sengoku.background.
+        ---
+        self.instrumentation is None until enable_instrumentation is called, see sengoku.instrumentation
+        ---
+        The routes, the middlewares and the exception handler are registered while the app is set up, under a lock.
+        When the app starts serving (its first request, or its startup by a server), it is frozen: self.routes
+        becomes a read-only snapshot and registering anything else raises a RuntimeError.
+        From then on, the requests only read this state, so they can be handled by many threads at once.
+        ---
+        The on_startup hooks run once per process, when it starts serving: in every worker of a prefork server,
+        after the fork, so the resources they open (e.g. a sengoku.pool.ResourcePool) are not shared between
+        workers. The on_shutdown hooks run from shutdown.
         """
         self.routes = {}
-        self.templates_env = Environment(loader=FileSystemLoader(os.path.abspath(templates_dir)))
+        self.router = Router()
+        self.templates_dir = templates_dir
+        self.bytecode_cache = bytecode_cache
+        self._templates_env = None
+        self.render_cache = LRUCache(render_cache_size, render_cache_ttl)
+        self._async_templates_env = None
         self.exception_handler = None
-        self.whitenoise = WhiteNoise(self.wsgi_app, root=static_dir)
+        self.static_dir = static_dir
+        self._whitenoise = None
+        self.static = StaticFiles(static_dir, prefix=STATIC_PREFIX)
+        self.instrumentation = None
         self.middleware = Middleware(self)
+        self.max_threads = max_threads
+        self._executor = None
+        self.json_serializer = json_serializer or default_json_serializer
+        self.max_body_size = max_body_size
+        self.background = background or BackgroundPool()
+        # the raw WSGI middlewares, wrapped around _serve_wsgi, see add_wsgi_middleware
+        self._wsgi_stack = self._serve_wsgi
+        self.frozen = False
+        self._registration_lock = threading.RLock()
+        self.startup_hooks = []
+        self.shutdown_hooks = []
+        # the pid of the process in which the startup hooks ran
+        self._started_pid = None
+        self._startup_task = None
+
+    @property
+    def templates_env(self):
+        """
+        The Jinja2 Environment, created (and Jinja2 imported) when it is first needed,
+        so that the apps without templates never load Jinja2.
+
+        :return:
+        """
+        if self._templates_env is None:
+            with self._registration_lock:
+                if self._templates_env is None:
+                    from jinja2 import Environment, FileSystemLoader
+                    templates_env = Environment(loader=FileSystemLoader(os.path.abspath(self.templates_dir)),
+                                                bytecode_cache=make_bytecode_cache(self.bytecode_cache))
+                    templates_env.globals['static'] = self.static.url
+                    self._templates_env = templates_env
+        return self._templates_env
+
+    @property
+    def whitenoise(self):
+        """
+        The WhiteNoise app that serves the static files, created when the first static file is requested.
+        It indexes the static directory when it is created.
+
+        :return:
+        """
+        if self._whitenoise is None:
+            with self._registration_lock:
+                if self._whitenoise is None:
+                    from whitenoise import WhiteNoise
+                    self._whitenoise = WhiteNoise(self.wsgi_app, root=self.static_dir)
+        return self._whitenoise
 
     def __call__(self, environ, start_response):
         """
         Treat requests for static files differently from all other requests.
-        When a request is coming in for a static file -> call WhiteNoise.
+        When a request is coming in for a static file -> call serve_static.
         For others -> call the middleware.
+        The raw WSGI middlewares (see add_wsgi_middleware) come in front of both.
 
         :param environ:
         :param start_response:
         :return:
         """
-        path_info = environ['PATH_INFO']
+        if self._started_pid != _pid:
+            self.startup()
+
+        return self._wsgi_stack(environ, start_response)
+
+    def _serve_wsgi(self, environ, start_response):
+        if is_static_path(environ['PATH_INFO']):
+            return self.serve_static(environ, start_response)
 
-        if path_info.startswith('/static'):
-            # remove /static from the path; otherwise, WhiteNoise won't find the files
-            environ['PATH_INFO'] = path_info[len('/static'):]
-            return self.whitenoise(environ, start_response)
+        if self.instrumentation is not None:
+            return self.instrumentation.wsgi(self.middleware, environ, start_response)
 
         return self.middleware(environ, start_response)
 
+    def serve_static(self, environ, start_response):
+        """
+        Serve the fingerprinted files from self.static, hand the others to WhiteNoise.
+
+        :param environ:
+        :param start_response:
+        :return:
+        """
+        # remove /static from the path; otherwise, WhiteNoise won't find the files
+        environ['PATH_INFO'] = environ['PATH_INFO'][len(STATIC_PREFIX):]
+
+        app_iter = self.static.serve(environ, start_response)
+        if app_iter is not None:
+            return app_iter
+
+        return self.whitenoise(environ, start_response)
+
+    async def asgi(self, scope, receive, send):
+        """
+        The ASGI entrypoint, to be served by an ASGI server, e.g., uvicorn app:app.asgi
+        Static files are served by serve_static in the thread pool, other requests go through the middleware
+        and handle_request_async, where async def handlers are awaited directly.
+
+        :param scope:
+        :param receive:
+        :param send:
+        :return:
+        """
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if self._started_pid != _pid:
+            await self.startup_async()
+
+        environ = scope_to_environ(scope)
+
+        if is_static_path(environ['PATH_INFO']):
+            environ['wsgi.input'], length = await read_body_file(receive)
+            environ['CONTENT_LENGTH'] = str(length)
+            status, headers, body = await self.run_in_threadpool(run_wsgi, self.serve_static, environ)
+            await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        respond = functools.partial(self._respond_asgi, environ, receive)
+        if self.instrumentation is not None:
+            await self.instrumentation.asgi(respond, send)
+        else:
+            await respond(send)
+
+    async def _respond_asgi(self, environ, receive, send):
+        # the route is known before the body is received, so a body over its size limit is never received whole
+        request = Request(environ)
+        self.match(request)
+        limit = request.max_body_size
+        try:
+            declared = declared_content_length(environ['asgi.scope'])
+            if limit is not None and declared is not None and declared > limit:
+                raise RequestEntityTooLarge(f'The request body is larger than {limit} bytes.')
+            environ['wsgi.input'], length = await read_body_file(receive, limit)
+            environ['CONTENT_LENGTH'] = str(length)
+        except HTTPError as e:
+            response = Response(self.json_serializer)
+            e.apply(response)
+        else:
+            response = await self.middleware.handle_asgi_request(request)
+        await response.asgi(send, self.run_in_threadpool)
+        if response.background is not None:
+            self.background.schedule_async(
+                response.background, functools.partial(self.report_background_error_async, request, response),
+            )
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup_async()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': repr(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown_async()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def on_startup(self, hook):
+        """
+        Register a function (or an async function) to run once per process before it serves its first request,
+        e.g. to open a pool of database connections. Can be used as a decorator.
+
+        :param hook:
+        :return:
+        """
+        with self._registration_lock:
+            self._check_not_frozen()
+            self.startup_hooks.append(hook)
+        return hook
+
+    def on_shutdown(self, hook):
+        """
+        Register a function (or an async function) to run when the app shuts down, see shutdown.
+        Can be used as a decorator.
+
+        :param hook:
+        :return:
+        """
+        with self._registration_lock:
+            self._check_not_frozen()
+            self.shutdown_hooks.append(hook)
+        return hook
+
+    def startup(self):
+        """
+        Freeze the app and run the startup hooks, once per process. Done by the first request of the process,
+        or ahead of it by a server, e.g. by every worker of a prefork server right after the fork.
+        An async hook is run in its own event loop, see startup_async for the ASGI interface.
+
+        :return:
+        """
+        with self._registration_lock:
+            if self._started_pid == _pid:
+                return
+            self.freeze()
+            for hook in self.startup_hooks:
+                if inspect.iscoroutinefunction(hook):
+                    run_coroutine(hook())
+                else:
+                    hook()
+            self._started_pid = _pid
+
+    async def startup_async(self):
+        """
+        The ASGI counterpart of startup, run by the lifespan startup (or the first request without it).
+        The async hooks are awaited in the event loop of the server, the requests that arrive meanwhile wait for them.
+
+        :return:
+        """
+        if self._started_pid == _pid:
+            return
+        import asyncio
+
+        if self._startup_task is None:
+            self._startup_task = asyncio.ensure_future(self._run_startup_hooks())
+        await asyncio.shield(self._startup_task)
+
+    async def _run_startup_hooks(self):
+        try:
+            self.freeze()
+            for hook in self.startup_hooks:
+                if inspect.iscoroutinefunction(hook):
+                    await hook()
+                else:
+                    hook()
+            self._started_pid = _pid
+        finally:
+            # a failed startup is tried again by the next request
+            self._startup_task = None
+
+    def shutdown(self):
+        """
+        Release what the app started while serving: run the pending background tasks, run the shutdown hooks
+        and stop the thread pools. Called when the ASGI server shuts down (see shutdown_async), and by every worker
+        of a prefork server before it exits; other WSGI servers call it from their worker exit hook.
+        The shutdown hooks only run in a process whose startup hooks ran, a failing hook does not stop the others.
+
+        :return:
+        """
+        self.background.shutdown(wait=True)
+        for hook in self._pending_shutdown_hooks():
+            try:
+                if inspect.iscoroutinefunction(hook):
+                    run_coroutine(hook())
+                else:
+                    hook()
+            except Exception as e:
+                traceback.print_exception(e)
+        self._shutdown_executor()
+
+    async def shutdown_async(self):
+        await self.background.drain_async()
+        self.background.shutdown(wait=True)
+        for hook in self._pending_shutdown_hooks():
+            try:
+                if inspect.iscoroutinefunction(hook):
+                    await hook()
+                else:
+                    hook()
+            except Exception as e:
+                traceback.print_exception(e)
+        self._shutdown_executor()
+
+    def _pending_shutdown_hooks(self):
+        with self._registration_lock:
+            if self._started_pid != _pid:
+                return []
+            self._started_pid = None
+            return list(self.shutdown_hooks)
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def run_background(self, app_iter, request, response):
+        """
+        Wrap the iterable of a WSGI response so that its background tasks are handed to the pool
+        when the server closes it.
+
+        :param app_iter:
+        :param request:
+        :param response:
+        :return:
+        """
+        on_error = functools.partial(self.report_background_error, request, response)
+        return self.background.after_response(app_iter, response.background, on_error)
+
+    def report_background_error(self, request, response, e):
+        """
+        Hand the exception of a background task to the exception handler. The response was already sent,
+        so it is only given for context; without an exception handler, the traceback is printed to stderr.
+
+        :param request:
+        :param response:
+        :param e:
+        :return:
+        """
+        if self.exception_handler is None:
+            traceback.print_exception(e)
+        elif inspect.iscoroutinefunction(self.exception_handler):
+            run_coroutine(self.exception_handler(request, response, e))
+        else:
+            self.exception_handler(request, response, e)
+
+    async def report_background_error_async(self, request, response, e):
+        if inspect.iscoroutinefunction(self.exception_handler):
+            await self.exception_handler(request, response, e)
+        else:
+            self.report_background_error(request, response, e)
+
+    async def run_in_threadpool(self, func, *args, **kwargs):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix='sengoku')
+        return await run_in_threadpool(self._executor, func, *args, **kwargs)
+
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
 
@@ -65,18 +450,57 @@ class API:
 
         return response(environ, start_response)
 
-    def add_route(self, path, handler, allowed_methods=None):
+    def add_route(self, path, handler, allowed_methods=None, instances='request', pool_size=8, cache=None,
+                  max_body_size=None):
+        """
+        Register the handler for the path and precompute its dispatch table, {'GET': callable, ...},
+        so handling a request doesn't have to inspect the handler again.
+        For a class-based handler, instances tells how the class is instantiated: 'request' (a new instance
+        for every request), 'singleton' (one shared instance) or 'pool' (instances reused from a pool
+        of pool_size idle instances). The last two are meant for stateless views.
+        The annotated params of the handler are compiled into converters here, see sengoku.params
+        cache makes the responses of the route cacheable by CacheMiddleware, see sengoku.caching
+        max_body_size overrides the request body size limit of the app for the route
+
+        :param path:
+        :param handler:
+        :param allowed_methods:
+        :param instances:
+        :param pool_size:
+        :param cache:
+        :param max_body_size:
+        :return:
+        """
+        with self._registration_lock:
+            self._check_not_frozen()
+            self._add_route(path, handler, allowed_methods, instances, pool_size, cache, max_body_size)
+
+    def _add_route(self, path, handler, allowed_methods, instances, pool_size, cache, max_body_size):
         assert path not in self.routes, 'Such route already exists.'
 
         if allowed_methods is None:
             allowed_methods = ['get', 'post', 'put', 'patch', 'delete', 'options']
 
-        self.routes[path] = {'handler': handler, 'allowed_methods': allowed_methods}
+        methods = build_dispatch_table(handler, allowed_methods, instances, pool_size, path_fields(path))
+
+        self.routes[path] = {
+            'path': path,
+            'handler': handler,
+            'allowed_methods': allowed_methods,
+            'methods': methods,
+            'allowed': frozenset(methods),
+            'async_methods': frozenset(
+                method for method, callable_ in methods.items() if inspect.iscoroutinefunction(callable_)
+            ),
+            'cache': cache_policy(cache),
+            'max_body_size': max_body_size if max_body_size is not None else self.max_body_size,
+        }
+        self.router.add(path, self.routes[path])
 
-    def route(self, path, allowed_methods=None):
+    def route(self, path, allowed_methods=None, **kwargs):
         """
         Take a path as an argument and in the wrapper method added this path in the self. routes dictionary
-        as a key and the handler as a value.
+        as a key and the handler as a value. The other keyword arguments are passed to add_route.
 
         :param path:
         :param allowed_methods:
@@ -84,57 +508,109 @@ class API:
         """
 
         def wrapper(handler):
-            self.add_route(path, handler, allowed_methods)
+            self.add_route(path, handler, allowed_methods, **kwargs)
             return handler
 
         return wrapper
 
     def find_handler(self, request_path):
         """
-        Compare the path to the request path, the method tries to parse it and if there is a result,
+        Walk the compiled route tree with the request path. If a route matches,
         it returns both the handler and keyword params as a dictionary.
 
         :param request_path:
         :return:
         """
-        for path, handler_data in self.routes.items():
-            parse_result = parse(path, request_path)
-            if parse_result is not None:
-                return handler_data, parse_result.named
-        return None, None
+        return self.router.match(request_path)
+
+    def match(self, request):
+        """
+        find_handler for the request path, done once per request: the result is kept on the request,
+        so the middlewares that need the route of the request don't route it again.
+        It also sets the body size limit of the route on the request, so it applies to the middlewares as well.
+
+        :param request:
+        :return:
+        """
+        if request.route_match is None:
+            timings = current_timings.get()
+            if timings is None:
+                request.route_match = self.find_handler(request_path=request.path)
+            else:
+                started = perf_counter_ns()
+                request.route_match = self.find_handler(request_path=request.path)
+                timings.add('routing', started)
+                if request.route_match[0] is not None:
+                    timings.route = request.route_match[0]['path']
+            handler_data = request.route_match[0]
+            request.max_body_size = handler_data['max_body_size'] if handler_data is not None else self.max_body_size
+        return request.route_match
+
+    def get_handler(self, handler_data, request):
+        """
+        Look the request method up in the dispatch table of the route.
+        For a class-based handler, the table holds its get(), post()... methods, for a function the allowed methods.
+
+        :param handler_data:
+        :param request:
+        :return:
+        """
+        handler = handler_data['methods'].get(request.method)
+        # if the handler is None, it means that such function was not implemented in the class
+        # or that the request method is not allowed
+        if handler is None:
+            raise AttributeError('Method not allowed', request.method)
+
+        return handler
+
+    def check_body_size(self, handler_data, request):
+        """
+        Reject the request upfront when its Content-Length is over the body size limit of the route.
+        Otherwise, the limit (set on the request by match) is enforced while the body is read, for the bodies
+        sent without a Content-Length.
+
+        :param handler_data:
+        :param request:
+        :return:
+        """
+        limit = handler_data['max_body_size']
+        if limit is None:
+            return
+        length = request.content_length
+        if length is not None and length > limit:
+            raise RequestEntityTooLarge(f'The request body is larger than {limit} bytes.')
 
     def handle_request(self, request):
         """
-        Check if the handler is a function or if it is a class.
-        If it's a class, depending on the request method, it should call the appropriate method of the class.
-        That is, if the request method is GET it should call the get() method of the class...
-        if it is POST it should call the post() method... and so on
+        Find the handler for the request path and call it.
+        An async def handler can be used from the WSGI interface as well, it is then run in its own event loop.
+        An HTTPError raised by the handler becomes the response, the other exceptions go to the exception handler.
 
         :param request:
         :return:
         """
-        response = Response()
+        response = Response(self.json_serializer)
 
-        handler_data, kwargs = self.find_handler(request_path=request.path)
+        handler_data, kwargs = self.match(request)
 
         try:
             if handler_data is not None:
-                handler = handler_data['handler']
-                allowed_methods = handler_data['allowed_methods']
-
-                if inspect.isclass(handler):
-                    handler = getattr(handler(), request.method.lower(), None)
-                    # if the handler is None, it means that such function was not implemented in the class
-                    # and the request method is not allowed
-                    if handler is None:
-                        raise AttributeError('Method not allowed', request.method)
+                handler = self.get_handler(handler_data, request)
+                self.check_body_size(handler_data, request)
+                timings = current_timings.get()
+                started = perf_counter_ns() if timings is not None else 0
+
+                if request.method in handler_data['async_methods']:
+                    run_coroutine(handler(request, response, **kwargs))
                 else:
-                    if request.method.lower() not in allowed_methods:
-                        raise AttributeError('Method not allowed', request.method)
+                    handler(request, response, **kwargs)
 
-                handler(request, response, **kwargs)
+                if timings is not None:
+                    timings.add('handler', started)
             else:
                 default_response(response)
+        except HTTPError as e:
+            e.apply(response)
         except Exception as e:
             if self.exception_handler is None:
                 raise e
@@ -143,6 +619,46 @@ class API:
 
         return response
 
+    async def handle_request_async(self, request):
+        """
+        The ASGI counterpart of handle_request. An async def handler (or an async method of a class-based handler)
+        is awaited, a sync handler is run in the thread pool. The exception handler may be async as well.
+
+        :param request:
+        :return:
+        """
+        response = Response(self.json_serializer)
+
+        handler_data, kwargs = self.match(request)
+
+        try:
+            if handler_data is not None:
+                handler = self.get_handler(handler_data, request)
+                self.check_body_size(handler_data, request)
+                timings = current_timings.get()
+                started = perf_counter_ns() if timings is not None else 0
+
+                if request.method in handler_data['async_methods']:
+                    await handler(request, response, **kwargs)
+                else:
+                    await self.run_in_threadpool(handler, request, response, **kwargs)
+
+                if timings is not None:
+                    timings.add('handler', started)
+            else:
+                default_response(response)
+        except HTTPError as e:
+            e.apply(response)
+        except Exception as e:
+            if self.exception_handler is None:
+                raise e
+            elif inspect.iscoroutinefunction(self.exception_handler):
+                await self.exception_handler(request, response, e)
+            else:
+                self.exception_handler(request, response, e)
+
+        return response
+
     def test_session(self, base_url='http://testserver'):
         """
         To use the Requests WSGI Adapter, you need to mount it to a Session object.
@@ -152,18 +668,207 @@ class API:
         :param base_url:
         :return:
         """
+        # only the tests need requests and the adapter
+        import requests
+        from wsgiadapter import WSGIAdapter
+
         session = requests.Session()
         session.mount(prefix=base_url, adapter=WSGIAdapter(self))
         return session
 
-    def template(self, template_name, context=None):
+    def test_client(self, base_url='http://testserver'):
+        """
+        A client that calls the app directly, without going through requests and the WSGI adapter.
+        It takes the same arguments as the test_session, and is much faster.
+
+        :param base_url:
+        :return: a sengoku.testing.TestClient
+        """
+        from .testing import TestClient
+
+        return TestClient(self, base_url)
+
+    def template(self, template_name, context=None, cache=False):
+        """
+        Render the template with the context.
+        With cache=True, the output is kept in self.render_cache, keyed by the template name and the context,
+        so rendering the same context again costs a dict lookup. The context values must be hashable for that,
+        otherwise the template is simply rendered.
+
+        :param template_name:
+        :param context:
+        :param cache:
+        :return:
+        """
         if context is None:
             context = {}
 
-        return self.templates_env.get_template(template_name).render(**context)
+        timings = current_timings.get()
+        started = perf_counter_ns() if timings is not None else 0
+
+        key = render_cache_key(template_name, context) if cache else None
+        if key is not None:
+            rendered = self.render_cache.get(key)
+            if rendered is not None:
+                if timings is not None:
+                    timings.add('template', started)
+                return rendered
+
+        rendered = self.templates_env.get_template(template_name).render(**context)
+
+        if key is not None:
+            self.render_cache.set(key, rendered)
+
+        if timings is not None:
+            timings.add('template', started)
+        return rendered
+
+    def stream_template(self, template_name, context=None, min_chunk_size=1024):
+        """
+        Render the template piece by piece with Jinja2's generate(), to be assigned to response.html (or body),
+        e.g. response.html = api.stream_template('index.html', context={...})
+        The pieces are buffered until they reach min_chunk_size bytes, 0 sends every piece as it is rendered.
+
+        :param template_name:
+        :param context:
+        :param min_chunk_size:
+        :return:
+        """
+        if context is None:
+            context = {}
+
+        chunks = self.templates_env.get_template(template_name).generate(**context)
+        return buffer_chunks(chunks, min_chunk_size)
+
+    def stream_template_async(self, template_name, context=None, min_chunk_size=1024):
+        """
+        Same as stream_template, with Jinja2's generate_async(), for the async handlers served through API.asgi.
+        The template can then await async functions given in the context.
+
+        :param template_name:
+        :param context:
+        :param min_chunk_size:
+        :return:
+        """
+        if context is None:
+            context = {}
+
+        if self._async_templates_env is None:
+            # same loader and bytecode cache, but the templates are compiled as coroutines
+            self._async_templates_env = self.templates_env.overlay(enable_async=True)
+
+        chunks = self._async_templates_env.get_template(template_name).generate_async(**context)
+        return buffer_chunks_async(chunks, min_chunk_size)
+
+    def invalidate_template(self, template_name=None):
+        """
+        Drop the cached renderings of a template, or of all the templates if no name is given.
+
+        :param template_name:
+        :return:
+        """
+        if template_name is None:
+            self.render_cache.clear()
+            return
+
+        for key in self.render_cache.keys():
+            if key[0] == template_name:
+                self.render_cache.delete(key)
+
+    def compress_static(self):
+        """
+        Generate the .gz/.br variants of the static files, and reload WhiteNoise so it serves them
+        to the clients that accept them.
+
+        :return:
+        """
+        generated = compress_static(self.static_dir)
+        # the fingerprinted files get the new variants
+        self.static.refresh()
+        # indexed again on the next static request
+        self._whitenoise = None
+        return generated
+
+    def precompile(self):
+        """
+        Do ahead of time the work that is otherwise done by the first requests: import the dependencies that are
+        loaded lazily, compile every template (into the bytecode cache as well, when there is one), build
+        the manifest of the static files, index them for WhiteNoise and compile the middleware pipeline.
+        The routes are compiled as they are added.
+        A prefork server calls it before forking, so the workers share the result instead of each doing it.
+
+        :return:
+        """
+        for module_name in LAZY_DEPENDENCIES:
+            importlib.import_module(module_name)
+        # the optional ones
+        load_brotli()
+        load_json_serializer()
+        if os.path.isdir(self.templates_dir):
+            for template_name in self.templates_env.list_templates():
+                self.templates_env.get_template(template_name)
+        self.static.build()
+        # WhiteNoise indexes the static files when it is created
+        self.whitenoise
+        self.middleware.compile()
+
+    def freeze(self):
+        """
+        Snapshot the registered routes and middlewares, after which the app cannot be changed anymore.
+        It is done when the app starts serving, or by calling it at the end of the setup of the app.
+
+        :return:
+        """
+        with self._registration_lock:
+            if self.frozen:
+                return
+            self.middleware.compile()
+            self.routes = MappingProxyType(self.routes)
+            self.frozen = True
+
+    def _check_not_frozen(self):
+        if self.frozen:
+            raise RuntimeError('The app is frozen once it serves requests, everything must be registered before.')
 
     def add_exception_handler(self, exception_handler):
-        self.exception_handler = exception_handler
+        with self._registration_lock:
+            self._check_not_frozen()
+            self.exception_handler = exception_handler
+
+    def add_middleware(self, middleware_cls, **kwargs):
+        with self._registration_lock:
+            self._check_not_frozen()
+            self.middleware.add(middleware_cls, **kwargs)
+
+    def add_wsgi_middleware(self, middleware_cls, **kwargs):
+        """
+        Wrap a raw WSGI middleware around the app, e.g. a sengoku.wsgi.BodyTransformMiddleware subclass or
+        a third-party WSGI component. The last added is the outermost. They are only run for the WSGI interface,
+        API.asgi doesn't go through them.
+
+        :param middleware_cls: called with the WSGI app to wrap and kwargs
+        :return:
+        """
+        with self._registration_lock:
+            self._check_not_frozen()
+            self._wsgi_stack = middleware_cls(self._wsgi_stack, **kwargs)
 
-    def add_middleware(self, middleware_cls):
-        self.middleware.add(middleware_cls)
+    def enable_instrumentation(self, server_timing=True, metrics_path='/metrics', profile_every=0, **kwargs):
+        """
+        Time the routing, the middlewares, the handlers, the templates and the serialization of every request,
+        see sengoku.instrumentation. The per-route metrics are served on metrics_path, unless it is None.
+        With profile_every=N, one request out of N is profiled with cProfile.
+
+        :param server_timing:
+        :param metrics_path:
+        :param profile_every:
+        :return: the Instrumentation, which holds the metrics and the profiles
+        """
+        with self._registration_lock:
+            self._check_not_frozen()
+            self.instrumentation = Instrumentation(server_timing=server_timing, profile_every=profile_every, **kwargs)
+            if metrics_path is not None:
+                self.add_route(metrics_path, self.instrumentation.metrics_handler, allowed_methods=['get'])
+            # the middleware hooks are wrapped to be timed
+            self.middleware.compile()
+        return self.instrumentation
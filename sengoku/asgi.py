@@ -0,0 +1,175 @@
+"""
+Helpers that translate between the ASGI interface and the WSGI environ that the rest of the framework works with.
+According to the ASGI specification, an application is an async callable that receives a connection scope
+and two awaitables: receive, to get the events (e.g., the request body) from the server,
+and send, to send the events (e.g., the response start and body) back to the server.
+"""
+import contextvars
+import functools
+import io
+import sys
+import tempfile
+
+from .exceptions import RequestEntityTooLarge
+
+# request bodies above this size are spooled to a temporary file instead of being kept in memory
+SPOOL_SIZE = 1024 * 1024
+
+
+async def read_body(receive):
+    """
+    The request body may arrive in several http.request events. Keep receiving until more_body is False.
+
+    :param receive:
+    :return:
+    """
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def read_body_file(receive, max_size=None, spool_size=SPOOL_SIZE):
+    """
+    Like read_body, but the body is written to a temporary file that only stays in memory up to spool_size bytes.
+    The body is rejected with RequestEntityTooLarge as soon as it gets larger than max_size.
+
+    :param receive:
+    :param max_size:
+    :param spool_size:
+    :return: the file, at its beginning, and the length of the body
+    """
+    body = tempfile.SpooledTemporaryFile(spool_size)
+    length = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        length += len(chunk)
+        if max_size is not None and length > max_size:
+            body.close()
+            raise RequestEntityTooLarge(f'The request body is larger than {max_size} bytes.')
+        body.write(chunk)
+        more_body = message.get('more_body', False)
+    body.seek(0)
+    return body, length
+
+
+def declared_content_length(scope):
+    for name, value in scope.get('headers', []):
+        if name.lower() == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def scope_to_environ(scope, body=b''):
+    """
+    Build a WSGI environ out of an ASGI http scope, so that requests coming from an ASGI server can be wrapped
+    in the same request object and go through the same routing as the WSGI ones.
+
+    :param scope:
+    :param body:
+    :return:
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # like WSGI servers do (PEP 3333), the paths are the UTF-8 bytes decoded as latin-1
+        'SCRIPT_NAME': scope.get('root_path', '').encode('UTF-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('UTF-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = f'HTTP_{name}'
+        # repeated headers are folded into a single comma separated value, like WSGI servers do
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+    return environ
+
+
+async def run_in_threadpool(executor, func, *args, **kwargs):
+    """
+    Run a blocking callable in the given thread pool without blocking the event loop.
+    The context variables are copied, so the callable sees the same context as the coroutine awaiting it.
+
+    :param executor:
+    :param func:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def run_coroutine(coroutine):
+    """
+    Run a coroutine to completion in its own event loop, for the async handlers and hooks called from
+    the WSGI interface. asyncio is imported here, so that the WSGI apps that don't use it never load it.
+
+    :param coroutine:
+    :return:
+    """
+    import asyncio
+
+    return asyncio.run(coroutine)
+
+
+def run_wsgi(app, environ):
+    """
+    Call a WSGI app (e.g., WhiteNoise) and collect its status, headers and body.
+
+    :param app:
+    :param environ:
+    :return:
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    app_iter = app(environ, start_response)
+    try:
+        body = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    return started['status'], started['headers'], body
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
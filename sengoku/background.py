@@ -0,0 +1,186 @@
+"""
+Background tasks, run once the response is sent:
+    @app.route('/orders', allowed_methods=['post'])
+    def create_order(request, response):
+        order = save_order(request.json)
+        response.add_background(send_confirmation, order.email)
+        response.json = order.to_dict()
+The client gets the response without waiting for the email. The tasks of a response run one after the other,
+in the order they were added:
+    - through the WSGI interface, the iterable of the response is wrapped, and its close(), called by the server
+      once the body is sent, hands the tasks to the pool.
+    - through the ASGI interface, the tasks are scheduled on the event loop once the response is sent.
+      Async functions are awaited there, the others run in the pool.
+---
+The pool (API.background) is bounded: it runs max_workers tasks at a time, threads by default or processes
+with processes=True (the tasks and their arguments must then be picklable). At most max_pending responses have
+tasks waiting or running; past that, the request that adds more waits for a slot, so a burst slows down
+the requests instead of queueing an unbounded amount of work.
+The exceptions raised by a task go to the exception handler of the app (see add_exception_handler), with the
+request and the response that were already sent; without one, they are printed to stderr.
+The pool is drained when the app shuts down (see API.shutdown): the pending tasks are run before the process exits.
+"""
+import functools
+import inspect
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .asgi import run_coroutine
+
+
+def run_tasks(tasks):
+    """
+    Run the (func, args, kwargs) tasks of a response in order, an async func in its own event loop.
+    The first exception stops the tasks that follow.
+
+    :param tasks:
+    :return:
+    """
+    for func, args, kwargs in tasks:
+        if inspect.iscoroutinefunction(func):
+            run_coroutine(func(*args, **kwargs))
+        else:
+            func(*args, **kwargs)
+
+
+class AfterResponse:
+    def __init__(self, app_iter, callback):
+        """
+        The iterable of a response, whose close() calls callback once the iterable of the app is closed.
+
+        :param app_iter:
+        :param callback:
+        """
+        self._app_iter = app_iter
+        self._callback = callback
+
+    def __iter__(self):
+        return iter(self._app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self._app_iter, 'close'):
+                self._app_iter.close()
+        finally:
+            self._callback()
+
+
+class BackgroundPool:
+    def __init__(self, max_workers=4, max_pending=256, processes=False):
+        """
+        :param max_workers: how many tasks run at the same time
+        :param max_pending: how many responses can have tasks waiting or running, before adding more waits
+        :param processes: run the tasks in processes instead of threads
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.processes = processes
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        # the tasks scheduled on an event loop, see schedule_async
+        self._async_tasks = set()
+
+    @property
+    def executor(self):
+        # created on first use, so that a prefork server forks the workers before the pool has threads
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.processes:
+                        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                            thread_name_prefix='sengoku-background')
+        return self._executor
+
+    def submit(self, tasks, on_error):
+        """
+        Run the tasks in the pool, waiting for a slot when max_pending responses already have tasks in it.
+
+        :param tasks: a list of (func, args, kwargs)
+        :param on_error: called with the exception of a task that failed
+        :return: the Future of the tasks
+        """
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(run_tasks, tasks)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(functools.partial(self._done, on_error))
+        return future
+
+    def _done(self, on_error, future):
+        self._slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            on_error(future.exception())
+
+    def after_response(self, app_iter, tasks, on_error):
+        """
+        Wrap the iterable of a WSGI response so that the tasks are submitted when the server closes it.
+
+        :param app_iter:
+        :param tasks:
+        :param on_error:
+        :return:
+        """
+        return AfterResponse(app_iter, functools.partial(self.submit, tasks, on_error))
+
+    def schedule_async(self, tasks, on_error):
+        """
+        Run the tasks on the running event loop, see run_async. The task is kept until it is done,
+        so that drain_async can wait for it.
+
+        :param tasks:
+        :param on_error: an async callable, called with the exception of a task that failed
+        :return: the asyncio.Task
+        """
+        import asyncio
+
+        task = asyncio.get_running_loop().create_task(self.run_async(tasks, on_error))
+        self._async_tasks.add(task)
+        task.add_done_callback(self._async_tasks.discard)
+        return task
+
+    async def run_async(self, tasks, on_error):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if not self._slots.acquire(blocking=False):
+            # wait for a slot without blocking the event loop
+            await loop.run_in_executor(None, self._slots.acquire)
+        try:
+            for func, args, kwargs in tasks:
+                if inspect.iscoroutinefunction(func):
+                    await func(*args, **kwargs)
+                else:
+                    await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        except Exception as e:
+            await on_error(e)
+        finally:
+            self._slots.release()
+
+    async def drain_async(self):
+        """
+        Wait for the tasks scheduled on the running event loop.
+
+        :return:
+        """
+        import asyncio
+
+        while self._async_tasks:
+            await asyncio.gather(*self._async_tasks, return_exceptions=True)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the pool, after running the tasks that were submitted when wait is True.
+        A pool that is used again afterwards starts a new executor.
+
+        :param wait:
+        :return:
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
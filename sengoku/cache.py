@@ -0,0 +1,82 @@
+"""
+A small thread-safe LRU cache with an optional time to live, used to keep rendered templates
+(and other computed values) around between requests.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize=128, ttl=None, weigh=None):
+        """
+        Keep at most maxsize entries. When the cache is full, the least recently used entry is evicted.
+        If ttl (in seconds) is given, entries also expire ttl seconds after they were set.
+        If weigh is given, maxsize is the total weight of the entries instead of their number,
+        e.g. LRUCache(16 * 1024 * 1024, weigh=len) keeps up to 16 MiB of bytes.
+
+        :param maxsize:
+        :param ttl:
+        :param weigh:
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.size = 0
+        # key -> (value, expiration time or None, weight)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _missing)
+            if entry is _missing:
+                return default
+
+            value, expires_at, weight = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self.size -= weight
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        weight = self.weigh(value) if self.weigh is not None else 1
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self._entries[key] = (value, expires_at, weight)
+            self.size += weight
+            while self.size > self.maxsize and self._entries:
+                _, (_, _, evicted_weight) = self._entries.popitem(last=False)
+                self.size -= evicted_weight
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._entries)
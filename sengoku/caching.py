@@ -0,0 +1,350 @@
+"""
+HTTP response caching.
+A route opts in with @api.route('/books', cache=30) (cached for 30 seconds), or with a dict to also vary the cache
+on some request headers: @api.route('/books', cache={'ttl': 30, 'vary': ['Accept-Language'], 'query': False}).
+Then CacheMiddleware, once added with api.add_middleware(CacheMiddleware), stores the responses of these routes
+in a backend and answers the following requests from it, without calling the handler.
+---
+The Vary header of the response is honored: when it lists request headers that are not in the vary of the route
+(e.g. Accept-Encoding, set by a CompressionMiddleware that comes before the CacheMiddleware), the list is stored
+under the key of the route, and the response under a key that includes the values of these headers.
+A response with Vary: * is not cached, and neither is a response that sets a cookie or whose Cache-Control
+(set by the handler, and kept as it is) is private, no-store or no-cache.
+---
+Every cached response gets an ETag computed from its body and a Last-Modified date, so clients that send
+If-None-Match or If-Modified-Since get a 304 Not Modified without the body being sent again.
+---
+Two backends are available:
+    - MemoryBackend, an LRU cache in the process (the default).
+    - FileBackend, which stores the responses in a private directory, so all the gunicorn workers of a host
+      share them.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from .cache import LRUCache
+from .middleware import Middleware
+from .response import Response
+
+CACHEABLE_METHODS = ('GET', 'HEAD')
+# the Cache-Control directives of a response that keep it out of a shared cache
+UNCACHEABLE_DIRECTIVES = frozenset(('private', 'no-store', 'no-cache'))
+
+
+class CachePolicy:
+    def __init__(self, ttl, vary=(), query=True):
+        """
+        :param ttl: how long (in seconds) a response is cached
+        :param vary: the request headers whose values are part of the cache key
+        :param query: whether the query string is part of the cache key
+        """
+        self.ttl = ttl
+        self.vary = tuple(vary)
+        self.query = query
+
+    @classmethod
+    def from_option(cls, cache):
+        """
+        Build the policy from the cache option of a route: None, a TTL, a dict of arguments or a CachePolicy.
+
+        :param cache:
+        :return:
+        """
+        if cache is None or isinstance(cache, cls):
+            return cache
+        if isinstance(cache, dict):
+            return cls(**cache)
+        return cls(ttl=cache)
+
+    def key(self, request):
+        parts = [request.path]
+        if self.query:
+            parts.append('&'.join(sorted(request.query_string.split('&'))))
+        for header in self.vary:
+            parts.append(request.headers.get(header, ''))
+        return '\n'.join(parts)
+
+
+def variant_key(key, vary, request):
+    return '\n'.join([key, *(request.headers.get(header, '') for header in vary)])
+
+
+def response_vary(response):
+    """
+    The request headers listed in the Vary header of the response.
+
+    :param response:
+    :return:
+    """
+    vary = response.headers.get('Vary')
+    if not vary:
+        return []
+    return [header.strip() for header in vary.split(',') if header.strip()]
+
+
+class MemoryBackend:
+    def __init__(self, maxsize=1024):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, entry, ttl):
+        self._cache.set(key, entry, ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class FileBackend:
+    # a sweep runs every sweep_interval sets of the process
+    sweep_interval = 100
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        """
+        Store every entry in its own file of the directory: a line of JSON with the status and the headers,
+        followed by the body. The files are written to a temporary file first and renamed, so the workers never
+        read a partially written entry. The modification time of a file is the time it expires at.
+        ---
+        The directory must only be writable by the user of the app (it is created with mode 0o700),
+        since the entries it holds are sent to the clients as they are.
+        ---
+        The expired entries are removed by sweep(), along with the ones that expire first when the files take more
+        than max_size bytes.
+
+        :param directory:
+        :param max_size: the total size (in bytes) of the files, enforced by sweep()
+        """
+        self.directory = str(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        status = os.stat(self.directory)
+        if status.st_mode & 0o077 or (hasattr(os, 'getuid') and status.st_uid != os.getuid()):
+            raise ValueError(f'The cache directory {self.directory} must be private to the user of the app '
+                             f'(owned by it, with mode 0o700).')
+        self._sets = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                if os.fstat(file.fileno()).st_mtime <= time.time():
+                    expired = True
+                else:
+                    expired = False
+                    entry = json.loads(file.readline())
+                    if 'body' in entry:
+                        entry['body'] = file.read()
+        except (OSError, ValueError):
+            return None
+
+        if expired:
+            remove_file(path)
+            return None
+        return entry
+
+    def set(self, key, entry, ttl):
+        metadata = dict(entry)
+        body = metadata.pop('body', None)
+        if body is not None:
+            metadata['body'] = True
+
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                file.write(json.dumps(metadata).encode('UTF-8'))
+                file.write(b'\n')
+                if body is not None:
+                    file.write(body)
+            expires_at = time.time() + ttl
+            os.utime(temporary_path, (expires_at, expires_at))
+            os.replace(temporary_path, self._path(key))
+        except BaseException:
+            remove_file(temporary_path)
+            raise
+
+        self._sets += 1
+        if self._sets % self.sweep_interval == 0:
+            self.sweep()
+
+    def sweep(self):
+        """
+        Remove the expired entries, then the ones that expire first until the files take at most max_size bytes.
+
+        :return:
+        """
+        now = time.time()
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as directory:
+            for file in directory:
+                if file.name.startswith('.'):
+                    # an entry that is being written
+                    continue
+                try:
+                    status = file.stat()
+                except OSError:
+                    continue
+                if status.st_mtime <= now:
+                    remove_file(file.path)
+                else:
+                    entries.append((status.st_mtime, status.st_size, file.path))
+                    total_size += status.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            remove_file(path)
+            total_size -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            remove_file(os.path.join(self.directory, name))
+
+
+def is_shareable(response):
+    """
+    Whether the response can be sent to other clients: it sets no cookie and its Cache-Control does not
+    keep it private.
+
+    :param response:
+    :return:
+    """
+    if 'Set-Cookie' in response.headers:
+        return False
+    if response._webob is not None and 'Set-Cookie' in response._webob.headers:
+        return False
+    cache_control = response.headers.get('Cache-Control', '')
+    directives = {directive.split('=', 1)[0].strip().lower() for directive in cache_control.split(',')}
+    return not directives & UNCACHEABLE_DIRECTIVES
+
+
+def compute_etag(body):
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Check the conditional headers of the request. If-None-Match takes precedence over If-Modified-Since.
+
+    :param request:
+    :param etag:
+    :param last_modified: the timestamp of the last modification
+    :return:
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+class CacheMiddleware(Middleware):
+    def __init__(self, app, backend=None):
+        """
+        api.add_middleware(CacheMiddleware) caches in the process,
+        api.add_middleware(CacheMiddleware, backend=FileBackend('/var/cache/myapp')) shares the cache between
+        the workers.
+
+        :param app:
+        :param backend:
+        """
+        super().__init__(app)
+        self.backend = backend if backend is not None else MemoryBackend()
+
+    def _policy(self, request):
+        if request.method not in CACHEABLE_METHODS:
+            return None
+        route, _ = self.api.match(request)
+        if route is None:
+            return None
+        return route.get('cache')
+
+    def process_request(self, req):
+        policy = self._policy(req)
+        if policy is None:
+            return None
+
+        key = policy.key(req)
+        entry = self.backend.get(key)
+        if entry is not None and 'vary' in entry:
+            entry = self.backend.get(variant_key(key, entry['vary'], req))
+        if entry is None:
+            return None
+
+        req.environ['sengoku.cache_hit'] = True
+
+        response = Response()
+        response.headers.update(entry['headers'])
+        if is_not_modified(req, entry['etag'], entry['last_modified']):
+            response.status_code = 304
+            return response
+
+        response.status_code = entry['status_code']
+        response.content_type = entry['content_type']
+        response.body = entry['body']
+        return response
+
+    def process_response(self, req, res):
+        policy = self._policy(req)
+        if policy is None or req.environ.get('sengoku.cache_hit') or res.status_code != 200:
+            return
+
+        res.materialize()
+        if not isinstance(res.body, bytes):
+            # streamed bodies are never buffered to be cached
+            return
+
+        # the headers the response varies on, besides the ones of the route
+        lowered = {header.lower() for header in policy.vary}
+        vary = [header for header in response_vary(res) if header.lower() not in lowered]
+        if '*' in vary or not is_shareable(res):
+            return
+
+        last_modified = int(time.time())
+        etag = compute_etag(res.body)
+        res.headers['ETag'] = etag
+        res.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+        res.headers.setdefault('Cache-Control', f'max-age={int(policy.ttl)}')
+        if policy.vary or vary:
+            res.headers['Vary'] = ', '.join([*policy.vary, *vary])
+
+        key = policy.key(req)
+        if vary:
+            self.backend.set(key, {'vary': vary}, policy.ttl)
+            key = variant_key(key, vary, req)
+        self.backend.set(key, {
+            'status_code': res.status_code,
+            'content_type': res.content_type,
+            'headers': dict(res.headers),
+            'body': res.body,
+            'etag': etag,
+            'last_modified': last_modified,
+        }, policy.ttl)
+
+        if is_not_modified(req, etag, last_modified):
+            res.status_code = 304
+            res.body = b''
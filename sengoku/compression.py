@@ -0,0 +1,212 @@
+"""
+Response compression.
+CompressionMiddleware negotiates the Accept-Encoding of the request and compresses the dynamic responses:
+    - materialized bodies above min_size bytes are compressed at once, and the compressed variants of identical
+      bodies are kept in an LRU cache, so a body that is sent again is not compressed again.
+    - streamed bodies (generators, streamed templates, files) are compressed chunk by chunk as they are sent.
+Brotli is used when the brotli package is installed and the client accepts it, gzip otherwise.
+brotli is only imported once a client accepts it, see load_brotli.
+---
+The static files are served by WhiteNoise, which sends the precompressed .br/.gz variant of a file when it exists.
+compress_static generates these variants, see API.compress_static and `python -m sengoku compress-static`.
+"""
+import functools
+import hashlib
+import os
+import zlib
+
+from .cache import LRUCache
+from .middleware import Middleware
+from .response import FileIterator, NO_BODY_STATUS_CODES, close_body, is_file_like
+
+
+@functools.lru_cache(maxsize=None)
+def load_brotli():
+    """
+    The brotli module, imported on first use (API.precompile imports it ahead of time), None when it is not installed.
+
+    :return:
+    """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+COMPRESSIBLE_CONTENT_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+def accepted_encodings(accept_encoding):
+    """
+    Parse an Accept-Encoding header into the set of the encodings the client accepts (q > 0).
+
+    :param accept_encoding:
+    :return:
+    """
+    encodings = set()
+    for item in accept_encoding.split(','):
+        encoding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if encoding and quality > 0:
+            encodings.add(encoding.lower())
+    return encodings
+
+
+def negotiate_encoding(accept_encoding):
+    accepted = accepted_encodings(accept_encoding)
+    if ('br' in accepted or '*' in accepted) and load_brotli() is not None:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding, level):
+    if encoding == 'br':
+        return load_brotli().compress(body, quality=level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compress the chunks as they are pulled by the server. Every chunk is flushed, so the client gets
+    what was produced so far (e.g. the <head> of a streamed template) without waiting for the end.
+    Closing the generator closes the original body.
+
+    :param chunks:
+    :param encoding:
+    :param level:
+    :return:
+    """
+    if encoding == 'br':
+        compressor = load_brotli().Compressor(quality=level)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    try:
+        for chunk in chunks:
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close_body(chunks)
+
+
+async def compress_stream_async(chunks, encoding, level):
+    """
+    compress_stream for the async iterators (e.g. API.stream_template_async) sent through API.asgi.
+
+    :param chunks:
+    :param encoding:
+    :param level:
+    :return:
+    """
+    if encoding == 'br':
+        compressor = load_brotli().Compressor(quality=level)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    async for chunk in chunks:
+        data = process(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+class CompressionMiddleware(Middleware):
+    def __init__(self, app, min_size=500, level=6, cache_size=16 * 1024 * 1024):
+        """
+        api.add_middleware(CompressionMiddleware, min_size=1024)
+
+        :param app:
+        :param min_size: bodies smaller than min_size bytes are not worth compressing
+        :param level: the compression level, from 1 (fastest) to 9 (smallest), and up to 11 for brotli
+        :param cache_size: the total number of bytes of compressed bodies kept in memory
+        """
+        super().__init__(app)
+        self.min_size = min_size
+        self.level = level
+        # keyed by a digest of the body, so the uncompressed bodies are not kept alive
+        self.cache = LRUCache(cache_size, weigh=len)
+
+    def process_response(self, req, res):
+        if res.status_code in NO_BODY_STATUS_CODES or 'Content-Encoding' in res.headers:
+            return
+
+        res.materialize()
+        content_type = res.content_type or 'text/html'
+        if not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES):
+            return
+
+        vary = res.headers.get('Vary')
+        res.headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+
+        encoding = negotiate_encoding(req.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return
+
+        if isinstance(res.body, bytes):
+            if len(res.body) < self.min_size:
+                return
+            key = (encoding, hashlib.blake2b(res.body, digest_size=16).digest())
+            compressed = self.cache.get(key)
+            if compressed is None:
+                compressed = compress(res.body, encoding, self.level)
+                self.cache.set(key, compressed)
+            res.body = compressed
+        elif hasattr(res.body, '__aiter__'):
+            res.body = compress_stream_async(res.body, encoding, self.level)
+        else:
+            body = FileIterator(res.body) if is_file_like(res.body) else res.body
+            res.body = compress_stream(body, encoding, self.level)
+
+        res.headers['Content-Encoding'] = encoding
+        # the compressed representation is not byte for byte the one the ETag was computed from
+        etag = res.headers.get('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            res.headers['ETag'] = f'W/{etag}'
+
+
+def compress_static(static_dir, log=None):
+    """
+    Write a .gz (and a .br, when brotli is installed) variant next to every compressible file of static_dir,
+    for WhiteNoise to serve. The variants that would not be smaller than the file are skipped.
+
+    :param static_dir:
+    :param log:
+    :return: the paths of the generated files
+    """
+    from whitenoise.compress import Compressor
+
+    compressor = Compressor(quiet=log is None, log=log or print)
+    generated = []
+    for directory, _, file_names in os.walk(static_dir):
+        for file_name in file_names:
+            if compressor.should_compress(file_name):
+                generated.extend(compressor.compress(os.path.join(directory, file_name)))
+    return generated
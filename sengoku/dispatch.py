@@ -0,0 +1,130 @@
+"""
+Build, once per route, the table that maps every allowed HTTP method to the callable that handles it,
+so dispatching a request is a single dict lookup.
+For a class-based handler, the table holds the methods of the class (get() for GET, post() for POST...).
+By default, the class is instantiated for every request, like before. Stateless views can opt in to sharing
+a single instance ('singleton') or to reusing instances from a pool ('pool').
+---
+The annotated params of the handlers (see sengoku.params) are compiled here as well, every callable of the table
+converts its arguments before calling the handler.
+"""
+import inspect
+import queue
+
+from .params import bind_params
+
+HTTP_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'HEAD')
+
+INSTANCES_PER_REQUEST = 'request'
+INSTANCES_SINGLETON = 'singleton'
+INSTANCES_POOL = 'pool'
+
+
+class HandlerPool:
+    def __init__(self, handler_cls, size):
+        """
+        Keep up to size idle instances of the class-based handler. When they are all in use,
+        a new instance is created for the request and dropped afterwards if the pool is full.
+
+        :param handler_cls:
+        :param size:
+        """
+        self.handler_cls = handler_cls
+        self._instances = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._instances.get_nowait()
+        except queue.Empty:
+            return self.handler_cls()
+
+    def release(self, instance):
+        try:
+            self._instances.put_nowait(instance)
+        except queue.Full:
+            pass
+
+
+def _per_request(handler_cls, function):
+    if inspect.iscoroutinefunction(function):
+        async def call(request, response, **kwargs):
+            return await function(handler_cls(), request, response, **kwargs)
+    else:
+        def call(request, response, **kwargs):
+            return function(handler_cls(), request, response, **kwargs)
+    return call
+
+
+def _pooled(pool, function):
+    if inspect.iscoroutinefunction(function):
+        async def call(request, response, **kwargs):
+            instance = pool.acquire()
+            try:
+                return await function(instance, request, response, **kwargs)
+            finally:
+                pool.release(instance)
+    else:
+        def call(request, response, **kwargs):
+            instance = pool.acquire()
+            try:
+                return function(instance, request, response, **kwargs)
+            finally:
+                pool.release(instance)
+    return call
+
+
+def _options(allowed):
+    allow = ', '.join(sorted(allowed))
+
+    def options(request, response, **kwargs):
+        response.status_code = 204
+        response.headers['Allow'] = allow
+    return options
+
+
+def build_dispatch_table(handler, allowed_methods, instances=INSTANCES_PER_REQUEST, pool_size=8, path_fields=()):
+    """
+    Return the {METHOD: callable} table of the route. Every callable takes (request, response, **kwargs).
+    HEAD is answered by the GET callable when it is not handled explicitly (the body is not sent),
+    and OPTIONS answers with the Allow header when it is not handled explicitly.
+
+    :param handler:
+    :param allowed_methods:
+    :param instances:
+    :param pool_size:
+    :param path_fields: the names of the params of the route path
+    :return:
+    """
+    table = {}
+
+    if inspect.isclass(handler):
+        if instances == INSTANCES_SINGLETON:
+            singleton = handler()
+        elif instances == INSTANCES_POOL:
+            pool = HandlerPool(handler, pool_size)
+        elif instances != INSTANCES_PER_REQUEST:
+            raise ValueError(f'Unknown handler instances mode: {instances}')
+
+        for method in HTTP_METHODS:
+            function = getattr(handler, method.lower(), None)
+            if function is None:
+                continue
+            if instances == INSTANCES_SINGLETON:
+                call = getattr(singleton, method.lower())
+            elif instances == INSTANCES_POOL:
+                call = _pooled(pool, function)
+            else:
+                call = _per_request(handler, function)
+            # the signature of the method starts with self
+            table[method] = bind_params(call, function, path_fields, skip=3)
+    else:
+        call = bind_params(handler, handler, path_fields)
+        for method in allowed_methods:
+            table[method.upper()] = call
+
+    if 'GET' in table and 'HEAD' not in table:
+        table['HEAD'] = table['GET']
+    if 'OPTIONS' not in table:
+        table['OPTIONS'] = _options(set(table) | {'OPTIONS'})
+
+    return table
@@ -0,0 +1,54 @@
+"""
+Exceptions that are turned into an HTTP response, instead of going to the exception handler of the app.
+A handler (or the framework itself, e.g. for a body over the size limit) raises them to answer with an error:
+    raise HTTPError('The book is sold out.', status_code=409)
+"""
+from http import HTTPStatus
+
+
+class HTTPError(Exception):
+    status_code = 500
+
+    def __init__(self, detail=None, status_code=None, headers=None):
+        """
+        :param detail: the text of the response, the reason phrase of the status by default
+        :param status_code:
+        :param headers: more headers of the response
+        """
+        if status_code is not None:
+            self.status_code = status_code
+        self.detail = detail if detail is not None else HTTPStatus(self.status_code).phrase
+        self.headers = headers or {}
+        super().__init__(self.detail)
+
+    def apply(self, response):
+        """
+        Replace what the handler may have put in the response with the error.
+
+        :param response:
+        :return:
+        """
+        response.json = None
+        response.html = None
+        response.background = None
+        response.body = b''
+        response.content_type = None
+        response.text = self.detail
+        response.status_code = self.status_code
+        response.headers.update(self.headers)
+
+
+class BadRequest(HTTPError):
+    status_code = 400
+
+
+class RequestEntityTooLarge(HTTPError):
+    status_code = 413
+
+
+class UnprocessableEntity(HTTPError):
+    status_code = 422
+
+
+class ServiceUnavailable(HTTPError):
+    status_code = 503
@@ -0,0 +1,288 @@
+"""
+Opt-in request instrumentation, enabled with api.enable_instrumentation().
+Every request gets a RequestTimings in a context variable, and the hot paths record time.perf_counter_ns spans
+into it: routing (API.match), every middleware hook, the handler, API.template and the serialization of
+the response (Response.set_body_and_content_type). When instrumentation is disabled, each of these points costs
+a context variable lookup.
+---
+From the spans:
+    - every response gets a Server-Timing header, which the browser devtools display next to the request.
+    - the request durations are aggregated in a latency histogram per route, and the spans in a sum/count per route,
+      served in the Prometheus text format on metrics_path (/metrics by default).
+---
+With profile_every=N, one request out of N is run under cProfile, and the profiles are aggregated into
+self.profile_stats (a pstats.Stats), see profile_report and dump_profile. Only the WSGI interface is profiled,
+an ASGI request shares its thread with the other requests of the event loop.
+"""
+import bisect
+import io
+import itertools
+import threading
+from contextvars import ContextVar
+from time import perf_counter_ns
+
+# in seconds, the default buckets of the Prometheus clients
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+UNMATCHED_ROUTE = '<unmatched>'
+
+current_timings = ContextVar('sengoku_timings', default=None)
+
+
+class RequestTimings:
+    __slots__ = ('route', 'spans')
+
+    def __init__(self):
+        # the path of the matched route, set by API.match
+        self.route = None
+        # [(name, duration in ns), ...] in the order they ended
+        self.spans = []
+
+    def add(self, name, started_ns):
+        self.spans.append((name, perf_counter_ns() - started_ns))
+
+    def totals(self):
+        """
+        The duration of every span name, summed, e.g. two templates rendered by the same handler are one span.
+
+        :return: {name: duration in ns} in the order the spans first ended
+        """
+        totals = {}
+        for name, duration in self.spans:
+            totals[name] = totals.get(name, 0) + duration
+        return totals
+
+
+def instrument_hook(name, hook, is_async):
+    """
+    Wrap a middleware hook to record its span, see Middleware.compile.
+
+    :param name:
+    :param hook:
+    :param is_async:
+    :return:
+    """
+    if is_async:
+        async def timed_hook(*args):
+            timings = current_timings.get()
+            started = perf_counter_ns()
+            try:
+                return await hook(*args)
+            finally:
+                if timings is not None:
+                    timings.add(name, started)
+    else:
+        def timed_hook(*args):
+            timings = current_timings.get()
+            started = perf_counter_ns()
+            try:
+                return hook(*args)
+            finally:
+                if timings is not None:
+                    timings.add(name, started)
+
+    return timed_hook
+
+
+def server_timing_header(timings, total_ns):
+    metrics = [f'{name};dur={duration / 1e6:.3f}' for name, duration in timings.totals().items()]
+    metrics.append(f'total;dur={total_ns / 1e6:.3f}')
+    return ', '.join(metrics)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum_ns')
+
+    def __init__(self, bucket_count):
+        # the last one counts the durations above the largest bucket
+        self.counts = [0] * (bucket_count + 1)
+        self.count = 0
+        self.sum_ns = 0
+
+
+class Instrumentation:
+    def __init__(self, server_timing=True, profile_every=0, buckets=DEFAULT_BUCKETS):
+        """
+        :param server_timing: whether to send the Server-Timing header
+        :param profile_every: profile one request out of profile_every, 0 never profiles
+        :param buckets: the upper bounds (in seconds) of the latency histogram buckets
+        """
+        self.server_timing = server_timing
+        self.profile_every = profile_every
+        self.buckets = tuple(sorted(buckets))
+        self._bounds_ns = [int(bound * 1e9) for bound in self.buckets]
+        # route -> Histogram
+        self.histograms = {}
+        # (route, span name) -> [count, total duration in ns]
+        self.span_totals = {}
+        self.profile_stats = None
+        self._requests = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def wsgi(self, app, environ, start_response):
+        """
+        Call the WSGI app with a RequestTimings for the request, then record the timings.
+
+        :param app:
+        :param environ:
+        :param start_response:
+        :return:
+        """
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = perf_counter_ns()
+
+        if self.server_timing:
+            def start_response_with_timing(status, headers, exc_info=None):
+                header = server_timing_header(timings, perf_counter_ns() - started)
+                return start_response(status, [*headers, ('Server-Timing', header)], exc_info)
+        else:
+            start_response_with_timing = start_response
+
+        try:
+            if self.profile_every and next(self._requests) % self.profile_every == 0:
+                return self._profile(app, environ, start_response_with_timing)
+            return app(environ, start_response_with_timing)
+        finally:
+            current_timings.reset(token)
+            self.record(timings, perf_counter_ns() - started)
+
+    async def asgi(self, respond, send):
+        """
+        The ASGI counterpart of wsgi: await respond(send) with a RequestTimings for the request.
+
+        :param respond:
+        :param send:
+        :return:
+        """
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = perf_counter_ns()
+
+        if self.server_timing:
+            async def send_with_timing(message):
+                if message['type'] == 'http.response.start':
+                    header = server_timing_header(timings, perf_counter_ns() - started)
+                    message['headers'] = [*message['headers'], (b'server-timing', header.encode('latin-1'))]
+                await send(message)
+        else:
+            send_with_timing = send
+
+        try:
+            await respond(send_with_timing)
+        finally:
+            current_timings.reset(token)
+            self.record(timings, perf_counter_ns() - started)
+
+    def _profile(self, app, environ, start_response):
+        # only imported by the apps that profile
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active, e.g. the sampled request of another thread
+            return app(environ, start_response)
+
+        try:
+            return app(environ, start_response)
+        finally:
+            profiler.disable()
+            with self._lock:
+                if self.profile_stats is None:
+                    self.profile_stats = pstats.Stats(profiler)
+                else:
+                    self.profile_stats.add(profiler)
+
+    def record(self, timings, total_ns):
+        route = timings.route or UNMATCHED_ROUTE
+        bucket = bisect.bisect_left(self._bounds_ns, total_ns)
+        with self._lock:
+            histogram = self.histograms.get(route)
+            if histogram is None:
+                histogram = self.histograms[route] = Histogram(len(self.buckets))
+            histogram.counts[bucket] += 1
+            histogram.count += 1
+            histogram.sum_ns += total_ns
+
+            for name, duration in timings.spans:
+                totals = self.span_totals.get((route, name))
+                if totals is None:
+                    totals = self.span_totals[(route, name)] = [0, 0]
+                totals[0] += 1
+                totals[1] += duration
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.span_totals.clear()
+            self.profile_stats = None
+
+    def render_metrics(self):
+        """
+        The histograms and the span totals in the Prometheus text exposition format.
+
+        :return:
+        """
+        lines = [
+            '# HELP sengoku_request_duration_seconds The duration of the requests, per route.',
+            '# TYPE sengoku_request_duration_seconds histogram',
+        ]
+        with self._lock:
+            histograms = [(route, list(h.counts), h.count, h.sum_ns) for route, h in self.histograms.items()]
+            span_totals = [(route, name, count, total) for (route, name), (count, total) in self.span_totals.items()]
+
+        for route, counts, count, sum_ns in histograms:
+            route = _label(route)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'sengoku_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+            lines.append(f'sengoku_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {count}')
+            lines.append(f'sengoku_request_duration_seconds_sum{{route="{route}"}} {sum_ns / 1e9}')
+            lines.append(f'sengoku_request_duration_seconds_count{{route="{route}"}} {count}')
+
+        lines.append('# HELP sengoku_span_duration_seconds The time spent in each step of the requests, per route.')
+        lines.append('# TYPE sengoku_span_duration_seconds summary')
+        for route, name, count, total in span_totals:
+            labels = f'route="{_label(route)}",span="{_label(name)}"'
+            lines.append(f'sengoku_span_duration_seconds_sum{{{labels}}} {total / 1e9}')
+            lines.append(f'sengoku_span_duration_seconds_count{{{labels}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def metrics_handler(self, req, resp):
+        resp.body = self.render_metrics().encode()
+        resp.content_type = 'text/plain; version=0.0.4'
+
+    def profile_report(self, sort='cumulative', limit=30):
+        """
+        The aggregated profile of the sampled requests, as printed by pstats.
+
+        :param sort:
+        :param limit:
+        :return:
+        """
+        with self._lock:
+            if self.profile_stats is None:
+                return ''
+            stream = io.StringIO()
+            self.profile_stats.stream = stream
+            self.profile_stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def dump_profile(self, path):
+        """
+        Write the aggregated profile to path, to be loaded with pstats or a viewer such as snakeviz.
+
+        :param path:
+        :return:
+        """
+        with self._lock:
+            if self.profile_stats is not None:
+                self.profile_stats.dump_stats(path)
@@ -3,8 +3,25 @@ Middleware class that can modify an HTTP request and/or response and is designed
 to form a pipeline of behavioral changes during request processing.
 The middleware is not fully responsible for responding to a client. Instead, it changes the behavior
 in some way as part of the pipeline, leaving the actual response to come from something later in the pipeline.
+---
+The middlewares are still chained (each one wraps the previous app), but the entrypoint compiles the chain into
+flat lists of the process_request and process_response methods that each subclass actually overrides,
+and calls them in a single loop instead of going through N nested handle_request calls.
+A process_request may return a response: the rest of the pipeline and the handler are then skipped.
+An HTTPError raised by a process_request (e.g. RequestEntityTooLarge, when it reads a body over the limit
+of the route) becomes that response.
 """
-from webob import Request
+import inspect
+
+from .asgi import run_coroutine
+from .exceptions import HTTPError
+from .instrumentation import instrument_hook
+from .request import Request
+from .response import Response
+
+
+def _overrides(middleware, method_name):
+    return getattr(type(middleware), method_name) is not getattr(Middleware, method_name)
 
 
 class Middleware:
@@ -16,6 +33,7 @@ class Middleware:
         :param app:
         """
         self.app = app
+        self.compile()
 
     def __call__(self, environ, start_response):
         """
@@ -27,11 +45,131 @@ class Middleware:
         :return:
         """
         request = Request(environ)
-        response = self.app.handle_request(request)
-        return response(environ, start_response)
+        # routed before the middlewares run, so the body size limit of the route applies to them
+        self.api.match(request)
+        response = self.dispatch(request)
+        app_iter = response(environ, start_response)
+        if response.background is not None:
+            return self.api.run_background(app_iter, request, response)
+        return app_iter
+
+    def compile(self):
+        """
+        Flatten the chain of middlewares wrapped by this entrypoint, from the outermost (the last added) to the
+        innermost, and keep the (position, method, is_async) of every overridden process_request and
+        process_response. If a middleware overrides handle_request itself, the chain is called as it is.
+        When the instrumentation of the app is enabled, the hooks are wrapped to record their timing.
+
+        :return:
+        """
+        layers = []
+        app = self.app
+        while isinstance(app, Middleware):
+            layers.append(app)
+            app = app.app
+
+        self.api = app
+        self._layer_count = len(layers)
+        self._flat = not any(
+            _overrides(layer, 'handle_request') or _overrides(layer, 'handle_request_async') for layer in layers
+        )
+        self._request_hooks = [
+            (index, layer.process_request, inspect.iscoroutinefunction(layer.process_request))
+            for index, layer in enumerate(layers) if _overrides(layer, 'process_request')
+        ]
+        # responses go back up the chain, from the innermost middleware to the outermost one
+        self._response_hooks = [
+            (index, layer.process_response, inspect.iscoroutinefunction(layer.process_response))
+            for index, layer in reversed(list(enumerate(layers))) if _overrides(layer, 'process_response')
+        ]
+
+        if getattr(app, 'instrumentation', None) is not None:
+            self._request_hooks = [
+                (index, instrument_hook(f'{type(layers[index]).__name__}.process_request', hook, is_async), is_async)
+                for index, hook, is_async in self._request_hooks
+            ]
+            self._response_hooks = [
+                (index, instrument_hook(f'{type(layers[index]).__name__}.process_response', hook, is_async), is_async)
+                for index, hook, is_async in self._response_hooks
+            ]
+
+    def dispatch(self, request):
+        """
+        Run the compiled pipeline: the process_request hooks, the handler, then the process_response hooks.
+        When a process_request returns a response, only the middlewares that already processed the request
+        get to process that response.
+
+        :param request:
+        :return:
+        """
+        if not self._flat:
+            return self.app.handle_request(request)
+
+        response = None
+        depth = self._layer_count
+        for index, hook, is_async in self._request_hooks:
+            try:
+                response = run_coroutine(hook(request)) if is_async else hook(request)
+            except HTTPError as e:
+                response = self.error_response(e)
+            if response is not None:
+                depth = index
+                break
+
+        if response is None:
+            response = self.api.handle_request(request)
+
+        for index, hook, is_async in self._response_hooks:
+            if index <= depth:
+                if is_async:
+                    run_coroutine(hook(request, response))
+                else:
+                    hook(request, response)
+
+        return response
 
-    def add(self, middleware_cls):
-        self.app = middleware_cls(self.app)
+    async def handle_asgi_request(self, request):
+        """
+        The ASGI counterpart of __call__ and dispatch, called by API.asgi with the request built from
+        the ASGI scope. process_request and process_response may be defined with async def.
+
+        :param request:
+        :return:
+        """
+        if not self._flat:
+            return await self.app.handle_request_async(request)
+
+        response = None
+        depth = self._layer_count
+        for index, hook, is_async in self._request_hooks:
+            try:
+                response = await hook(request) if is_async else hook(request)
+            except HTTPError as e:
+                response = self.error_response(e)
+            if response is not None:
+                depth = index
+                break
+
+        if response is None:
+            response = await self.api.handle_request_async(request)
+
+        for index, hook, is_async in self._response_hooks:
+            if index <= depth:
+                if is_async:
+                    await hook(request, response)
+                else:
+                    hook(request, response)
+
+        return response
+
+    def error_response(self, error):
+        response = Response(self.api.json_serializer)
+        error.apply(response)
+        return response
+
+    def add(self, middleware_cls, **kwargs):
+        self.app = middleware_cls(self.app, **kwargs)
+        self.compile()
 
     def process_request(self, req):
         pass
@@ -42,14 +180,34 @@ class Middleware:
     def handle_request(self, request):
         """
         Call self.process_request to do something with the request. Then it delegates the response creation to the app
-        that it is wrapping. Finally, it calls the process_response to do something with the response object.
-        Then it simply returns the response upward.
+        that it is wrapping, unless process_request returned a response. Finally, it calls the process_response
+        to do something with the response object. Then it simply returns the response upward.
 
         :param request:
         :return:
         """
-        self.process_request(request)
-        response = self.app.handle_request(request)
+        response = self.process_request(request)
+        if response is None:
+            response = self.app.handle_request(request)
         self.process_response(request, response)
 
         return response
+
+    async def handle_request_async(self, request):
+        """
+        Same as handle_request, but process_request and process_response may be defined with async def,
+        in which case they are awaited.
+
+        :param request:
+        :return:
+        """
+        response = self.process_request(request)
+        if inspect.isawaitable(response):
+            response = await response
+        if response is None:
+            response = await self.app.handle_request_async(request)
+        result = self.process_response(request, response)
+        if inspect.isawaitable(result):
+            await result
+
+        return response
@@ -0,0 +1,225 @@
+"""
+An incremental multipart/form-data parser, for uploads that should not be held in memory.
+The body is read in chunks and the parts are yielded as soon as their headers arrived; the content of a part
+is then streamed chunk by chunk, e.g. straight to a file:
+    for part in request.iter_parts():
+        if part.filename is not None:
+            part.save(os.path.join(UPLOAD_DIR, secure_name(part.filename)))
+        else:
+            fields[part.name] = part.text()
+Whatever the size of the upload, at most a chunk and a boundary are kept in memory.
+---
+The parts must be consumed in order: moving to the next part skips what is left of the current one.
+request.POST is built with the same parser, the files are then spooled to UploadedFile objects.
+"""
+import tempfile
+
+from .exceptions import BadRequest
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADERS_SIZE = 16 * 1024
+# the uploaded files of request.POST above this size are written to a temporary file instead of kept in memory
+SPOOL_SIZE = 1024 * 1024
+
+
+class MultipartError(BadRequest):
+    pass
+
+
+def parse_options_header(value):
+    """
+    'form-data; name="file"; filename="a.txt"' -> ('form-data', {'name': 'file', 'filename': 'a.txt'})
+
+    :param value:
+    :return:
+    """
+    main, *params = value.split(';')
+    options = {}
+    for param in params:
+        key, _, option = param.strip().partition('=')
+        option = option.strip()
+        if len(option) >= 2 and option[0] == option[-1] == '"':
+            option = option[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+        options[key.strip().lower()] = option
+    return main.strip().lower(), options
+
+
+class Part:
+    def __init__(self, parser, headers):
+        """
+        :param parser:
+        :param headers: {lowercased name: value}
+        """
+        self._parser = parser
+        self.headers = headers
+        _, options = parse_options_header(headers.get('content-disposition', ''))
+        self.name = options.get('name')
+        # None for a regular field, the name of the file (may be empty) for a file field
+        self.filename = options.get('filename')
+        self.content_type = headers.get('content-type', 'text/plain' if self.filename is None else None)
+        self.size = 0
+        self._done = False
+
+    def __iter__(self):
+        """
+        Yield the content of the part in chunks, as it is read from the body.
+
+        :return:
+        """
+        while not self._done:
+            chunk, self._done = self._parser.read_part_chunk()
+            if chunk:
+                self.size += len(chunk)
+                yield chunk
+
+    def read(self):
+        return b''.join(self)
+
+    def text(self, encoding='UTF-8'):
+        return self.read().decode(encoding)
+
+    def save(self, destination):
+        """
+        Stream the content of the part to destination: a path, a binary file or a callable that gets every chunk.
+
+        :param destination:
+        :return: the number of bytes written
+        """
+        if callable(destination):
+            for chunk in self:
+                destination(chunk)
+        elif hasattr(destination, 'write'):
+            for chunk in self:
+                destination.write(chunk)
+        else:
+            with open(destination, 'wb') as file:
+                for chunk in self:
+                    file.write(chunk)
+        return self.size
+
+    def drain(self):
+        for _ in self:
+            pass
+
+
+class UploadedFile:
+    def __init__(self, part, spool_size=SPOOL_SIZE):
+        """
+        A file field of request.POST: the content of the part is copied to self.file,
+        a temporary file that stays in memory up to spool_size bytes.
+
+        :param part:
+        :param spool_size:
+        """
+        self.name = part.name
+        self.filename = part.filename
+        self.content_type = part.content_type
+        self.headers = part.headers
+        self.file = tempfile.SpooledTemporaryFile(spool_size)
+        self.size = part.save(self.file)
+        self.file.seek(0)
+
+    def __repr__(self):
+        return f'<UploadedFile {self.name}={self.filename!r} ({self.size} bytes)>'
+
+
+class MultipartParser:
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE, max_headers_size=MAX_HEADERS_SIZE):
+        """
+        :param stream: the body, an object with a read(size) method (e.g. request.body)
+        :param boundary: the boundary parameter of the Content-Type of the request
+        :param chunk_size: how much of the body is read at a time
+        :param max_headers_size: the headers of a part are rejected above that size
+        """
+        if not boundary:
+            raise MultipartError('The multipart boundary is missing.')
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._max_headers_size = max_headers_size
+        # every delimiter but the first one is preceded by a CRLF, which belongs to it and not to the content,
+        # so the first one gets a virtual CRLF to be found the same way
+        self._delimiter = b'\r\n--' + boundary.encode('latin-1')
+        self._buffer = bytearray(b'\r\n')
+        self._eof = False
+        self._current = None
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._stream.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer += chunk
+        return True
+
+    def __iter__(self):
+        # skip the preamble
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index >= 0:
+                del self._buffer[:index + len(self._delimiter)]
+                break
+            # keep what may be the beginning of the delimiter
+            del self._buffer[:max(0, len(self._buffer) - len(self._delimiter) + 1)]
+            if not self._fill():
+                raise MultipartError('The multipart body has no boundary.')
+
+        while True:
+            if self._current is not None:
+                self._current.drain()
+
+            # the delimiter is followed by -- for the last one, by CRLF otherwise
+            while len(self._buffer) < 2:
+                if not self._fill():
+                    raise MultipartError('The multipart body ended unexpectedly.')
+            if self._buffer[:2] == b'--':
+                return
+            if self._buffer[:2] != b'\r\n':
+                raise MultipartError('The multipart boundary is malformed.')
+            del self._buffer[:2]
+
+            self._current = Part(self, self._read_headers())
+            yield self._current
+
+    def _read_headers(self):
+        while True:
+            index = self._buffer.find(b'\r\n\r\n')
+            if index >= 0:
+                break
+            if len(self._buffer) > self._max_headers_size:
+                raise MultipartError('The headers of a multipart part are too large.')
+            if not self._fill():
+                raise MultipartError('The multipart body ended unexpectedly.')
+        if index > self._max_headers_size:
+            raise MultipartError('The headers of a multipart part are too large.')
+
+        headers = {}
+        for line in bytes(self._buffer[:index]).decode('UTF-8', 'replace').split('\r\n'):
+            name, separator, value = line.partition(':')
+            if separator:
+                headers[name.strip().lower()] = value.strip()
+        del self._buffer[:index + 4]
+        return headers
+
+    def read_part_chunk(self):
+        """
+        The next chunk of the content of the current part.
+
+        :return: (chunk, whether it is the last chunk of the part)
+        """
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index >= 0:
+                chunk = bytes(self._buffer[:index])
+                del self._buffer[:index + len(self._delimiter)]
+                return chunk, True
+
+            # everything but a possible beginning of the delimiter is content
+            safe = len(self._buffer) - len(self._delimiter) + 1
+            if safe >= self._chunk_size or (safe > 0 and self._eof):
+                chunk = bytes(self._buffer[:safe])
+                del self._buffer[:safe]
+                return chunk, False
+            if not self._fill():
+                raise MultipartError('The multipart body ended unexpectedly.')
@@ -0,0 +1,338 @@
+"""
+Typed handler parameters.
+The signature of a handler is inspected once, when its route is added, and compiled into a list of converters
+that run before it is called:
+    @app.route('/books/{book_id}')
+    def book(request, response, book_id: int, page: int = Query(1), token: str = Header(alias='X-Token')):
+        ...
+    - the path params are converted to their annotation (int, float, bool, uuid.UUID, decimal.Decimal...)
+    - Query(), Header() and Body() take the param from the query string, the headers or the JSON body.
+      The first argument is the default value, a param without a default is required.
+A list[...] annotation on a Query collects the repeated values, on a Header it splits the comma separated values.
+A X | None annotation accepts None.
+---
+Resource(pool) checks a resource out of a sengoku.pool.ResourcePool for the duration of the call of the handler:
+    def books(request, response, connection=Resource(db)):
+It is given back when the handler returns, so a streamed body must not use it.
+---
+An invalid or missing path, query or header param gets a 400 response, an invalid JSON body field a 422,
+without calling the handler. A handler without annotated params or markers is called as it is.
+An annotation that can't be resolved (e.g. a name that is not imported) raises a TypeError when the route is added.
+"""
+import abc
+import contextlib
+import inspect
+import types
+import typing
+from uuid import UUID
+
+from .exceptions import BadRequest, UnprocessableEntity
+
+REQUIRED = object()
+TRUE_VALUES = {'1', 'true', 'yes', 'on'}
+FALSE_VALUES = {'0', 'false', 'no', 'off'}
+# the annotations of the JSON body fields that are checked, and not converted
+JSON_TYPES = (str, int, float, bool, list, dict)
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        # e.g. a {flag:d} path field, already converted by the route pattern
+        if value in (0, 1):
+            return bool(value)
+        raise ValueError(f'{value!r} is not a boolean')
+    lowered = value.lower()
+    if lowered in TRUE_VALUES:
+        return True
+    if lowered in FALSE_VALUES:
+        return False
+    raise ValueError(f'{value!r} is not a boolean')
+
+
+def _optional(annotation):
+    """
+    X | None -> (X, True), X -> (X, False)
+
+    :param annotation:
+    :return:
+    """
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+        args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0], True
+    return annotation, False
+
+
+def make_converter(annotation):
+    """
+    The callable that converts a string (a path, query or header value) to the annotation, None when there is none.
+
+    :param annotation:
+    :return:
+    """
+    if annotation is inspect.Parameter.empty or annotation is str or annotation is typing.Any:
+        return None
+    if annotation is bool:
+        return to_bool
+    if annotation is UUID:
+        return lambda value: value if isinstance(value, UUID) else UUID(value)
+    if callable(annotation):
+        return annotation
+    raise TypeError(f'Unsupported parameter annotation: {annotation!r}')
+
+
+def make_json_converter(annotation):
+    """
+    The callable that checks (or converts) a field of a JSON body against the annotation.
+
+    :param annotation:
+    :return:
+    """
+    if annotation is inspect.Parameter.empty or annotation is typing.Any:
+        return None
+
+    origin = typing.get_origin(annotation) or annotation
+    if origin in JSON_TYPES:
+        def check(value):
+            if origin is float:
+                valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+            elif origin is bool:
+                valid = isinstance(value, bool)
+            else:
+                # bool is an int for isinstance, but not for JSON
+                valid = isinstance(value, origin) and not isinstance(value, bool)
+            if not valid:
+                raise TypeError(f'expected {origin.__name__}, got {type(value).__name__}')
+            return value
+        return check
+
+    if callable(annotation):
+        # e.g. a dataclass, built from a JSON object
+        return lambda value: annotation(**value) if isinstance(value, dict) else annotation(value)
+    raise TypeError(f'Unsupported parameter annotation: {annotation!r}')
+
+
+class Param(abc.ABC):
+    source = None
+    error = BadRequest
+
+    def __init__(self, default=REQUIRED, alias=None):
+        """
+        :param default: the value when the param is missing, it is required without it
+        :param alias: the name of the param in the request, the name of the argument by default
+        """
+        self.default = default
+        self.alias = alias
+
+    def compile(self, name, annotation):
+        """
+        Build the extractor of the param: a callable that takes the request and returns the value of the argument.
+
+        :param name:
+        :param annotation:
+        :return:
+        """
+        annotation, nullable = _optional(annotation)
+        key = self.key(name)
+        lookup = self.lookup(key, annotation)
+        convert = self.converter(annotation)
+        default = self.default
+        error = self.error
+        source = self.source
+
+        def extract(request):
+            value = lookup(request)
+            if value is None:
+                if default is not REQUIRED:
+                    return default
+                if nullable:
+                    return None
+                raise error(f'The {source} param {key} is required.')
+            if convert is None:
+                return value
+            try:
+                return convert(value)
+            except (TypeError, ValueError, AttributeError, ArithmeticError) as e:
+                raise error(f'The {source} param {key} is invalid: {e}') from None
+
+        return extract
+
+    def key(self, name):
+        return self.alias or name
+
+    @abc.abstractmethod
+    def lookup(self, key, annotation):
+        """
+        Build the lookup of the param: a callable that takes the request and returns the raw value, None when
+        the param is missing.
+
+        :param key: the name of the param in the request
+        :param annotation:
+        :return:
+        """
+
+    def converter(self, annotation):
+        if typing.get_origin(annotation) is list:
+            (item_annotation,) = typing.get_args(annotation) or (str,)
+            convert = make_converter(item_annotation)
+            if convert is None:
+                return None
+            return lambda values: [convert(value) for value in values]
+        return make_converter(annotation)
+
+
+class Query(Param):
+    source = 'query'
+
+    def lookup(self, key, annotation):
+        if typing.get_origin(annotation) is list or annotation is list:
+            return lambda request: request.GET.getall(key) or None
+        return lambda request: request.GET.get(key)
+
+
+class Header(Param):
+    source = 'header'
+
+    def key(self, name):
+        # user_agent -> User-Agent
+        return self.alias or name.replace('_', '-').title()
+
+    def lookup(self, key, annotation):
+        if typing.get_origin(annotation) is list or annotation is list:
+            def lookup(request):
+                value = request.headers.get(key)
+                if value is None:
+                    return None
+                return [item.strip() for item in value.split(',') if item.strip()]
+            return lookup
+        return lambda request: request.headers.get(key)
+
+
+class Body(Param):
+    source = 'body'
+    error = UnprocessableEntity
+
+    def __init__(self, default=REQUIRED, alias=None, embed=True):
+        """
+        :param default:
+        :param alias:
+        :param embed: whether the param is a field of the JSON body (the default) or the whole body
+        """
+        super().__init__(default, alias)
+        self.embed = embed
+
+    def lookup(self, key, annotation):
+        embed = self.embed
+
+        def lookup(request):
+            try:
+                body = request.json
+            except ValueError:
+                raise BadRequest('The request body is not valid JSON.') from None
+            if not embed:
+                return body
+            if not isinstance(body, dict):
+                raise UnprocessableEntity('The request body must be a JSON object.')
+            return body.get(key)
+        return lookup
+
+    def converter(self, annotation):
+        return make_json_converter(annotation)
+
+
+class Resource:
+    def __init__(self, pool):
+        """
+        :param pool: the sengoku.pool.ResourcePool the resource is checked out of
+        """
+        self.pool = pool
+
+
+async def acquire_async(pool):
+    import asyncio
+
+    # without blocking the event loop when the resources are all in use
+    resource = pool.try_acquire()
+    if resource is None:
+        resource = await asyncio.get_running_loop().run_in_executor(None, pool.acquire)
+    return resource
+
+
+def path_converters(parameters, path_fields):
+    converters = []
+    for parameter in parameters:
+        if parameter.name in path_fields and not isinstance(parameter.default, (Param, Resource)):
+            convert = make_converter(_optional(parameter.annotation)[0])
+            if convert is not None:
+                converters.append((parameter.name, convert))
+    return converters
+
+
+def _convert_path(converters, kwargs):
+    for name, convert in converters:
+        try:
+            kwargs[name] = convert(kwargs[name])
+        except (TypeError, ValueError, AttributeError, ArithmeticError) as e:
+            raise BadRequest(f'The path param {name} is invalid: {e}') from None
+
+
+def bind_params(call, function, path_fields, skip=2):
+    """
+    Compile the params of function into converters, and wrap call, which takes (request, response, **kwargs),
+    to give it the converted arguments. call is returned as it is when there is nothing to convert.
+
+    :param call: the callable of the dispatch table
+    :param function: the handler function (or method) whose signature is inspected
+    :param path_fields: the names of the params of the route path
+    :param skip: the number of leading arguments that are not params (request and response, and self)
+    :return:
+    """
+    try:
+        signature = inspect.signature(function, eval_str=True)
+    except NameError as e:
+        raise TypeError(f'The annotations of {function.__qualname__} cannot be resolved: {e}') from None
+    except (TypeError, ValueError):
+        return call
+
+    parameters = [
+        parameter for parameter in list(signature.parameters.values())[skip:]
+        if parameter.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY)
+    ]
+    converters = path_converters(parameters, path_fields)
+    extractors = [
+        (parameter.name, parameter.default.compile(parameter.name, parameter.annotation))
+        for parameter in parameters if isinstance(parameter.default, Param)
+    ]
+    resources = [
+        (parameter.name, parameter.default.pool) for parameter in parameters if isinstance(parameter.default, Resource)
+    ]
+    if not converters and not extractors and not resources:
+        return call
+
+    if inspect.iscoroutinefunction(call):
+        async def bound(request, response, **kwargs):
+            _convert_path(converters, kwargs)
+            for name, extract in extractors:
+                kwargs[name] = extract(request)
+            if not resources:
+                return await call(request, response, **kwargs)
+            with contextlib.ExitStack() as stack:
+                for name, pool in resources:
+                    kwargs[name] = await acquire_async(pool)
+                    stack.callback(pool.release, kwargs[name])
+                return await call(request, response, **kwargs)
+    else:
+        def bound(request, response, **kwargs):
+            _convert_path(converters, kwargs)
+            for name, extract in extractors:
+                kwargs[name] = extract(request)
+            if not resources:
+                return call(request, response, **kwargs)
+            with contextlib.ExitStack() as stack:
+                for name, pool in resources:
+                    kwargs[name] = stack.enter_context(pool.checkout())
+                return call(request, response, **kwargs)
+
+    return bound
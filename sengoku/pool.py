@@ -0,0 +1,229 @@
+"""
+A pool of reusable resources (database connections, HTTP sessions...), so that the requests check out
+a resource that is already open instead of opening one each time:
+    db = ResourcePool(lambda: sqlite3.connect(DB_PATH, check_same_thread=False), min_size=2, max_size=10,
+                      health_check=lambda connection: connection.execute('SELECT 1'),
+                      reset=lambda connection: connection.rollback())
+    app.on_startup(db.open)
+    app.on_shutdown(db.close)
+
+    @app.route('/books')
+    def books(request, response, connection=Resource(db)):
+        response.json = connection.execute('SELECT title FROM books').fetchall()
+A Resource param (see sengoku.params) checks a resource out for the duration of the handler call,
+and gives it back to the pool when the handler returns or raises.
+---
+The resources are created when needed up to max_size; open() creates min_size of them ahead of the first requests.
+When all max_size resources are in use, a checkout waits up to timeout seconds for one to be given back,
+then raises PoolTimeout, a 503 response when it happens in a handler.
+An idle resource goes through health_check before it is checked out again (only after check_after seconds
+of idleness, if given), and is replaced when the check fails or raises. reset is called when a resource is given
+back, a resource whose reset raises is closed instead of being reused.
+---
+The resources belong to the process that created them: in a process forked from it (e.g. a worker of a prefork
+server), the pool starts empty and creates its own, without touching the ones of the parent.
+"""
+import collections
+import contextlib
+import os
+import threading
+import time
+import weakref
+
+from .exceptions import ServiceUnavailable
+
+# the pools of the process, emptied in the child after a fork
+_pools = weakref.WeakSet()
+
+
+class PoolTimeout(ServiceUnavailable):
+    pass
+
+
+def close_resource(resource):
+    if hasattr(resource, 'close'):
+        resource.close()
+
+
+class ResourcePool:
+    def __init__(self, factory, min_size=0, max_size=10, timeout=30.0, health_check=None, check_after=0.0,
+                 reset=None, close=close_resource):
+        """
+        :param factory: the callable that creates a resource
+        :param min_size: how many resources open() creates upfront
+        :param max_size: how many resources can exist at the same time
+        :param timeout: how long (in seconds) a checkout waits for a resource when they are all in use
+        :param health_check: called with an idle resource before it is checked out, it is unhealthy
+            when it returns False or raises
+        :param check_after: only check the resources that were idle for at least that many seconds
+        :param reset: called with a resource when it is given back, e.g. to roll back a transaction
+        :param close: called with a resource that is dropped from the pool
+        """
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('The sizes of the pool must be 0 <= min_size <= max_size and max_size >= 1.')
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.check_after = check_after
+        self.reset = reset
+        self.close_resource = close
+        self._init_state()
+        _pools.add(self)
+
+    def _init_state(self):
+        self._condition = threading.Condition()
+        # (resource, when it was given back), the last one given back is checked out first
+        self._idle = collections.deque()
+        # the resources that exist: idle, in use or being created
+        self._size = 0
+        self._closed = False
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def open(self):
+        """
+        Create min_size resources, e.g. from an on_startup hook of the app.
+
+        :return:
+        """
+        self._closed = False
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            resource = self._create()
+            self.release(resource)
+
+    def _create(self):
+        try:
+            return self.factory()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def try_acquire(self):
+        """
+        Check out a resource without waiting: an idle one, or a new one when the pool is not full.
+
+        :return: the resource, None when they are all in use
+        """
+        return self.acquire(timeout=0)
+
+    def acquire(self, timeout=None):
+        """
+        Check out a resource, waiting up to timeout seconds (the timeout of the pool by default) for one.
+        It must be given back with release, see checkout.
+
+        :param timeout:
+        :return:
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if timeout == 0:
+                            return None
+                        raise PoolTimeout(f'No resource was available in the pool after {timeout} seconds.')
+                    self._condition.wait(remaining)
+                if not self._idle:
+                    self._size += 1
+                    idle = None
+                else:
+                    idle = self._idle.pop()
+
+            if idle is None:
+                return self._create()
+            resource, released_at = idle
+            if self._is_healthy(resource, released_at):
+                return resource
+            self._discard(resource)
+
+    def _is_healthy(self, resource, released_at):
+        if self.health_check is None or time.monotonic() - released_at < self.check_after:
+            return True
+        try:
+            return self.health_check(resource) is not False
+        except Exception:
+            return False
+
+    def release(self, resource, discard=False):
+        """
+        Give a resource back to the pool.
+
+        :param resource:
+        :param discard: close it instead, e.g. when it is known to be broken
+        :return:
+        """
+        if not discard and self.reset is not None:
+            try:
+                self.reset(resource)
+            except Exception:
+                discard = True
+        if discard or self._closed:
+            self._discard(resource)
+            return
+        with self._condition:
+            self._idle.append((resource, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, resource):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+        try:
+            self.close_resource(resource)
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def checkout(self, timeout=None):
+        """
+        with pool.checkout() as resource: ...
+
+        :param timeout:
+        :return:
+        """
+        resource = self.acquire(timeout)
+        try:
+            yield resource
+        finally:
+            self.release(resource)
+
+    def close(self):
+        """
+        Close the idle resources, and the ones in use once they are given back. The pool can be opened again.
+
+        :return:
+        """
+        with self._condition:
+            self._closed = True
+            idle = [resource for resource, _ in self._idle]
+            self._idle.clear()
+        for resource in idle:
+            self._discard(resource)
+
+    def _after_fork(self):
+        # the resources of the parent are left alone, the child creates its own
+        self._init_state()
+
+
+def _reset_pools_after_fork():
+    for pool in list(_pools):
+        pool._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
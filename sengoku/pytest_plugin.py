@@ -0,0 +1,40 @@
+"""
+Fixtures for the tests of a sengoku app, enabled in the conftest.py of the project:
+    pytest_plugins = ['sengoku.pytest_plugin']
+
+    @pytest.fixture(scope='session')
+    def sengoku_app():
+        from app import app
+        return app
+The app is imported, precompiled and frozen once per session, and every test gets its own client on it:
+    def test_books(sengoku_client):
+        assert sengoku_client.get('/books').status_code == 200
+---
+This is safe with parallel runs (e.g. pytest-xdist): a worker is a process with its own session, the frozen app
+cannot be changed by a test, and the cookies are kept by the client, which is not shared between tests.
+"""
+import pytest
+
+from .testing import AsyncTestClient, TestClient
+
+
+@pytest.fixture(scope='session')
+def sengoku_app():
+    raise pytest.UsageError('Override the sengoku_app fixture to return the app under test.')
+
+
+@pytest.fixture(scope='session')
+def compiled_sengoku_app(sengoku_app):
+    sengoku_app.precompile()
+    sengoku_app.freeze()
+    return sengoku_app
+
+
+@pytest.fixture
+def sengoku_client(compiled_sengoku_app):
+    return TestClient(compiled_sengoku_app)
+
+
+@pytest.fixture
+def sengoku_async_client(compiled_sengoku_app):
+    return AsyncTestClient(compiled_sengoku_app)
@@ -0,0 +1,224 @@
+"""
+A lightweight request class that wraps the WSGI environ and only parses the parts of it that a handler touches.
+Building it costs a single attribute assignment. The query string, the cookies, the headers, the form and the JSON
+bodies are decoded on first access and cached, so the following accesses are free.
+---
+Large bodies don't have to be buffered: request.body streams the raw body, and request.iter_parts() parses
+a multipart/form-data body as it is read, see sengoku.multipart. When the route has a max_body_size,
+reading past it raises RequestEntityTooLarge (413).
+"""
+import json
+from functools import cached_property
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import parse_qsl
+from wsgiref.util import request_uri
+
+from .exceptions import BadRequest, RequestEntityTooLarge
+from .multipart import CHUNK_SIZE, MultipartParser, UploadedFile, parse_options_header
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+MULTIPART_CONTENT_TYPE = 'multipart/form-data'
+
+
+class BodyReader:
+    """
+    A file-like reader over wsgi.input that never reads past the Content-Length of the request,
+    so the body can be consumed piece by piece instead of being buffered in memory.
+    Iterating over it yields the body in chunks of chunk_size bytes.
+    When limit is given, reading more than limit bytes raises RequestEntityTooLarge, for the bodies
+    without a Content-Length (chunked) that could not be rejected upfront. No more than limit + 1 bytes
+    are ever read from wsgi.input, and read() without a size reads a chunked body in pieces of chunk_size bytes.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream, length, limit=None):
+        self._stream = stream
+        self._remaining = length
+        self._limit = limit
+        self._read = 0
+
+    def read(self, size=-1):
+        if self._remaining is not None:
+            if size < 0 or size > self._remaining:
+                size = self._remaining
+            if size == 0:
+                return b''
+        elif size < 0:
+            return b''.join(iter(self))
+
+        if self._limit is not None:
+            # one byte past the limit is enough to know that the body is too large
+            size = min(size, self._limit + 1 - self._read)
+        data = self._stream.read(size)
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        if self._limit is not None:
+            self._read += len(data)
+            if self._read > self._limit:
+                raise RequestEntityTooLarge(f'The request body is larger than {self._limit} bytes.')
+
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class Request:
+    # the body size limit of the route, set by API.match before the middlewares see the request
+    max_body_size = None
+
+    def __init__(self, environ):
+        self.environ = environ
+        # (route data, params) once the request has been routed, see API.match
+        self.route_match = None
+
+    @property
+    def method(self):
+        return self.environ['REQUEST_METHOD']
+
+    @property
+    def path_info(self):
+        # WSGI servers decode the raw path as latin-1, get the actual UTF-8 string back
+        return self.environ.get('PATH_INFO', '').encode('latin-1').decode('UTF-8', 'replace')
+
+    @property
+    def path(self):
+        return self.environ.get('SCRIPT_NAME', '') + self.path_info
+
+    @property
+    def query_string(self):
+        return self.environ.get('QUERY_STRING', '')
+
+    @property
+    def scheme(self):
+        return self.environ['wsgi.url_scheme']
+
+    @property
+    def host(self):
+        host = self.environ.get('HTTP_HOST')
+        if host is None:
+            host = f'{self.environ["SERVER_NAME"]}:{self.environ["SERVER_PORT"]}'
+        return host
+
+    @property
+    def url(self):
+        return request_uri(self.environ, include_query=True)
+
+    @property
+    def content_type(self):
+        return self.environ.get('CONTENT_TYPE', '').split(';', 1)[0].strip().lower()
+
+    @property
+    def content_length(self):
+        try:
+            return int(self.environ['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return None
+
+    @cached_property
+    def headers(self):
+        """
+        A case-insensitive view over the HTTP_* keys of the environ, nothing is copied.
+
+        :return:
+        """
+        from webob.headers import EnvironHeaders
+
+        return EnvironHeaders(self.environ)
+
+    @cached_property
+    def GET(self):
+        from webob.multidict import MultiDict
+
+        return MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+
+    @cached_property
+    def POST(self):
+        """
+        The decoded form body. Multipart forms are parsed as they are read (see iter_parts), their files are
+        UploadedFile objects. Both go through request.body, so the max_body_size of the route applies.
+
+        :return:
+        """
+        from webob.multidict import MultiDict
+
+        if self.method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            return MultiDict()
+
+        if self.content_type == FORM_CONTENT_TYPE:
+            return MultiDict(parse_qsl(self.data.decode('UTF-8'), keep_blank_values=True))
+
+        if self.content_type == MULTIPART_CONTENT_TYPE:
+            form = MultiDict()
+            for part in self.iter_parts():
+                if part.filename is None:
+                    form.add(part.name, part.text())
+                else:
+                    form.add(part.name, UploadedFile(part))
+            return form
+
+        return MultiDict()
+
+    @cached_property
+    def params(self):
+        from webob.multidict import NestedMultiDict
+
+        return NestedMultiDict(self.GET, self.POST)
+
+    @cached_property
+    def cookies(self):
+        cookie = SimpleCookie()
+        try:
+            cookie.load(self.environ.get('HTTP_COOKIE', ''))
+        except CookieError:
+            return {}
+        return {name: morsel.value for name, morsel in cookie.items()}
+
+    @cached_property
+    def body(self):
+        """
+        A streaming reader over the request body. Read it in pieces (request.body.read(size)) or iterate
+        over it to get the body in chunks. Note that request.data, request.json and request.POST consume it.
+
+        :return:
+        """
+        length = self.content_length
+        if length is None and not self.environ.get('wsgi.input_terminated'):
+            # without a Content-Length, reading wsgi.input could block forever
+            length = 0
+        return BodyReader(self.environ['wsgi.input'], length, self.max_body_size)
+
+    def iter_parts(self, chunk_size=CHUNK_SIZE):
+        """
+        Parse the multipart/form-data body as it is read, and yield its parts (see sengoku.multipart.Part)
+        as they arrive. The content of a part is streamed: iterate over it, or save() it to a file.
+        It consumes request.body, like request.POST does.
+
+        :param chunk_size:
+        :return:
+        """
+        content_type, options = parse_options_header(self.environ.get('CONTENT_TYPE', ''))
+        if content_type != MULTIPART_CONTENT_TYPE:
+            raise BadRequest('The request body is not multipart/form-data.')
+        return iter(MultipartParser(self.body, options.get('boundary'), chunk_size))
+
+    @cached_property
+    def data(self):
+        """
+        The whole body as bytes, read once from the streaming reader.
+
+        :return:
+        """
+        return self.body.read()
+
+    @cached_property
+    def text(self):
+        return self.data.decode('UTF-8')
+
+    @cached_property
+    def json(self):
+        return json.loads(self.data)
@@ -1,39 +1,426 @@
 """
 A custom class that wraps around the WebOb.Response class and add custom properties to it.
+---
+By default, the response does not build a WebOb.Response at all: the status line and the headers are written
+straight to start_response and the body is returned as a single-element list. The WebOb.Response is only created
+(and used to answer the request) once a WebOb-specific feature is needed, through Response.webob.
+---
+The body does not have to be materialized: it can also be an iterator, a generator or a file-like object,
+which are handed to the WSGI server as they are, so the server pulls the chunks as it sends them.
 """
+import functools
+import io
 import json
+import os
+from collections.abc import Iterator, MutableMapping
+from http import HTTPStatus
+from time import perf_counter_ns
 
-from webob import Response as WebObResponse
+from .asgi import encode_headers, run_in_threadpool as run_in_executor
+from .instrumentation import current_timings
+
+
+# '200' -> '200 OK', '404' -> '404 Not Found'...
+STATUS_LINES = {status.value: f'{status.value} {status.phrase}' for status in HTTPStatus}
+
+DEFAULT_CONTENT_TYPE = 'text/html'
+
+# the same charset rule as WebOb: text/* and xml content types get an explicit charset
+CONTENT_TYPE_HEADERS = {
+    None: 'text/html; charset=UTF-8',
+    'text/html': 'text/html; charset=UTF-8',
+    'text/plain': 'text/plain; charset=UTF-8',
+    'application/json': 'application/json',
+}
+
+
+def content_type_header(content_type):
+    header = CONTENT_TYPE_HEADERS.get(content_type)
+    if header is not None:
+        return header
+
+    header = content_type
+    if 'charset=' not in content_type and (content_type.startswith('text/') or content_type.endswith('xml')):
+        header = f'{content_type}; charset=UTF-8'
+    CONTENT_TYPE_HEADERS[content_type] = header
+
+    return header
+
+
+def dumps_json(obj):
+    return json.dumps(obj).encode('UTF-8')
+
+
+# resolved on the first call of default_json_serializer
+_json_serializer = None
+
+
+def load_json_serializer():
+    """
+    orjson when it is installed, it serializes straight to bytes without the intermediate str of json.dumps,
+    dumps_json otherwise. orjson is imported on first use (or ahead of time by API.precompile).
+    orjson is stricter than the stdlib json: the non-str dict keys are allowed with OPT_NON_STR_KEYS,
+    and what it still rejects (e.g. the integers above 64 bits) is serialized by dumps_json instead.
+
+    :return:
+    """
+    global _json_serializer
+    if _json_serializer is None:
+        try:
+            import orjson
+        except ImportError:
+            _json_serializer = dumps_json
+        else:
+            def dumps_orjson(obj):
+                try:
+                    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+                except TypeError:
+                    return dumps_json(obj)
+
+            _json_serializer = dumps_orjson
+    return _json_serializer
+
+
+def default_json_serializer(obj):
+    return (_json_serializer or load_json_serializer())(obj)
+
+
+JSON_CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_array(items, json_serializer, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Serialize the items one by one into a JSON array, yielding it in chunks of at least chunk_size bytes,
+    so the whole list is never held in memory.
+
+    :param items:
+    :param json_serializer:
+    :param chunk_size:
+    :return:
+    """
+    buffer = bytearray(b'[')
+    separator = b''
+    for item in items:
+        buffer += separator
+        buffer += json_serializer(item)
+        separator = b','
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b']'
+    yield bytes(buffer)
+
+
+FILE_BLOCK_SIZE = 64 * 1024
+
+NO_BODY_STATUS_CODES = (204, 304)
+
+
+class FileIterator:
+    """
+    Iterate over a file-like object in blocks, for servers that do not provide wsgi.file_wrapper.
+    The server calls close() once the response is sent, which closes the file.
+    """
+
+    def __init__(self, file, block_size=FILE_BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        while True:
+            block = self.file.read(self.block_size)
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        self.file.close()
+
+
+def is_file_like(body):
+    return hasattr(body, 'read')
+
+
+def file_length(file):
+    """
+    The number of bytes left to read in the file, or None when it can't be known (e.g. a pipe or a socket).
+
+    :param file:
+    :return:
+    """
+    try:
+        return os.fstat(file.fileno()).st_size - file.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def close_body(body):
+    if hasattr(body, 'close'):
+        body.close()
+
+
+class Headers(MutableMapping):
+    """
+    The headers of a response: a dict whose keys are case-insensitive, that keeps the names as they were set,
+    so response.headers['content-type'] replaces the Content-Type and 'Vary' in response.headers finds a 'vary'.
+    """
+
+    def __init__(self, headers=None):
+        # lowercased name -> (name, value)
+        self._headers = {}
+        if headers:
+            self.update(headers)
+
+    def __getitem__(self, name):
+        return self._headers[name.lower()][1]
+
+    def __setitem__(self, name, value):
+        self._headers[name.lower()] = (name, value)
+
+    def __delitem__(self, name):
+        del self._headers[name.lower()]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self._headers
+
+    def __iter__(self):
+        return (name for name, _ in self._headers.values())
+
+    def __len__(self):
+        return len(self._headers)
+
+    def get(self, name, default=None):
+        header = self._headers.get(name.lower())
+        return default if header is None else header[1]
+
+    def items(self):
+        return list(self._headers.values())
+
+    def __repr__(self):
+        return f'Headers({self.items()!r})'
+
+
+def status_line(status_code):
+    line = STATUS_LINES.get(status_code)
+    if line is None:
+        line = f'{status_code} Unknown Status'
+    return line
 
 
 class Response:
-    def __init__(self):
+    def __init__(self, json_serializer=None):
+        """
+        Custom headers can be added through self.headers, e.g. response.headers['Cache-Control'] = 'no-cache'
+        Its names are case-insensitive, and a Content-Type or a Content-Length set there replaces the computed one.
+        ---
+        self.body is either bytes, an iterable of bytes chunks (e.g. a generator) or a file-like object.
+        Files are sent through wsgi.file_wrapper when the server provides it, so it can use sendfile.
+        ---
+        json_serializer turns response.json into bytes, it defaults to orjson when it is installed,
+        and to the stdlib json otherwise. If response.json is an iterator (e.g. a generator of rows),
+        it is streamed to the client as a JSON array, one chunk at a time.
+        """
+        self.json_serializer = json_serializer or default_json_serializer
         self.json = None
         self.html = None
         self.text = None
         self.content_type = None
         self.body = b''
         self.status_code = 200
+        self.headers = Headers()
+        # the (func, args, kwargs) to run once the response is sent, see add_background
+        self.background = None
+        self._webob = None
+
+    def add_background(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) once the response is sent, see sengoku.background.
+
+        :param func: a function or an async function
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if self.background is None:
+            self.background = []
+        self.background.append((func, args, kwargs))
+
+    @property
+    def webob(self):
+        """
+        The WebOb.Response to use for WebOb-specific features, e.g. response.webob.set_cookie('name', 'value').
+        Once it is accessed, the response is sent through WebOb instead of the lean path.
+
+        :return:
+        """
+        if self._webob is None:
+            from webob import Response as WebObResponse
+
+            self._webob = WebObResponse()
+        return self._webob
 
     def __call__(self, environ, start_response):
+        if self._webob is not None:
+            return self.to_webob()(environ, start_response)
+
+        status, headers = self.status_and_headers()
+        start_response(status, headers)
+
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            close_body(self.body)
+            return []
+        if isinstance(self.body, bytes):
+            return [self.body]
+        if is_file_like(self.body):
+            file_wrapper = environ.get('wsgi.file_wrapper', FileIterator)
+            return file_wrapper(self.body, FILE_BLOCK_SIZE)
+        return self.body
+
+    async def asgi(self, send, run_in_threadpool=None):
+        """
+        Send the response through the ASGI send awaitable: a http.response.start event with the status
+        and the headers, followed by a http.response.body event.
+        The chunks of a sync iterable body (a generator, the blocks of a file) are pulled in the thread pool,
+        so producing them does not block the other requests of the event loop. Async iterables are iterated
+        on the event loop.
+
+        :param send:
+        :param run_in_threadpool: an async callable(func, *args), the default executor of the loop by default
+        :return:
+        """
+        if run_in_threadpool is None:
+            run_in_threadpool = functools.partial(run_in_executor, None)
+
+        if self._webob is not None:
+            response = self.to_webob()
+            status_code, headers, body = response.status_code, response.headerlist, response.app_iter
+        else:
+            _, headers = self.status_and_headers()
+            status_code, body = self.status_code, self.body
+
+        await send({
+            'type': 'http.response.start',
+            'status': status_code,
+            'headers': encode_headers(headers),
+        })
+
+        if isinstance(body, bytes):
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        if is_file_like(body):
+            body = FileIterator(body)
+
+        if hasattr(body, '__aiter__'):
+            try:
+                async for chunk in body:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                close_body(body)
+        elif isinstance(body, (list, tuple)):
+            for chunk in body:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        else:
+            try:
+                chunks = iter(body)
+                while True:
+                    chunk = await run_in_threadpool(next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                await run_in_threadpool(close_body, body)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def status_and_headers(self):
+        """
+        Build the status line and the header list for start_response from the precomputed tables.
+
+        :return:
+        """
+        self.set_body_and_content_type()
+
+        if isinstance(self.body, str):
+            self.body = self.body.encode('UTF-8')
+
+        if not self.headers:
+            headers = [('Content-Type', content_type_header(self.content_type))]
+        elif 'Content-Type' not in self.headers:
+            headers = [('Content-Type', content_type_header(self.content_type)), *self.headers.items()]
+        else:
+            headers = self.headers.items()
+        # an iterable body is sent as it is produced, so its length is unknown
+        length = self.content_length()
+        if length is not None and 'Content-Length' not in self.headers:
+            headers.append(('Content-Length', str(length)))
+
+        return status_line(self.status_code), headers
+
+    def content_length(self):
+        if self.status_code in NO_BODY_STATUS_CODES:
+            return None
+        if isinstance(self.body, bytes):
+            return len(self.body)
+        if is_file_like(self.body):
+            return file_length(self.body)
+        return None
+
+    def to_webob(self):
         self.set_body_and_content_type()
 
-        response = WebObResponse(
-            body=self.body,
-            content_type=self.content_type,
-            status=self.status_code
-        )
+        if self._webob is None:
+            from webob import Response as WebObResponse
+
+            response = WebObResponse(content_type=self.content_type, status=self.status_code)
+        else:
+            response = self._webob
+            response.status = self.status_code
+            response.content_type = self.content_type or DEFAULT_CONTENT_TYPE
+
+        if isinstance(self.body, str):
+            response.text = self.body
+        elif isinstance(self.body, bytes):
+            response.body = self.body
+        elif is_file_like(self.body):
+            response.app_iter = FileIterator(self.body)
+            response.content_length = file_length(self.body)
+        else:
+            response.app_iter = self.body
 
-        return response(environ, start_response)
+        for name, value in self.headers.items():
+            response.headers[name] = value
 
+        return response
+
+    def materialize(self):
+        """
+        Serialize json, html or text into the body once, for the middlewares that need the actual body
+        (e.g. to hash or compress it). They are cleared, so the body is not serialized again when it is sent.
+
+        :return:
+        """
+        self.set_body_and_content_type()
+        self.json = self.html = self.text = None
+        if isinstance(self.body, str):
+            self.body = self.body.encode('UTF-8')
 
     def set_body_and_content_type(self):
+        timings = current_timings.get()
+        started = perf_counter_ns() if timings is not None else 0
+
         if self.json is not None:
-            self.body = json.dumps(self.json).encode('UTF-8')
+            if isinstance(self.json, Iterator):
+                self.body = iter_json_array(self.json, self.json_serializer)
+            else:
+                self.body = self.json_serializer(self.json)
             self.content_type = 'application/json'
         if self.html is not None:
-            self.body = self.html.encode()
+            # a streamed template (see API.stream_template) is already an iterable of bytes
+            self.body = self.html.encode() if isinstance(self.html, str) else self.html
             self.content_type = 'text/html'
         if self.text is not None:
-            self.body = self.text
-            self.content_type = 'text/plain'
\ No newline at end of file
+            self.body = self.text.encode()
+            self.content_type = 'text/plain'
+
+        if timings is not None:
+            timings.add('serialize', started)
@@ -0,0 +1,125 @@
+"""
+A prefix (radix) tree router that compiles every route once, when it is added, instead of re-parsing all the
+route patterns for every incoming request.
+Each route is split on '/' into segments. Plain segments (e.g. 'sub') become static children of a node and are
+looked up with a single dict access. They are keyed in lowercase and matched case-insensitively, like parse()
+matches the literal parts of a pattern, so /HOME still reaches the /home route. Segments that contain a field (e.g. '{num_1:d}' or '{name}.json') are compiled
+once with parse.compile, so they keep the exact same converters that parse() offers.
+parse is only imported once a route has a field.
+"""
+
+
+def split_path(path):
+    """
+    Split a path into its segments, '/home/about' -> ['home', 'about'], '/' -> [''].
+
+    :param path:
+    :return:
+    """
+    if path.startswith('/'):
+        path = path[1:]
+    return path.split('/')
+
+
+def path_fields(path):
+    """
+    The names of the fields of a route path, '/sub/{num_1:d}/{num_2:d}' -> {'num_1', 'num_2'}.
+
+    :param path:
+    :return:
+    """
+    if '{' not in path:
+        return frozenset()
+    from parse import compile as compile_pattern
+
+    return frozenset(compile_pattern(path).named_fields)
+
+
+def _is_bare_field(segment):
+    return segment.startswith('{') and segment.endswith('}') and segment.count('{') == 1 and ':' not in segment
+
+
+class _Node:
+    __slots__ = ('static', 'dynamic', 'route')
+
+    def __init__(self):
+        self.static = {}
+        # list of (segment pattern, compiled parser, child node), typed fields are kept ahead of plain ones
+        self.dynamic = []
+        self.route = None
+
+
+class Router:
+    def __init__(self):
+        """
+        The tree starts with an empty root node. The lookup cost depends only on the depth of the requested path
+        (and on the few dynamic siblings at each level), not on the number of registered routes.
+        """
+        self._root = _Node()
+
+    def add(self, path, route):
+        """
+        Walk the tree segment by segment, creating the missing nodes, and store the route data on the last one.
+
+        :param path:
+        :param route:
+        :return:
+        """
+        node = self._root
+
+        for segment in split_path(path):
+            if '{' not in segment:
+                node = node.static.setdefault(segment.lower(), _Node())
+                continue
+
+            for pattern, _, child in node.dynamic:
+                if pattern == segment:
+                    node = child
+                    break
+            else:
+                child = _Node()
+                from parse import compile as compile_pattern
+
+                node.dynamic.append((segment, compile_pattern(segment), child))
+                # a bare field such as '{name}' matches any segment, so it must be tried last
+                node.dynamic.sort(key=lambda entry: _is_bare_field(entry[0]))
+                node = child
+
+        node.route = route
+
+    def match(self, request_path):
+        """
+        Find the route for the request path. Static segments are matched first, then the typed and finally
+        the plain parameter segments.
+
+        :param request_path:
+        :return: the route data and the named params as a dictionary, or (None, None) if nothing matches
+        """
+        kwargs = {}
+        route = self._match(self._root, split_path(request_path), 0, kwargs)
+        if route is None:
+            return None, None
+        return route, kwargs
+
+    def _match(self, node, segments, index, kwargs):
+        if index == len(segments):
+            return node.route
+
+        segment = segments[index]
+
+        child = node.static.get(segment.lower())
+        if child is not None:
+            route = self._match(child, segments, index + 1, kwargs)
+            if route is not None:
+                return route
+
+        for _, parser, child in node.dynamic:
+            parse_result = parser.parse(segment)
+            if parse_result is None:
+                continue
+            route = self._match(child, segments, index + 1, kwargs)
+            if route is not None:
+                kwargs.update(parse_result.named)
+                return route
+
+        return None
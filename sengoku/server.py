@@ -0,0 +1,436 @@
+"""
+A preforking server, to run an app on every core of a host without a separate WSGI server:
+    sengoku serve app:app --bind 0.0.0.0:8000 --workers 4 --max-requests 10000
+The master process imports the app and precompiles it (see API.precompile) before forking the workers,
+so the code, the routes and the compiled templates are shared copy-on-write. Then it opens the listening socket
+and forks one worker per core. The workers all accept connections from this shared socket and serve them with
+wsgiref, one at a time. Every worker runs the startup hooks of the app (see API.startup) after the fork,
+so each one opens its own connections.
+---
+The master watches the workers and replaces the ones that exit. A worker exits after max_requests requests
+(plus a random jitter, so they don't all restart together), which caps the memory that a slow leak can take.
+A worker that fails to boot (e.g. a startup hook that can't reach the database) exits with WORKER_BOOT_ERROR:
+it is replaced after a delay that doubles with every failure in a row, and after max_boot_failures of them
+the master stops (with the same exit code) instead of forking failing workers forever, like gunicorn.
+---
+With threads=N, every worker hands the connections it accepts to a pool of N threads, for the I/O-bound handlers.
+The connections wait for a thread in a queue of queue_size connections. When that queue is full, the worker sheds
+the load: the connection gets a 503 right away, instead of a response that comes too late anyway.
+The app is frozen (see API.freeze) before the workers are forked, so the threads share it safely.
+---
+Signals sent to the master:
+    - SIGHUP reloads without downtime: the app module is reloaded, a new generation of workers is forked
+      and only then are the old workers stopped. As the socket stays open, no connection is refused.
+      The modules imported by the app module are not reloaded.
+    - SIGTERM and SIGINT stop the workers gracefully: each one finishes its current request, runs its pending
+      background tasks (see API.shutdown) and exits, the ones still running after graceful_timeout seconds
+      are killed.
+"""
+import importlib
+import os
+import queue
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+WORKER_POLL_INTERVAL = 0.5
+# the exit code of a worker that failed before serving, and of the master that gave up on them
+WORKER_BOOT_ERROR = 3
+# the delay before replacing a worker that failed to boot, doubled with every failure in a row, up to the max
+BOOT_BACKOFF = 0.1
+MAX_BOOT_BACKOFF = 10.0
+SERVICE_UNAVAILABLE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Content-Type: text/plain\r\n'
+    b'Content-Length: 20\r\n'
+    b'Retry-After: 1\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+    b'Service Unavailable.'
+)
+
+
+def load_app(target):
+    """
+    Import the app from 'module:attribute', e.g. 'app:app'. The attribute defaults to app.
+
+    :param target:
+    :return:
+    """
+    module_name, _, attribute = target.partition(':')
+    return getattr(importlib.import_module(module_name), attribute or 'app')
+
+
+def reload_app(target):
+    module_name, _, attribute = target.partition(':')
+    module = importlib.reload(sys.modules[module_name])
+    return getattr(module, attribute or 'app')
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class WorkerServer(WSGIServer):
+    def __init__(self, listener, app, access_log=False):
+        """
+        A wsgiref server on a socket that is already listening, shared with the other workers.
+
+        :param listener:
+        :param app:
+        :param access_log:
+        """
+        super().__init__(listener.getsockname()[:2], WSGIRequestHandler if access_log else QuietRequestHandler,
+                         bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+        self.set_app(app)
+        self.timeout = WORKER_POLL_INTERVAL
+        self.handled = 0
+
+    def finish_request(self, request, client_address):
+        self.handled += 1
+        super().finish_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # a client that went away is no reason to print a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def server_close(self):
+        # the socket belongs to the master
+        pass
+
+
+class ThreadPoolMixIn:
+    def start_threads(self, threads, queue_size):
+        """
+        Serve the accepted connections with threads threads instead of the thread that accepts them,
+        at most queue_size connections wait for a thread.
+
+        :param threads:
+        :param queue_size:
+        :return:
+        """
+        self.connections = queue.Queue(queue_size)
+        self.rejected = 0
+        self._threads = [
+            threading.Thread(target=self._process_connections, name=f'sengoku-{index}', daemon=True)
+            for index in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except queue.Full:
+            self.rejected += 1
+            try:
+                request.sendall(SERVICE_UNAVAILABLE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _process_connections(self):
+        while True:
+            connection = self.connections.get()
+            if connection is None:
+                return
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        # the queued connections are still served, the threads stop once they reach the end of the queue
+        for _ in self._threads:
+            self.connections.put(None)
+        for thread in self._threads:
+            thread.join()
+        super().server_close()
+
+
+class ThreadedWorkerServer(ThreadPoolMixIn, WorkerServer):
+    def __init__(self, listener, app, access_log=False, threads=16, queue_size=64):
+        super().__init__(listener, app, access_log)
+        self.start_threads(threads, queue_size)
+
+
+class PreforkServer:
+    def __init__(self, app, bind='127.0.0.1:8000', workers=None, threads=0, queue_size=64, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=30, backlog=2048, access_log=False, max_boot_failures=5):
+        """
+        :param app: the API, or 'module:attribute' to import it (required to reload the code on SIGHUP)
+        :param bind: host:port, port 0 picks a free port
+        :param workers: the number of worker processes, one per core by default
+        :param threads: the number of threads of every worker, 0 serves the connections in the main thread
+        :param queue_size: with threads, how many connections can wait for a thread before getting a 503
+        :param max_requests: restart a worker after that many requests, 0 never restarts them
+        :param max_requests_jitter: add up to that many requests to max_requests, per worker
+        :param graceful_timeout: how long (in seconds) the workers have to finish their requests when stopping
+        :param backlog: the size of the accept queue of the socket
+        :param access_log: log every request to stderr
+        :param max_boot_failures: stop the server when that many workers in a row fail to boot
+        """
+        self.target = app if isinstance(app, str) else None
+        self.app = app
+        self.address = parse_bind(bind)
+        self.worker_count = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.queue_size = queue_size
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.access_log = access_log
+        self.listener = None
+        # pid -> generation of the worker
+        self.workers = {}
+        self.generation = 0
+        self._signals = []
+        self._wakeup = None
+        self._stopping = False
+        self.max_boot_failures = max_boot_failures
+        # the workers that failed to boot in a row, and when the next one can be forked
+        self.boot_failures = 0
+        self._spawn_after = 0.0
+        self._halted = False
+
+    def log(self, message):
+        print(f'[sengoku {os.getpid()}] {message}', file=sys.stderr, flush=True)
+
+    def prepare(self):
+        """
+        Import, precompile and freeze the app, and open the listening socket.
+        Done by run, before forking the workers.
+
+        :return:
+        """
+        if self.target is not None:
+            self.app = load_app(self.target)
+        self._precompile()
+
+        self.listener = socket.create_server(self.address, backlog=self.backlog)
+        # the workers poll the socket, the ones that lose the race for a connection must not block in accept
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()[:2]
+
+    def run(self):
+        """
+        Fork the workers, and watch them until the server is stopped.
+
+        :return:
+        """
+        if self.listener is None:
+            self.prepare()
+
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        self._wakeup = read_fd, write_fd
+        signal.set_wakeup_fd(write_fd)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self._signals_handler)
+
+        host, port = self.address
+        threads = f' of {self.threads} threads' if self.threads else ''
+        self.log(f'Listening on http://{host}:{port} with {self.worker_count} workers{threads}')
+        self.spawn_workers()
+
+        try:
+            while not self._stopping:
+                # wake up in time to replace a worker once its boot backoff is over
+                backoff = self._spawn_after - time.monotonic()
+                select.select([read_fd], [], [], min(1.0, backoff) if backoff > 0 else 1.0)
+                try:
+                    os.read(read_fd, 4096)
+                except BlockingIOError:
+                    pass
+                self.handle_signals()
+                self.reap_workers()
+                if not self._stopping:
+                    self.spawn_workers()
+        finally:
+            self.stop_workers(list(self.workers))
+            signal.set_wakeup_fd(-1)
+            os.close(read_fd)
+            os.close(write_fd)
+            self.listener.close()
+            self.log('Stopped')
+        if self._halted:
+            sys.exit(WORKER_BOOT_ERROR)
+
+    def _signals_handler(self, signum, frame):
+        self._signals.append(signum)
+
+    def handle_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                self._stopping = True
+            elif signum == signal.SIGHUP:
+                self.reload()
+
+    def reload(self):
+        """
+        Reload the app, fork a new generation of workers, then stop the previous one.
+
+        :return:
+        """
+        if self.target is not None:
+            try:
+                self.app = reload_app(self.target)
+            except Exception as e:
+                self.log(f'Reloading {self.target} failed, the workers keep the previous code: {e!r}')
+                return
+        self._precompile()
+
+        previous = [pid for pid, generation in self.workers.items() if generation == self.generation]
+        self.generation += 1
+        self.spawn_workers()
+        self.stop_workers(previous)
+        self.log(f'Reloaded, generation {self.generation}')
+
+    def _precompile(self):
+        if hasattr(self.app, 'precompile'):
+            self.app.precompile()
+            self.app.freeze()
+
+    def spawn_workers(self):
+        if time.monotonic() < self._spawn_after:
+            # backing off after a worker that failed to boot
+            return
+        current = sum(generation == self.generation for generation in self.workers.values())
+        for _ in range(self.worker_count - current):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker()
+            self.workers[pid] = self.generation
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.workers.pop(pid, None)
+            if os.waitstatus_to_exitcode(status) == WORKER_BOOT_ERROR:
+                self.worker_failed_to_boot()
+            else:
+                self.boot_failures = 0
+
+    def worker_failed_to_boot(self):
+        self.boot_failures += 1
+        if self.boot_failures >= self.max_boot_failures:
+            self.log(f'{self.boot_failures} workers in a row failed to boot, stopping')
+            self._stopping = True
+            self._halted = True
+            return
+        delay = min(MAX_BOOT_BACKOFF, BOOT_BACKOFF * 2 ** (self.boot_failures - 1))
+        self._spawn_after = time.monotonic() + delay
+        self.log(f'A worker failed to boot, the next one is forked in {delay:.1f}s')
+
+    def stop_workers(self, pids):
+        """
+        Ask the workers to stop after their current request, and kill the ones that are still running
+        after graceful_timeout seconds.
+
+        :param pids:
+        :return:
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + self.graceful_timeout
+        remaining = set(pids)
+        while remaining:
+            for pid in list(remaining):
+                try:
+                    waited, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    waited = pid
+                if waited:
+                    remaining.discard(pid)
+                    self.workers.pop(pid, None)
+            if remaining and time.monotonic() > deadline:
+                for pid in remaining:
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(0.05)
+
+    def _run_worker(self):
+        exit_code = 0
+        booted = False
+        try:
+            signal.set_wakeup_fd(-1)
+            for fd in self._wakeup:
+                os.close(fd)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            # the master stops the workers when it gets a SIGINT (e.g. ^C sent to the process group)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+            stopping = []
+            signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+            if hasattr(self.app, 'startup'):
+                # e.g. open the connections of the worker, which must not be shared with the other workers
+                self.app.startup()
+
+            if self.threads:
+                server = ThreadedWorkerServer(self.listener, self.app, self.access_log, self.threads, self.queue_size)
+            else:
+                server = WorkerServer(self.listener, self.app, self.access_log)
+            booted = True
+            max_requests = self.max_requests
+            if max_requests and self.max_requests_jitter:
+                max_requests += random.randint(0, self.max_requests_jitter)
+
+            while not stopping and not (max_requests and server.handled >= max_requests):
+                # returns after WORKER_POLL_INTERVAL without a connection, to check whether to stop
+                server.handle_request()
+            server.server_close()
+            if hasattr(self.app, 'shutdown'):
+                # e.g. run the background tasks that are still pending and close the connections of the worker
+                self.app.shutdown()
+        except BaseException:
+            exit_code = 1 if booted else WORKER_BOOT_ERROR
+            sys.excepthook(*sys.exc_info())
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+
+def serve(app, bind='127.0.0.1:8000', **kwargs):
+    """
+    Run the app with a PreforkServer until it is stopped, see PreforkServer for the arguments.
+
+    :param app:
+    :param bind:
+    :return:
+    """
+    PreforkServer(app, bind, **kwargs).run()
@@ -0,0 +1,173 @@
+"""
+The static asset pipeline.
+Every file of the static directory gets a fingerprinted name that contains the hash of its content,
+e.g. css/main.css -> css/main.3f2a1b9c0d4e.css. Templates link to the fingerprinted URL with the static() helper:
+    <link href="{{ static('css/main.css') }}" rel="stylesheet">
+Since the URL changes whenever the content changes, the fingerprinted files are served with a far-future
+immutable Cache-Control, and browsers never revalidate them.
+The small files are kept in a size-bounded in-memory cache, so the hot ones are served without touching the disk,
+the precompressed variants (.gz/.br) that exist are recorded by build() for the same reason.
+The larger files are streamed through wsgi.file_wrapper.
+Everything else under the prefix (e.g. the plain, non-fingerprinted names) is left to WhiteNoise.
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+
+from .cache import LRUCache
+from .compression import negotiate_encoding
+from .response import FILE_BLOCK_SIZE, FileIterator
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PRECOMPRESSED_EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+
+
+def fingerprint(path, digest):
+    """
+    css/main.css -> css/main.<digest>.css
+
+    :param path:
+    :param digest:
+    :return:
+    """
+    root, extension = os.path.splitext(path)
+    return f'{root}.{digest}{extension}'
+
+
+class StaticFiles:
+    def __init__(self, static_dir, prefix='/static', max_file_size=256 * 1024, cache_size=16 * 1024 * 1024):
+        """
+        :param static_dir:
+        :param prefix: the URL prefix the static files are served under
+        :param max_file_size: files up to max_file_size bytes are kept in memory once they are served
+        :param cache_size: the total number of bytes kept in memory
+        """
+        self.static_dir = static_dir
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        self.cache = LRUCache(cache_size, weigh=len)
+        # 'css/main.css' -> 'css/main.3f2a1b9c0d4e.css'
+        self.manifest = {}
+        # 'css/main.3f2a1b9c0d4e.css' -> absolute path of css/main.css
+        self.fingerprinted = {}
+        # absolute path of css/main.css -> {'gzip': absolute path of css/main.css.gz, ...}
+        self.variants = {}
+        self._built = False
+        self._lock = threading.Lock()
+
+    def build(self):
+        """
+        Hash the files of the static directory and build the manifest. It is done on first use,
+        or ahead of time (e.g. before the workers are forked) by calling it directly.
+
+        :return:
+        """
+        manifest = {}
+        fingerprinted = {}
+        variants = {}
+        for directory, _, file_names in os.walk(self.static_dir):
+            existing = set(file_names)
+            for file_name in file_names:
+                if file_name.endswith(tuple(PRECOMPRESSED_EXTENSIONS.values())):
+                    continue
+                path = os.path.join(directory, file_name)
+                with open(path, 'rb') as file:
+                    digest = hashlib.blake2b(file.read(), digest_size=6).hexdigest()
+                name = os.path.relpath(path, self.static_dir).replace(os.sep, '/')
+                manifest[name] = fingerprint(name, digest)
+                fingerprinted[manifest[name]] = os.path.abspath(path)
+                variants[fingerprinted[manifest[name]]] = {
+                    encoding: os.path.abspath(path + extension)
+                    for encoding, extension in PRECOMPRESSED_EXTENSIONS.items() if file_name + extension in existing
+                }
+
+        with self._lock:
+            self.manifest = manifest
+            self.fingerprinted = fingerprinted
+            self.variants = variants
+            self._built = True
+
+    def refresh(self):
+        """
+        Rebuild the manifest and empty the in-memory cache, after the static files changed.
+
+        :return:
+        """
+        self.cache.clear()
+        self.build()
+
+    def _ensure_built(self):
+        if not self._built:
+            self.build()
+
+    def url(self, name):
+        """
+        The URL of the fingerprinted file, the static() helper of the templates.
+        Files that are not in the static directory keep their name.
+
+        :param name:
+        :return:
+        """
+        self._ensure_built()
+        name = name.lstrip('/')
+        return f'{self.prefix}/{self.manifest.get(name, name)}'
+
+    def _open(self, path):
+        """
+        The content of a small file, from the cache, or the open file and its size for a large one.
+
+        :param path:
+        :return: (data, None) or (None, (file, size))
+        """
+        data = self.cache.get(path)
+        if data is not None:
+            return data, None
+
+        file = open(path, 'rb')
+        size = os.fstat(file.fileno()).st_size
+        if size > self.max_file_size:
+            return None, (file, size)
+        with file:
+            data = file.read()
+        self.cache.set(path, data)
+        return data, None
+
+    def serve(self, environ, start_response):
+        """
+        Serve a fingerprinted file. environ['PATH_INFO'] is the path without the prefix.
+        Returns None when the path is not a fingerprinted file, so it can be handed to WhiteNoise.
+
+        :param environ:
+        :param start_response:
+        :return:
+        """
+        self._ensure_built()
+        path = self.fingerprinted.get(environ['PATH_INFO'].lstrip('/'))
+        if path is None or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None
+
+        content_type, _ = mimetypes.guess_type(path)
+        headers = [
+            ('Content-Type', content_type or 'application/octet-stream'),
+            ('Cache-Control', IMMUTABLE_CACHE_CONTROL),
+            ('Vary', 'Accept-Encoding'),
+        ]
+
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        variant = self.variants.get(path, {}).get(encoding)
+        if variant is not None:
+            path = variant
+            headers.append(('Content-Encoding', encoding))
+
+        data, large_file = self._open(path)
+        headers.append(('Content-Length', str(len(data) if data is not None else large_file[1])))
+        start_response('200 OK', headers)
+
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            if large_file is not None:
+                large_file[0].close()
+            return []
+        if data is not None:
+            return [data]
+        return environ.get('wsgi.file_wrapper', FileIterator)(large_file[0], FILE_BLOCK_SIZE)
@@ -0,0 +1,115 @@
+"""
+Caching for the Jinja2 templates.
+Jinja2 compiles every template to Python bytecode the first time it is loaded. A bytecode cache keeps that
+bytecode around, so the other workers (or the next start) skip the compilation:
+    - jinja2.FileSystemBytecodeCache stores it on disk and is shared by all the gunicorn workers of a host.
+    - MemoryBytecodeCache keeps it in the process; when the templates are loaded before the workers are
+      forked, the workers share it copy-on-write.
+---
+Templates can also be streamed: Jinja2's generate() yields the output piece by piece while the template renders,
+so the first bytes (e.g. the <head> with the assets) reach the client before the whole page is rendered.
+---
+Jinja2 is not imported by this module, only when a template environment or a bytecode cache is created.
+"""
+import functools
+
+
+@functools.cache
+def _memory_bytecode_cache_class():
+    from jinja2 import BytecodeCache
+
+    class MemoryBytecodeCache(BytecodeCache):
+        def __init__(self):
+            self._bytecode = {}
+
+        def load_bytecode(self, bucket):
+            code = self._bytecode.get(bucket.key)
+            if code is not None:
+                bucket.bytecode_from_string(code)
+
+        def dump_bytecode(self, bucket):
+            self._bytecode[bucket.key] = bucket.bytecode_to_string()
+
+        def clear(self):
+            self._bytecode.clear()
+
+    MemoryBytecodeCache.__module__ = __name__
+    MemoryBytecodeCache.__qualname__ = 'MemoryBytecodeCache'
+    return MemoryBytecodeCache
+
+
+def __getattr__(name):
+    # MemoryBytecodeCache subclasses a Jinja2 class, it is defined when it is first imported
+    # so that importing this module does not import Jinja2
+    if name == 'MemoryBytecodeCache':
+        return _memory_bytecode_cache_class()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def make_bytecode_cache(bytecode_cache):
+    """
+    Accept either a jinja2.BytecodeCache or the path of a directory to use with FileSystemBytecodeCache.
+
+    :param bytecode_cache:
+    :return:
+    """
+    from jinja2 import BytecodeCache, FileSystemBytecodeCache
+
+    if bytecode_cache is None or isinstance(bytecode_cache, BytecodeCache):
+        return bytecode_cache
+    return FileSystemBytecodeCache(str(bytecode_cache))
+
+
+def render_cache_key(template_name, context):
+    """
+    The render cache key is made of the template name and the context items, so the context values
+    have to be hashable. Returns None when they are not, and the template is then rendered without the cache.
+    The type of every value is part of the key: True == 1 == 1.0, but they don't render the same.
+
+    :param template_name:
+    :param context:
+    :return:
+    """
+    try:
+        key = (template_name, frozenset((name, type(value), value) for name, value in context.items()))
+    except TypeError:
+        return None
+    return key
+
+
+def buffer_chunks(chunks, min_chunk_size):
+    """
+    Encode the rendered pieces and join them until they reach min_chunk_size bytes,
+    so the server does not have to write every tiny piece on its own.
+
+    :param chunks:
+    :param min_chunk_size:
+    :return:
+    """
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        chunk = chunk.encode()
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= min_chunk_size:
+            yield b''.join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+async def buffer_chunks_async(chunks, min_chunk_size):
+    buffer = []
+    size = 0
+    async for chunk in chunks:
+        chunk = chunk.encode()
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= min_chunk_size:
+            yield b''.join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
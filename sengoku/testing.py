@@ -0,0 +1,385 @@
+"""
+Helpers to drive an API in-process, without a server or a network, e.g. from the benchmarks:
+    status, headers, body = run_wsgi(api, make_environ('/hello/matthew'))
+---
+TestClient is the client of the tests. It takes the arguments of a requests.Session (params, data, json, files,
+headers, cookies), but builds the WSGI environ itself and calls the app directly, so a test request costs about
+as much as the request itself:
+    client = api.test_client()
+    response = client.get('/books', params={'page': 2})
+    assert response.status_code == 200 and response.json() == [...]
+AsyncTestClient does the same through the ASGI interface, its methods are awaited.
+Like a session, a client keeps the cookies set by the responses and follows the redirects.
+"""
+import io
+import json as json_module
+import sys
+import uuid
+from collections.abc import Mapping
+from http.cookies import SimpleCookie
+from urllib.parse import quote, unquote, unquote_to_bytes, urlencode, urljoin, urlsplit
+
+from .asgi import run_wsgi
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 30
+
+
+def make_environ(path='/', method='GET', query_string='', body=b'', headers=None, **extra):
+    """
+    Build a WSGI environ for a request, as a WSGI server would.
+
+    :param path:
+    :param method:
+    :param query_string:
+    :param body:
+    :param headers: {'Accept-Encoding': 'gzip', ...}
+    :param extra: other keys of the environ
+    :return:
+    """
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in (headers or {}).items():
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key != 'CONTENT_LENGTH':
+            environ[f'HTTP_{key}'] = value
+
+    environ.update(extra)
+    return environ
+
+
+class Headers(Mapping):
+    def __init__(self, headers):
+        """
+        The headers of a response, looked up without regard to case.
+        A header sent several times joins its values with a comma, get_all returns them separately.
+
+        :param headers: a list of (name, value)
+        """
+        self._list = list(headers)
+        self._joined = {}
+        self._names = {}
+        for name, value in self._list:
+            key = name.lower()
+            self._names.setdefault(key, name)
+            self._joined[key] = f'{self._joined[key]}, {value}' if key in self._joined else value
+
+    def __getitem__(self, name):
+        return self._joined[name.lower()]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self._joined
+
+    def __iter__(self):
+        return iter(self._names.values())
+
+    def __len__(self):
+        return len(self._joined)
+
+    def get_all(self, name):
+        return [value for header, value in self._list if header.lower() == name.lower()]
+
+    def __repr__(self):
+        return f'Headers({self._list!r})'
+
+
+class TestResponse:
+    # not a test class, for pytest
+    __test__ = False
+
+    def __init__(self, status_code, headers, content, url):
+        """
+        :param status_code:
+        :param headers: a list of (name, value)
+        :param content: the body, bytes
+        :param url:
+        """
+        self.status_code = status_code
+        self.headers = Headers(headers)
+        self.content = content
+        self.url = url
+        # the responses of the redirects that were followed to get this one
+        self.history = []
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def encoding(self):
+        _, _, charset = self.headers.get('Content-Type', '').partition('charset=')
+        return charset.split(';')[0].strip() or 'UTF-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return json_module.loads(self.content)
+
+    @property
+    def cookies(self):
+        cookies = SimpleCookie()
+        for header in self.headers.get_all('Set-Cookie'):
+            cookies.load(header)
+        return {name: morsel.value for name, morsel in cookies.items()}
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise AssertionError(f'{self.status_code} response for {self.url}: {self.text[:200]}')
+
+    def __repr__(self):
+        return f'<TestResponse [{self.status_code}]>'
+
+
+def encode_multipart(data, files):
+    """
+    Encode fields and files as multipart/form-data. A file is its content (bytes, str or a binary file)
+    or a (filename, content) or (filename, content, content_type) tuple.
+
+    :param data:
+    :param files:
+    :return: (body, content_type)
+    """
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in _items(data):
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode())
+        body.write(value if isinstance(value, bytes) else str(value).encode())
+        body.write(b'\r\n')
+    for name, value in _items(files):
+        if isinstance(value, tuple):
+            filename, content, content_type = (value + ('application/octet-stream',))[:3]
+        else:
+            filename = getattr(value, 'name', name)
+            content, content_type = value, 'application/octet-stream'
+        if hasattr(content, 'read'):
+            content = content.read()
+        if isinstance(content, str):
+            content = content.encode()
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                   f'Content-Type: {content_type}\r\n\r\n'.encode())
+        body.write(content)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+def _items(fields):
+    if not fields:
+        return []
+    return fields.items() if isinstance(fields, Mapping) else fields
+
+
+class BaseTestClient:
+    __test__ = False
+
+    def __init__(self, app, base_url='http://testserver'):
+        """
+        :param app: the API
+        :param base_url: the URL the relative URLs of the requests are joined to
+        """
+        self.app = app
+        self.base_url = base_url
+        # the cookies set by the responses, sent with the next requests
+        self.cookies = {}
+
+    def prepare(self, method, url, params=None, data=None, json=None, files=None, headers=None, cookies=None):
+        """
+        Turn the arguments of a request into what both interfaces need.
+
+        :return: (method, url, scheme, host, path, query_string, headers, body), path is still percent-encoded
+        """
+        url = urljoin(self.base_url, url)
+        parts = urlsplit(url)
+        query_string = parts.query
+        if params:
+            query_string = '&'.join(filter(None, (query_string, urlencode(list(_items(params)), doseq=True))))
+
+        headers = dict(headers or {})
+        body = b''
+        if json is not None:
+            body = json_module.dumps(json).encode()
+            headers.setdefault('Content-Type', 'application/json')
+        elif files:
+            body, content_type = encode_multipart(data, files)
+            headers.setdefault('Content-Type', content_type)
+        elif isinstance(data, str):
+            body = data.encode()
+        elif isinstance(data, bytes):
+            body = data
+        elif hasattr(data, 'read'):
+            body = data.read()
+        elif data:
+            body = urlencode(list(_items(data)), doseq=True).encode()
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        sent_cookies = {**self.cookies, **(cookies or {})}
+        if sent_cookies:
+            headers.setdefault('Cookie', '; '.join(f'{name}={value}' for name, value in sent_cookies.items()))
+
+        # the path as it is sent on the wire, non-ASCII characters given as they are get percent-encoded
+        path = quote(parts.path, safe="/%;:@&=+$,!~*'()") or '/'
+        return method.upper(), url, parts.scheme, parts.netloc, path, query_string, headers, body
+
+    def store_cookies(self, response):
+        cookies = SimpleCookie()
+        for header in response.headers.get_all('Set-Cookie'):
+            cookies.load(header)
+        for name, morsel in cookies.items():
+            if morsel['max-age'] == '0':
+                self.cookies.pop(name, None)
+            else:
+                self.cookies[name] = morsel.value
+
+    @staticmethod
+    def redirect(response, method, kwargs):
+        """
+        The request to send to follow a redirect response, None when it is not one.
+
+        :param response:
+        :param method:
+        :param kwargs: the arguments of the request that got the response
+        :return: (method, url, kwargs)
+        """
+        if response.status_code not in REDIRECT_STATUSES or 'Location' not in response.headers:
+            return None
+        url = urljoin(response.url, response.headers['Location'])
+        if response.status_code == 303 or (response.status_code in (301, 302) and method == 'POST'):
+            # the body is not sent again
+            method = 'GET' if method != 'HEAD' else method
+            kwargs = {key: value for key, value in kwargs.items() if key in ('headers', 'cookies')}
+        return method, url, kwargs
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def options(self, url, **kwargs):
+        return self.request('OPTIONS', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+class TestClient(BaseTestClient):
+    def request(self, method, url, allow_redirects=True, **kwargs):
+        """
+        Send a request through the WSGI interface of the app.
+
+        :param method:
+        :param url: a path, or a URL
+        :param allow_redirects: whether to follow the redirects
+        :param kwargs: params, data, json, files, headers, cookies
+        :return: a TestResponse
+        """
+        history = []
+        while True:
+            response = self.send(method, url, **kwargs)
+            redirect = self.redirect(response, method, kwargs) if allow_redirects else None
+            if redirect is None or len(history) >= MAX_REDIRECTS:
+                response.history = history
+                return response
+            history.append(response)
+            method, url, kwargs = redirect
+
+    def send(self, method, url, **kwargs):
+        method, url, scheme, host, path, query_string, headers, body = self.prepare(method, url, **kwargs)
+        headers.setdefault('Host', host)
+        # a WSGI server decodes the bytes of the path as latin-1 (PEP 3333)
+        path = unquote_to_bytes(path).decode('latin-1')
+        environ = make_environ(path, method, query_string, body, headers, **{'wsgi.url_scheme': scheme})
+        if ':' in host:
+            environ['SERVER_NAME'], environ['SERVER_PORT'] = host.rsplit(':', 1)
+        else:
+            environ['SERVER_NAME'], environ['SERVER_PORT'] = host, '443' if scheme == 'https' else '80'
+
+        status, response_headers, content = run_wsgi(self.app, environ)
+        response = TestResponse(status, response_headers, content, url)
+        self.store_cookies(response)
+        return response
+
+
+class AsyncTestClient(BaseTestClient):
+    async def request(self, method, url, allow_redirects=True, **kwargs):
+        """
+        Send a request through the ASGI interface of the app, see TestClient.request.
+
+        :return: a TestResponse
+        """
+        history = []
+        while True:
+            response = await self.send(method, url, **kwargs)
+            redirect = self.redirect(response, method, kwargs) if allow_redirects else None
+            if redirect is None or len(history) >= MAX_REDIRECTS:
+                response.history = history
+                return response
+            history.append(response)
+            method, url, kwargs = redirect
+
+    async def send(self, method, url, **kwargs):
+        method, url, scheme, host, path, query_string, headers, body = self.prepare(method, url, **kwargs)
+        headers.setdefault('Host', host)
+        headers['Content-Length'] = str(len(body))
+        server_name, _, port = host.partition(':')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': scheme,
+            'path': unquote(path),
+            'raw_path': path.encode('ascii'),
+            'query_string': query_string.encode('latin-1'),
+            'root_path': '',
+            'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                        for name, value in headers.items()],
+            'client': ('testclient', 50000),
+            'server': (server_name, int(port or (443 if scheme == 'https' else 80))),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app.asgi(scope, receive, send)
+
+        start = next(message for message in sent if message['type'] == 'http.response.start')
+        response_headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in start['headers']]
+        content = b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+        response = TestResponse(start['status'], response_headers, content, url)
+        self.store_cookies(response)
+        return response
@@ -0,0 +1,110 @@
+"""
+Raw WSGI middlewares, added in front of the app with api.add_wsgi_middleware(cls, **kwargs).
+Unlike sengoku.middleware.Middleware, they see the environ and the body iterable exactly as the server does,
+which is what e.g. a third-party WSGI component expects.
+---
+BodyTransformMiddleware is the base class of the middlewares that rewrite the headers and/or the body without
+defeating streaming:
+    - the body is transformed chunk by chunk as the server pulls it, nothing is buffered.
+    - close() of the original iterable is always called, so the files and the generators of the app are released.
+    - when the body is not transformed (a middleware that only rewrites headers, or that decides to pass a response
+      through), the iterable of the app is returned as it is: no copy, and a wsgi.file_wrapper keeps its sendfile.
+    - the Content-Length is only dropped when transform_body actually rewrites the body, the call to start_response
+      waits until it has returned.
+"""
+
+
+class ClosingIterator:
+    def __init__(self, chunks, app_iter):
+        """
+        Iterate over chunks, and close both chunks and app_iter, the iterable chunks was built from.
+
+        :param chunks:
+        :param app_iter:
+        """
+        self._chunks = chunks
+        self._app_iter = app_iter
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self):
+        try:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            if self._app_iter is not self._chunks and hasattr(self._app_iter, 'close'):
+                self._app_iter.close()
+
+
+class BodyTransformMiddleware:
+    def __init__(self, app):
+        """
+        Subclasses override transform_headers, transform_body or both.
+
+        :param app: the WSGI app that is wrapped
+        """
+        self.app = app
+
+    def transform_headers(self, environ, status, headers):
+        """
+        Rewrite the status and the headers of the response.
+
+        :param environ:
+        :param status:
+        :param headers: a list of (name, value)
+        :return: (status, headers)
+        """
+        return status, headers
+
+    def transform_body(self, environ, chunks):
+        """
+        Rewrite the body: take the iterable of the app and return an iterable of chunks, usually by being
+        a generator. Returning chunks itself passes the body through unchanged.
+
+        :param environ:
+        :param chunks:
+        :return:
+        """
+        return chunks
+
+    def __call__(self, environ, start_response):
+        transforms_body = type(self).transform_body is not BodyTransformMiddleware.transform_body
+        # whether the body is rewritten, which makes its Content-Length wrong: only known once transform_body
+        # returned, so until then the call to start_response is held back
+        rewritten = None if transforms_body else False
+        pending = None
+        server_write = None
+
+        def send(status, headers, exc_info):
+            nonlocal server_write
+            if rewritten:
+                headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+            server_write = start_response(status, headers, exc_info)
+            return server_write
+
+        def write(data):
+            # the legacy write() callable of an app that wrote before returning its iterable
+            if server_write is None:
+                send(*pending)
+            server_write(data)
+
+        def start_response_with_headers(status, headers, exc_info=None):
+            nonlocal pending
+            status, headers = self.transform_headers(environ, status, list(headers))
+            if rewritten is None:
+                pending = (status, headers, exc_info)
+                return write
+            return send(status, headers, exc_info)
+
+        app_iter = self.app(environ, start_response_with_headers)
+        if not transforms_body:
+            return app_iter
+
+        chunks = self.transform_body(environ, app_iter)
+        rewritten = chunks is not app_iter
+        if pending is not None and server_write is None:
+            send(*pending)
+        if not rewritten:
+            return app_iter
+        return ClosingIterator(chunks, app_iter)
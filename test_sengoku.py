@@ -1,12 +1,52 @@
+import asyncio
+import gzip
+import importlib.util
+import io
+import json
+import os
+import re
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
 import pytest
 from sengoku.api import API
+from sengoku.background import BackgroundPool
+from sengoku.cache import LRUCache
+from sengoku.caching import CacheMiddleware, FileBackend
+from sengoku.compression import CompressionMiddleware
+from sengoku.exceptions import HTTPError
 from sengoku.middleware import Middleware
+from sengoku.params import Body, Header, Param, Query, Resource
+from sengoku.pool import PoolTimeout, ResourcePool
+from sengoku.response import Response
+from sengoku.server import ThreadedWorkerServer
+from sengoku.templating import MemoryBytecodeCache, render_cache_key
+from sengoku.testing import AsyncTestClient, encode_multipart, make_environ, run_wsgi
+from sengoku.wsgi import BodyTransformMiddleware
 
 FILE_DIR = 'css'
 FILE_NAME = 'main.css'
 FILE_CONTENTS = 'body {background-color: blue}'
 
 
+@pytest.fixture(scope='session')
+def sengoku_app():
+    app = API()
+
+    @app.route('/greeting')
+    def greeting(req, res):
+        res.json = {'greeting': f'hello {req.GET.get("name", "world")}'}
+
+    return app
+
+
 # helpers
 
 def _create_static(static_dir):
@@ -16,6 +56,43 @@ def _create_static(static_dir):
     return asset
 
 
+async def _asgi_request(api, method, path, body=b''):
+    sent = []
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': []}
+    await api.asgi(scope, receive, send)
+
+    start, *body_messages = sent
+    return start['status'], dict(start['headers']), b''.join(message['body'] for message in body_messages)
+
+
+def _asgi_get(api, path):
+    return asyncio.run(_asgi_request(api, 'GET', path))
+
+
+def _wsgi_call(api, path, method='GET', **environ):
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = status
+        started['headers'] = dict(headers)
+
+    environ.update({
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80', 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+    })
+    app_iter = api(environ, start_response)
+
+    return started['status'], started['headers'], app_iter
+
+
 # tests
 
 
@@ -234,3 +311,1885 @@ def test_manually_setting_body(api, client):
 
     assert 'text/plain' in response.headers['Content-Type']
     assert response.text == 'Byte Body'
+
+
+def test_typed_parameterized_route(api, client):
+    @api.route('/sub/{num_1:d}/{num_2:d}')
+    def sub(req, res, num_1, num_2):
+        res.text = f'{num_1 - num_2}'
+
+    assert client.get('http://testserver/sub/5/3').text == '2'
+    assert client.get('http://testserver/sub/five/3').status_code == 404
+
+
+def test_static_segments_are_matched_before_parameters(api, client):
+    @api.route('/books/{name}')
+    def book(req, res, name):
+        res.text = f'book {name}'
+
+    @api.route('/books/{number:d}')
+    def book_by_number(req, res, number):
+        res.text = f'book number {number}'
+
+    @api.route('/books/latest')
+    def latest(req, res):
+        res.text = 'latest book'
+
+    assert client.get('http://testserver/books/latest').text == 'latest book'
+    assert client.get('http://testserver/books/7').text == 'book number 7'
+    assert client.get('http://testserver/books/dune').text == 'book dune'
+    assert client.get('http://testserver/books/dune/chapters').status_code == 404
+
+
+def test_static_segments_are_matched_case_insensitively(api, client):
+    @api.route('/home')
+    def home(req, res):
+        res.text = 'home'
+
+    @api.route('/Books/{name}')
+    def book(req, res, name):
+        res.text = f'book {name}'
+
+    assert client.get('http://testserver/HOME').text == 'home'
+    assert client.get('http://testserver/books/Dune').text == 'book Dune'
+
+
+def test_asgi_async_handler(api):
+    @api.route('/hello/{name}')
+    async def hello(req, res, name):
+        await asyncio.sleep(0)
+        res.text = f'hey {name}'
+
+    status, headers, body = _asgi_get(api, '/hello/xavier')
+
+    assert status == 200
+    assert b'text/plain' in headers[b'content-type']
+    assert body == b'hey xavier'
+
+
+def test_asgi_non_ascii_path_params(api):
+    @api.route('/hello/{name}')
+    def hello(req, res, name):
+        res.text = f'hey {name}'
+
+    assert _asgi_get(api, '/hello/日本')[2] == 'hey 日本'.encode()
+    assert _asgi_get(api, '/hello/café')[2] == 'hey café'.encode()
+
+
+def test_asgi_async_class_based_handler(api):
+    @api.route('/book')
+    class BookResource:
+        async def get(self, req, res):
+            res.json = {'title': 'async book'}
+
+    status, _, body = _asgi_get(api, '/book')
+
+    assert status == 200
+    assert json.loads(body) == {'title': 'async book'}
+
+
+def test_asgi_sync_handler_runs_in_thread_pool(api):
+    handler_threads = []
+
+    @api.route('/sync')
+    def sync_handler(req, res):
+        handler_threads.append(threading.current_thread())
+        res.text = 'sync'
+
+    assert _asgi_get(api, '/sync')[2] == b'sync'
+    assert handler_threads[0] is not threading.main_thread()
+
+
+def test_asgi_default_404_response(api):
+    status, _, body = _asgi_get(api, '/doesnotexist')
+
+    assert status == 404
+    assert body == b'Not found.'
+
+
+def test_asgi_slow_handlers_run_concurrently(api):
+    @api.route('/slow')
+    async def slow(req, res):
+        await asyncio.sleep(0.2)
+        res.text = 'done'
+
+    async def run_many():
+        return await asyncio.gather(*(_asgi_request(api, 'GET', '/slow') for _ in range(20)))
+
+    started = time.perf_counter()
+    results = asyncio.run(run_many())
+
+    assert time.perf_counter() - started < 1
+    assert all(body == b'done' for _, _, body in results)
+
+
+def test_asgi_async_middleware_methods_are_awaited(api):
+    calls = []
+
+    class AsyncMiddleware(Middleware):
+        async def process_request(self, req):
+            calls.append('request')
+
+        async def process_response(self, req, res):
+            calls.append('response')
+
+    api.add_middleware(AsyncMiddleware)
+
+    @api.route('/')
+    async def index(req, res):
+        res.text = 'index'
+
+    assert _asgi_get(api, '/')[2] == b'index'
+    assert calls == ['request', 'response']
+
+
+def test_async_handler_through_wsgi(api, client):
+    @api.route('/async')
+    async def async_handler(req, res):
+        res.text = 'async over wsgi'
+
+    assert client.get('http://testserver/async').text == 'async over wsgi'
+
+
+def test_custom_response_headers(api, client):
+    @api.route('/headers')
+    def headers_handler(req, res):
+        res.headers['X-Custom'] = 'custom value'
+        res.text = 'headers'
+
+    response = client.get('http://testserver/headers')
+
+    assert response.headers['X-Custom'] == 'custom value'
+    assert response.headers['Content-Length'] == str(len('headers'))
+
+
+def test_explicit_response_headers_replace_the_computed_ones(api):
+    api.add_middleware(CompressionMiddleware, min_size=10)
+
+    @api.route('/export')
+    def export(req, res):
+        res.headers['Content-Type'] = 'text/csv'
+        res.text = 'id,name\n' * 10
+
+    @api.route('/encoded')
+    def encoded(req, res):
+        res.headers['content-encoding'] = 'identity'
+        res.text = 'already encoded ' * 10
+
+    _, headers, _ = run_wsgi(api, make_environ('/export'))
+    assert [value for name, value in headers if name.lower() == 'content-type'] == ['text/csv']
+
+    environ = make_environ('/encoded')
+    environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+    _, headers, body = run_wsgi(api, environ)
+    assert [value for name, value in headers if name.lower() == 'content-encoding'] == ['identity']
+    assert body == b'already encoded ' * 10
+
+
+def test_webob_features_fall_back_to_webob_response(api, client):
+    @api.route('/cookie')
+    def cookie_handler(req, res):
+        res.webob.set_cookie('flavor', 'chocolate')
+        res.json = {'cookie': 'set'}
+
+    response = client.get('http://testserver/cookie')
+
+    assert response.cookies['flavor'] == 'chocolate'
+    assert response.headers['Content-Type'] == 'application/json'
+    assert response.json() == {'cookie': 'set'}
+
+
+def test_head_request_has_no_body(api, client):
+    @api.route('/text', allowed_methods=['head'])
+    def text_handler(req, res):
+        res.text = 'no body for HEAD'
+
+    response = client.head('http://testserver/text')
+
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(len('no body for HEAD'))
+    assert response.content == b''
+
+
+def test_request_parses_query_cookies_and_headers(api, client):
+    @api.route('/inspect')
+    def inspect_handler(req, res):
+        res.json = {
+            'page': req.GET['page'],
+            'tags': req.GET.getall('tag'),
+            'cookie': req.cookies['session'],
+            'header': req.headers['X-Token'],
+        }
+
+    response = client.get('http://testserver/inspect?page=2&tag=a&tag=b',
+                          cookies={'session': 'abc'}, headers={'X-Token': 'secret'})
+
+    assert response.json() == {'page': '2', 'tags': ['a', 'b'], 'cookie': 'abc', 'header': 'secret'}
+
+
+def test_request_is_parsed_lazily(api, client):
+    parsed = {}
+
+    @api.route('/lazy')
+    def lazy_handler(req, res):
+        res.text = req.path
+        parsed['before'] = {'GET', 'cookies', 'headers', 'POST', 'json'} & set(vars(req))
+        req.GET
+        parsed['after'] = {'GET', 'cookies', 'headers', 'POST', 'json'} & set(vars(req))
+
+    assert client.get('http://testserver/lazy?x=1').text == '/lazy'
+    assert parsed == {'before': set(), 'after': {'GET'}}
+
+
+def test_request_form_and_json_bodies(api, client):
+    @api.route('/form', allowed_methods=['post'])
+    def form_handler(req, res):
+        res.text = req.POST['name']
+
+    @api.route('/upload', allowed_methods=['post'])
+    def upload_handler(req, res):
+        upload = req.POST['file']
+        res.text = f'{req.POST["name"]}:{upload.filename}:{upload.file.read().decode()}'
+
+    @api.route('/json', allowed_methods=['post'])
+    def json_handler(req, res):
+        res.json = {'received': req.json}
+
+    assert client.post('http://testserver/form', data={'name': 'sengoku'}).text == 'sengoku'
+    assert client.post('http://testserver/upload', data={'name': 'doc'},
+                       files={'file': ('notes.txt', b'contents')}).text == 'doc:notes.txt:contents'
+    assert client.post('http://testserver/json', json=[1, 2]).json() == {'received': [1, 2]}
+
+
+def test_request_body_is_a_streaming_reader(api, client):
+    chunks = []
+
+    @api.route('/stream', allowed_methods=['post'])
+    def stream_handler(req, res):
+        req.body.chunk_size = 4
+        chunks.extend(req.body)
+        res.text = 'streamed'
+
+    assert client.post('http://testserver/stream', data=b'0123456789').text == 'streamed'
+    assert chunks == [b'0123', b'4567', b'89']
+
+
+def test_custom_json_serializer():
+    api = API(json_serializer=lambda obj: json.dumps(obj, sort_keys=True, separators=(',', ':')).encode())
+    client = api.test_session()
+
+    @api.route('/json')
+    def json_handler(req, res):
+        res.json = {'b': 2, 'a': 1}
+
+    assert client.get('http://testserver/json').content == b'{"a":1,"b":2}'
+
+
+def test_default_json_serializer_accepts_what_the_stdlib_json_accepts(api, client):
+    @api.route('/json')
+    def json_handler(req, res):
+        res.json = {1: 'a', 'big': 2 ** 70}
+
+    response = client.get('http://testserver/json')
+
+    assert response.status_code == 200
+    assert response.json() == {'1': 'a', 'big': 2 ** 70}
+
+
+def test_json_generator_is_streamed_as_array(api, client):
+    def rows():
+        for number in range(5000):
+            yield {'row': number}
+
+    @api.route('/rows')
+    def rows_handler(req, res):
+        res.json = rows()
+
+    response = client.get('http://testserver/rows')
+
+    assert response.headers['Content-Type'] == 'application/json'
+    assert 'Content-Length' not in response.headers
+    assert response.json() == [{'row': number} for number in range(5000)]
+
+
+def test_json_generator_over_asgi(api):
+    @api.route('/rows')
+    async def rows_handler(req, res):
+        res.json = iter([1, 2, 3])
+
+    assert json.loads(_asgi_get(api, '/rows')[2]) == [1, 2, 3]
+
+
+def test_asgi_sync_streams_do_not_block_the_event_loop(api):
+    finished = []
+
+    @api.route('/export')
+    def export(req, res):
+        def rows():
+            for row in range(3):
+                time.sleep(0.1)
+                yield f'{row}\n'.encode()
+            finished.append('export')
+
+        res.body = rows()
+
+    @api.route('/ping')
+    async def ping(req, res):
+        res.text = 'pong'
+        finished.append('ping')
+
+    async def both():
+        export = asyncio.ensure_future(_asgi_request(api, 'GET', '/export'))
+        await asyncio.sleep(0.05)
+        ping = await _asgi_request(api, 'GET', '/ping')
+        return await export, ping
+
+    export, ping = asyncio.run(both())
+
+    assert export[2] == b'0\n1\n2\n'
+    assert ping[2] == b'pong'
+    assert finished == ['ping', 'export']
+
+
+def test_empty_json_generator(api, client):
+    @api.route('/rows')
+    def rows_handler(req, res):
+        res.json = iter([])
+
+    assert client.get('http://testserver/rows').json() == []
+
+
+def test_generator_body_is_passed_through_lazily(api):
+    produced = []
+
+    def export():
+        for line in range(3):
+            produced.append(line)
+            yield f'line {line}\n'.encode()
+
+    @api.route('/export')
+    def export_handler(req, res):
+        res.body = export()
+        res.content_type = 'text/csv'
+
+    status, headers, app_iter = _wsgi_call(api, '/export')
+
+    assert status == '200 OK'
+    assert 'Content-Length' not in headers
+    assert produced == []
+    assert b''.join(app_iter) == b'line 0\nline 1\nline 2\n'
+    assert produced == [0, 1, 2]
+
+
+def test_file_body_uses_wsgi_file_wrapper(api, tmp_path):
+    report = tmp_path / 'report.csv'
+    report.write_bytes(b'a,b\n1,2\n')
+
+    class FileWrapper:
+        def __init__(self, file, block_size):
+            self.file = file
+            self.block_size = block_size
+
+        def __iter__(self):
+            return iter(lambda: self.file.read(self.block_size), b'')
+
+    @api.route('/report')
+    def report_handler(req, res):
+        res.body = open(report, 'rb')
+        res.content_type = 'text/csv'
+
+    _, headers, app_iter = _wsgi_call(api, '/report', **{'wsgi.file_wrapper': FileWrapper})
+
+    assert isinstance(app_iter, FileWrapper)
+    assert headers['Content-Length'] == '8'
+    assert b''.join(app_iter) == b'a,b\n1,2\n'
+    app_iter.file.close()
+
+
+def test_file_body_without_file_wrapper(api, tmp_path):
+    report = tmp_path / 'report.csv'
+    report.write_bytes(b'x' * 200000)
+    opened = []
+
+    @api.route('/report')
+    def report_handler(req, res):
+        opened.append(open(report, 'rb'))
+        res.body = opened[0]
+
+    _, headers, app_iter = _wsgi_call(api, '/report')
+
+    assert headers['Content-Length'] == '200000'
+    assert b''.join(app_iter) == b'x' * 200000
+    app_iter.close()
+    assert opened[0].closed
+
+
+def test_streaming_body_over_asgi(api):
+    async def chunks():
+        for chunk in (b'first ', b'second'):
+            yield chunk
+
+    @api.route('/stream')
+    async def stream_handler(req, res):
+        res.body = chunks()
+
+    assert _asgi_get(api, '/stream')[2] == b'first second'
+
+
+def test_template_render_cache(tmp_path):
+    (tmp_path / 'page.html').write_text('v1 {{ name }}')
+    api = API(templates_dir=str(tmp_path))
+
+    assert api.template('page.html', {'name': 'a'}, cache=True) == 'v1 a'
+
+    (tmp_path / 'page.html').write_text('v2 {{ name }}')
+    os.utime(tmp_path / 'page.html', (time.time() + 10, time.time() + 10))
+
+    assert api.template('page.html', {'name': 'a'}, cache=True) == 'v1 a'
+    assert api.template('page.html', {'name': 'a'}) == 'v2 a'
+
+    api.invalidate_template('page.html')
+
+    assert api.template('page.html', {'name': 'a'}, cache=True) == 'v2 a'
+
+
+def test_template_render_cache_keys_on_the_value_types(tmp_path):
+    (tmp_path / 'page.html').write_text('{{ v }}')
+    api = API(templates_dir=str(tmp_path))
+
+    assert api.template('page.html', {'v': 1}, cache=True) == '1'
+    assert api.template('page.html', {'v': True}, cache=True) == 'True'
+    assert api.template('page.html', {'v': 1.0}, cache=True) == '1.0'
+
+
+def test_template_render_cache_ttl_and_unhashable_context(tmp_path):
+    (tmp_path / 'page.html').write_text('{{ items|join(",") }}')
+    api = API(templates_dir=str(tmp_path), render_cache_ttl=0.01)
+
+    assert api.template('page.html', {'items': ('a', 'b')}, cache=True) == 'a,b'
+    assert len(api.render_cache) == 1
+    time.sleep(0.02)
+    assert render_cache_key('page.html', {'items': ('a', 'b')}) not in api.render_cache
+
+    assert api.template('page.html', {'items': ['c']}, cache=True) == 'c'
+    assert len(api.render_cache) == 0
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.keys() == ['a', 'c']
+
+
+def test_memory_bytecode_cache_is_used(tmp_path):
+    (tmp_path / 'page.html').write_text('{{ name }}')
+    bytecode_cache = MemoryBytecodeCache()
+    api = API(templates_dir=str(tmp_path), bytecode_cache=bytecode_cache)
+
+    assert api.template('page.html', {'name': 'compiled'}) == 'compiled'
+    assert len(bytecode_cache._bytecode) == 1
+
+    other_api = API(templates_dir=str(tmp_path), bytecode_cache=bytecode_cache)
+    assert other_api.template('page.html', {'name': 'from cache'}) == 'from cache'
+
+
+def test_filesystem_bytecode_cache(tmp_path):
+    templates_dir = tmp_path / 'templates'
+    templates_dir.mkdir()
+    (templates_dir / 'page.html').write_text('{{ name }}')
+    api = API(templates_dir=str(templates_dir), bytecode_cache=tmp_path / 'bytecode')
+    (tmp_path / 'bytecode').mkdir()
+
+    assert api.template('page.html', {'name': 'on disk'}) == 'on disk'
+    assert len(list((tmp_path / 'bytecode').iterdir())) == 1
+
+
+def test_stream_template(api, client):
+    @api.route('/html')
+    def html_handler(req, res):
+        res.html = api.stream_template('index.html', context={'title': 'Streamed Title', 'name': 'Streamed Name'})
+
+    response = client.get('http://testserver/html')
+
+    assert 'text/html' in response.headers['Content-Type']
+    assert 'Content-Length' not in response.headers
+    assert 'Streamed Title' in response.text
+    assert 'Streamed Name' in response.text
+
+
+def test_stream_template_min_chunk_size(api):
+    context = {'title': 'Title', 'name': 'Name'}
+
+    unbuffered = list(api.stream_template('index.html', context, min_chunk_size=0))
+    buffered = list(api.stream_template('index.html', context, min_chunk_size=64 * 1024))
+
+    assert len(unbuffered) > 1
+    assert len(buffered) == 1
+    assert b''.join(unbuffered) == buffered[0] == api.template('index.html', context).encode()
+
+
+def test_stream_template_async(tmp_path):
+    (tmp_path / 'page.html').write_text('<h1>{{ title }}</h1><p>{{ load_name() }}</p>')
+    api = API(templates_dir=str(tmp_path))
+
+    async def load_name():
+        await asyncio.sleep(0)
+        return 'Async Name'
+
+    @api.route('/html')
+    async def html_handler(req, res):
+        res.html = api.stream_template_async('page.html', context={'title': 'Async Title', 'load_name': load_name})
+
+    status, headers, body = _asgi_get(api, '/html')
+
+    assert status == 200
+    assert b'text/html' in headers[b'content-type']
+    assert body == b'<h1>Async Title</h1><p>Async Name</p>'
+
+
+def test_class_based_handler_is_instantiated_per_request_by_default(api, client):
+    instances = []
+
+    @api.route('/book')
+    class BookResource:
+        def __init__(self):
+            instances.append(self)
+
+        def get(self, req, res):
+            res.text = 'book'
+
+    client.get('http://testserver/book')
+    client.get('http://testserver/book')
+
+    assert len(instances) == 2
+
+
+@pytest.mark.parametrize('instances', ['singleton', 'pool'])
+def test_class_based_handler_instances_are_reused(api, client, instances):
+    created = []
+
+    @api.route('/book', instances=instances)
+    class BookResource:
+        def __init__(self):
+            created.append(self)
+
+        def get(self, req, res):
+            res.text = f'book {id(self)}'
+
+    responses = {client.get('http://testserver/book').text for _ in range(3)}
+
+    assert len(created) == 1
+    assert responses == {f'book {id(created[0])}'}
+
+
+def test_unknown_handler_instances_mode(api):
+    with pytest.raises(ValueError):
+        @api.route('/book', instances='per-thread')
+        class BookResource:
+            def get(self, req, res):
+                pass
+
+
+def test_head_and_options_are_answered_from_the_dispatch_table(api, client):
+    @api.route('/book')
+    class BookResource:
+        def get(self, req, res):
+            res.text = 'book'
+
+        def post(self, req, res):
+            res.text = 'created'
+
+    head = client.head('http://testserver/book')
+    options = client.options('http://testserver/book')
+
+    assert head.status_code == 200
+    assert head.headers['Content-Length'] == '4'
+    assert head.content == b''
+    assert options.status_code == 204
+    assert options.headers['Allow'] == 'GET, HEAD, OPTIONS, POST'
+    assert api.routes['/book']['allowed'] == {'GET', 'HEAD', 'OPTIONS', 'POST'}
+
+
+def test_middleware_pipeline_order(api, client):
+    calls = []
+
+    class First(Middleware):
+        def process_request(self, req):
+            calls.append('first request')
+
+        def process_response(self, req, res):
+            calls.append('first response')
+
+    class Second(Middleware):
+        def process_request(self, req):
+            calls.append('second request')
+
+    class Third(Middleware):
+        def process_response(self, req, res):
+            calls.append('third response')
+
+    api.add_middleware(First)
+    api.add_middleware(Second)
+    api.add_middleware(Third)
+
+    @api.route('/')
+    def index(req, res):
+        calls.append('handler')
+
+    client.get('http://testserver/')
+
+    assert calls == ['second request', 'first request', 'handler', 'first response', 'third response']
+    assert len(api.middleware._request_hooks) == 2
+    assert len(api.middleware._response_hooks) == 2
+
+
+def test_middleware_can_short_circuit(api, client):
+    calls = []
+
+    class Inner(Middleware):
+        def process_request(self, req):
+            calls.append('inner request')
+
+        def process_response(self, req, res):
+            calls.append('inner response')
+
+    class Auth(Middleware):
+        def process_request(self, req):
+            if 'Authorization' not in req.headers:
+                response = Response()
+                response.status_code = 401
+                response.text = 'Unauthorized'
+                return response
+
+        def process_response(self, req, res):
+            calls.append('auth response')
+
+    class Outer(Middleware):
+        def process_response(self, req, res):
+            calls.append('outer response')
+
+    api.add_middleware(Inner)
+    api.add_middleware(Auth)
+    api.add_middleware(Outer)
+
+    @api.route('/')
+    def index(req, res):
+        calls.append('handler')
+        res.text = 'secret'
+
+    response = client.get('http://testserver/')
+
+    assert response.status_code == 401
+    assert response.text == 'Unauthorized'
+    assert calls == ['auth response', 'outer response']
+
+    calls.clear()
+    assert client.get('http://testserver/', headers={'Authorization': 'token'}).text == 'secret'
+    assert calls == ['inner request', 'handler', 'inner response', 'auth response', 'outer response']
+
+
+def test_middleware_overriding_handle_request_is_still_called(api, client):
+    class Wrapping(Middleware):
+        def handle_request(self, request):
+            response = super().handle_request(request)
+            response.text = response.text.upper()
+            return response
+
+    api.add_middleware(Wrapping)
+
+    @api.route('/')
+    def index(req, res):
+        res.text = 'wrapped'
+
+    assert client.get('http://testserver/').text == 'WRAPPED'
+
+
+def test_async_middleware_can_short_circuit(api):
+    class Cached(Middleware):
+        async def process_request(self, req):
+            response = Response()
+            response.text = 'from cache'
+            return response
+
+    api.add_middleware(Cached)
+
+    @api.route('/')
+    async def index(req, res):
+        res.text = 'from handler'
+
+    assert _asgi_get(api, '/')[2] == b'from cache'
+
+
+def test_cache_middleware_serves_cached_responses(api, client):
+    calls = []
+    api.add_middleware(CacheMiddleware)
+
+    @api.route('/books', cache=60)
+    def books(req, res):
+        calls.append(req.path)
+        res.json = {'books': len(calls)}
+
+    @api.route('/live')
+    def live(req, res):
+        calls.append(req.path)
+        res.text = 'live'
+
+    first = client.get('http://testserver/books')
+    second = client.get('http://testserver/books')
+    client.get('http://testserver/live')
+    client.get('http://testserver/live')
+
+    assert first.json() == second.json() == {'books': 1}
+    assert second.headers['Content-Type'] == 'application/json'
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.headers['Cache-Control'] == 'max-age=60'
+    assert calls == ['/books', '/live', '/live']
+
+
+def test_cache_middleware_answers_conditional_requests(api, client):
+    api.add_middleware(CacheMiddleware)
+
+    @api.route('/books', cache=60)
+    def books(req, res):
+        res.text = 'a list of books'
+
+    response = client.get('http://testserver/books')
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    not_modified = client.get('http://testserver/books', headers={'If-None-Match': etag})
+    modified = client.get('http://testserver/books', headers={'If-None-Match': '"something else"'})
+    not_modified_since = client.get('http://testserver/books', headers={'If-Modified-Since': last_modified})
+
+    assert not_modified.status_code == 304
+    assert not_modified.content == b''
+    assert not_modified.headers['ETag'] == etag
+    assert modified.status_code == 200
+    assert modified.text == 'a list of books'
+    assert not_modified_since.status_code == 304
+
+
+def test_cache_policy_varies_on_headers_and_query(api, client):
+    api.add_middleware(CacheMiddleware)
+
+    @api.route('/greeting', cache={'ttl': 60, 'vary': ['Accept-Language'], 'query': False})
+    def greeting(req, res):
+        language = req.headers.get('Accept-Language', 'en')
+        res.text = f'{language} {req.GET.get("name")}'
+
+    english = client.get('http://testserver/greeting?name=a', headers={'Accept-Language': 'en'})
+    french = client.get('http://testserver/greeting?name=b', headers={'Accept-Language': 'fr'})
+    english_again = client.get('http://testserver/greeting?name=c', headers={'Accept-Language': 'en'})
+
+    assert english.text == english_again.text == 'en a'
+    assert french.text == 'fr b'
+    assert english.headers['Vary'] == 'Accept-Language'
+
+
+def test_cache_file_backend_is_shared_between_workers(tmp_path):
+    calls = []
+
+    def build_worker():
+        worker = API()
+        worker.add_middleware(CacheMiddleware, backend=FileBackend(tmp_path))
+
+        @worker.route('/books', cache=60)
+        def books(req, res):
+            calls.append(req.path)
+            res.text = 'books'
+
+        return worker.test_session()
+
+    assert build_worker().get('http://testserver/books').text == 'books'
+    assert build_worker().get('http://testserver/books').text == 'books'
+    assert calls == ['/books']
+
+
+def test_cache_middleware_skips_private_responses(api, client):
+    calls = []
+    api.add_middleware(CacheMiddleware)
+
+    @api.route('/login', cache=60)
+    def login(req, res):
+        calls.append(req.path)
+        res.headers['Set-Cookie'] = 'session=alice'
+        res.text = 'welcome'
+
+    @api.route('/account', cache=60)
+    def account(req, res):
+        calls.append(req.path)
+        res.headers['cache-control'] = 'private, max-age=10'
+        res.text = 'account'
+
+    @api.route('/public', cache=60)
+    def public(req, res):
+        calls.append(req.path)
+        res.headers['Cache-Control'] = 'public, max-age=5'
+        res.text = 'public'
+
+    client.get('http://testserver/login')
+    anonymous = api.test_session().get('http://testserver/login')
+    client.get('http://testserver/account')
+    account_again = client.get('http://testserver/account')
+    client.get('http://testserver/public')
+    public_again = client.get('http://testserver/public')
+
+    assert anonymous.headers['Set-Cookie'] == 'session=alice'
+    assert account_again.headers['Cache-Control'] == 'private, max-age=10'
+    assert public_again.headers['Cache-Control'] == 'public, max-age=5'
+    assert calls == ['/login', '/login', '/account', '/account', '/public']
+
+
+def test_cache_file_backend_is_private_and_bounded(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(ValueError):
+        FileBackend(shared)
+
+    backend = FileBackend(tmp_path / 'cache', max_size=500)
+    entry = {'status_code': 200, 'content_type': 'text/plain', 'headers': {'ETag': '"1"'}, 'body': b'x' * 100,
+             'etag': '"1"', 'last_modified': 0}
+    backend.set('expired', entry, 0)
+    for ttl in (10, 20, 30):
+        backend.set(f'live {ttl}', entry, ttl)
+
+    assert backend.get('live 10') == entry
+    backend.sweep()
+    assert backend.get('expired') is None
+    assert backend.get('live 10') is None
+    assert backend.get('live 20') == backend.get('live 30') == entry
+    assert len(os.listdir(backend.directory)) == 2
+
+
+def test_cache_entries_expire(api, client):
+    calls = []
+    api.add_middleware(CacheMiddleware)
+
+    @api.route('/books', cache=0.01)
+    def books(req, res):
+        calls.append(req.path)
+        res.text = 'books'
+
+    client.get('http://testserver/books')
+    time.sleep(0.02)
+    client.get('http://testserver/books')
+
+    assert len(calls) == 2
+
+
+def test_compression_middleware_compresses_large_bodies(api, client):
+    api.add_middleware(CompressionMiddleware, min_size=100)
+    large_text = 'sengoku ' * 100
+
+    @api.route('/large')
+    def large(req, res):
+        res.text = large_text
+
+    @api.route('/small')
+    def small(req, res):
+        res.text = 'small'
+
+    compressed = client.get('http://testserver/large', headers={'Accept-Encoding': 'gzip'})
+    small = client.get('http://testserver/small', headers={'Accept-Encoding': 'gzip'})
+    identity = client.get('http://testserver/large', headers={'Accept-Encoding': 'identity'})
+
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert int(compressed.headers['Content-Length']) < len(large_text)
+    assert gzip.decompress(compressed.content).decode() == large_text
+    assert compressed.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in small.headers
+    assert 'Content-Encoding' not in identity.headers
+    assert identity.text == large_text
+
+
+def test_compression_middleware_caches_compressed_bodies(api, client):
+    api.add_middleware(CompressionMiddleware, min_size=0)
+
+    @api.route('/json')
+    def json_handler(req, res):
+        res.json = {'books': list(range(100))}
+
+    compression = api.middleware.app
+    client.get('http://testserver/json', headers={'Accept-Encoding': 'gzip'})
+    client.get('http://testserver/json', headers={'Accept-Encoding': 'gzip'})
+
+    assert len(compression.cache) == 1
+    ((encoding, digest),) = compression.cache.keys()
+    assert encoding == 'gzip' and len(digest) == 16
+    assert compression.cache.size == len(compression.cache.get((encoding, digest)))
+
+
+@pytest.mark.parametrize('order', [(CompressionMiddleware, CacheMiddleware), (CacheMiddleware, CompressionMiddleware)])
+def test_cached_responses_respect_the_accepted_encoding(api, client, order):
+    for middleware_cls in order:
+        api.add_middleware(middleware_cls)
+    calls = []
+    large_text = 'sengoku ' * 100
+
+    @api.route('/large', cache=60)
+    def large(req, res):
+        calls.append(1)
+        res.text = large_text
+
+    gzipped = client.get('/large', headers={'Accept-Encoding': 'gzip'})
+    plain = client.get('/large')
+    gzipped_again = client.get('/large', headers={'Accept-Encoding': 'gzip'})
+    plain_again = client.get('/large')
+
+    assert gzipped.headers['Content-Encoding'] == gzipped_again.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(gzipped_again.content).decode() == large_text
+    assert 'Content-Encoding' not in plain.headers and 'Content-Encoding' not in plain_again.headers
+    assert plain.text == plain_again.text == large_text
+    assert 'Accept-Encoding' in plain_again.headers['Vary']
+    # compressing before caching keeps one variant per encoding, caching before compressing a single entry
+    assert len(calls) == (2 if order[0] is CompressionMiddleware else 1)
+
+
+def test_compression_middleware_streams_generator_bodies(api):
+    api.add_middleware(CompressionMiddleware)
+
+    def export():
+        for line in range(1000):
+            yield f'line {line}\n'.encode()
+
+    @api.route('/export')
+    def export_handler(req, res):
+        res.body = export()
+        res.content_type = 'text/csv'
+
+    _, headers, app_iter = _wsgi_call(api, '/export', HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+
+    assert headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in headers
+    assert gzip.decompress(b''.join(app_iter)) == b''.join(export())
+
+
+def test_compressed_static_files_are_served(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp('static')
+    asset = _create_static(static_dir)
+    asset.write(FILE_CONTENTS * 100)
+    api = API(static_dir=str(static_dir))
+
+    generated = api.compress_static()
+    response = api.test_session().get(f'http://testserver/static/{FILE_DIR}/{FILE_NAME}',
+                                      headers={'Accept-Encoding': 'gzip'})
+
+    assert f'{asset}.gz' in generated
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.content).decode() == FILE_CONTENTS * 100
+
+
+def test_static_prefix_does_not_capture_other_paths(api, client):
+    @api.route('/staticfoo')
+    def static_foo(req, res):
+        res.text = 'not a static file'
+
+    assert client.get('http://testserver/staticfoo').text == 'not a static file'
+
+
+def test_fingerprinted_static_files(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp('static')
+    _create_static(static_dir)
+    api = API(static_dir=str(static_dir))
+    client = api.test_session()
+
+    url = api.templates_env.from_string("{{ static('css/main.css') }}").render()
+    first = client.get(f'http://testserver{url}')
+    second = client.get(f'http://testserver{url}')
+
+    assert url.startswith('/static/css/main.') and url.endswith('.css') and url != '/static/css/main.css'
+    assert first.text == second.text == FILE_CONTENTS
+    assert first.headers['Content-Type'] == 'text/css'
+    assert first.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert len(api.static.cache) == 1
+    assert api.static.url('unknown.js') == '/static/unknown.js'
+
+
+def test_fingerprinted_url_changes_with_the_content(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp('static')
+    asset = _create_static(static_dir)
+    api = API(static_dir=str(static_dir))
+
+    before = api.static.url(f'{FILE_DIR}/{FILE_NAME}')
+    asset.write('body {background-color: red}')
+    api.static.refresh()
+
+    assert api.static.url(f'{FILE_DIR}/{FILE_NAME}') != before
+    assert api.test_session().get(f'http://testserver{before}').status_code == 404
+
+
+def test_fingerprinted_static_files_are_served_precompressed(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp('static')
+    asset = _create_static(static_dir)
+    asset.write(FILE_CONTENTS * 100)
+    api = API(static_dir=str(static_dir))
+    api.compress_static()
+
+    response = api.test_session().get(f'http://testserver{api.static.url(f"{FILE_DIR}/{FILE_NAME}")}',
+                                      headers={'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.content).decode() == FILE_CONTENTS * 100
+
+
+def test_large_static_files_are_streamed_with_the_file_wrapper(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp('static')
+    asset = _create_static(static_dir)
+    asset.write(FILE_CONTENTS * 100)
+    api = API(static_dir=str(static_dir))
+    api.static.max_file_size = len(FILE_CONTENTS)
+    url = api.static.url(f'{FILE_DIR}/{FILE_NAME}')
+    wrapped = []
+
+    def file_wrapper(file, block_size):
+        wrapped.append(file)
+        return iter(lambda: file.read(block_size), b'')
+
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': url[len('/static'):], 'wsgi.file_wrapper': file_wrapper}
+    headers = {}
+    body = api.static.serve(environ, lambda status, response_headers: headers.update(response_headers))
+
+    assert b''.join(body).decode() == FILE_CONTENTS * 100
+    assert headers['Content-Length'] == str(len(FILE_CONTENTS) * 100)
+    assert len(wrapped) == 1
+    assert len(api.static.cache) == 0
+    # without a file wrapper, the response falls back to FileIterator
+    response = api.test_session().get(f'http://testserver{url}')
+    assert response.text == FILE_CONTENTS * 100
+
+
+def test_precompressed_variants_are_recorded_on_build(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp('static')
+    _create_static(static_dir).write(FILE_CONTENTS * 100)
+    api = API(static_dir=str(static_dir))
+    url = api.static.url(f'{FILE_DIR}/{FILE_NAME}')
+    path = api.static.fingerprinted[url[len('/static/'):]]
+    assert api.static.variants[path] == {}
+
+    api.compress_static()
+
+    assert api.static.variants[path]['gzip'] == path + '.gz'
+
+
+def test_lru_cache_bounded_by_weight():
+    cache = LRUCache(maxsize=10, weigh=len)
+    cache.set('a', b'12345')
+    cache.set('b', b'123456')
+
+    assert cache.keys() == ['b']
+    assert cache.size == 6
+
+
+def test_instrumentation_server_timing_and_metrics(api, client):
+    class TimedMiddleware(Middleware):
+        def process_request(self, req):
+            pass
+
+    api.add_middleware(TimedMiddleware)
+    api.enable_instrumentation()
+
+    @api.route('/{name}')
+    def greeting(req, resp, name):
+        resp.text = f'Hello, {name}'
+
+    response = client.get('http://testserver/matthew')
+    client.get('http://testserver/nowhere/to/go')
+
+    server_timing = response.headers['Server-Timing']
+    for span in ('routing', 'TimedMiddleware.process_request', 'handler', 'serialize', 'total'):
+        assert f'{span};dur=' in server_timing
+
+    metrics = client.get('http://testserver/metrics').text
+    assert 'sengoku_request_duration_seconds_count{route="/{name}"} 1' in metrics
+    assert 'sengoku_request_duration_seconds_bucket{route="/{name}",le="+Inf"} 1' in metrics
+    assert 'sengoku_request_duration_seconds_count{route="<unmatched>"} 1' in metrics
+    assert 'sengoku_span_duration_seconds_count{route="/{name}",span="handler"} 1' in metrics
+
+
+def test_instrumentation_asgi_and_template_span(api):
+    api.enable_instrumentation(metrics_path=None)
+
+    @api.route('/html')
+    async def html_handler(req, resp):
+        resp.html = api.template('index.html', context={'title': 'Title', 'name': 'Name'})
+
+    status, headers, _ = _asgi_get(api, '/html')
+
+    assert status == 200
+    assert b'template;dur=' in headers[b'server-timing']
+    assert '/html' in api.instrumentation.histograms
+
+
+def test_instrumentation_samples_profiles(api, client):
+    instrumentation = api.enable_instrumentation(profile_every=2)
+
+    @api.route('/home')
+    def home(req, resp):
+        resp.text = 'Hello'
+
+    client.get('http://testserver/home')
+    assert instrumentation.profile_stats is None
+
+    client.get('http://testserver/home')
+    assert any(function == 'home' for _, _, function in instrumentation.profile_stats.stats)
+    assert 'function calls' in instrumentation.profile_report()
+
+
+def test_make_environ_drives_the_wsgi_callable(api):
+    @api.route('/echo')
+    def echo(req, resp):
+        resp.text = f'{req.method} {req.GET["q"]} {req.headers["X-Token"]} {req.text}'
+
+    environ = make_environ('/echo', method='POST', query_string='q=1', body=b'hi', headers={'X-Token': 'abc'})
+    status, _, body = run_wsgi(api, environ)
+
+    assert status == 200
+    assert body == b'POST 1 abc hi'
+
+
+def test_benchmark_compare_reports_regressions():
+    from benchmarks.suite import compare
+
+    baseline = {'routing': {'rps': 1000, 'p99_us': 10.0}, 'json': {'rps': 1000, 'p99_us': 10.0}}
+    results = {'routing': {'rps': 950, 'p99_us': 10.5}, 'json': {'rps': 800, 'p99_us': 20.0}, 'new': {}}
+
+    assert [name for name, _ in compare(results, baseline, tolerance=0.1)] == ['json', 'json']
+
+
+def test_replay_traffic_log(api):
+    from benchmarks.replay import read_log, replay, summarize
+
+    @api.route('/hello/{name}')
+    def greeting(req, resp, name):
+        resp.text = f'Hello, {name}'
+
+    @api.route('/fail')
+    def fail(req, resp):
+        resp.status_code = 503
+
+    log = io.StringIO('\n'.join([
+        '{"path": "/hello/matthew?lang=en"}',
+        '{"method": "POST", "path": "/hello/john", "body": "x"}',
+        '{"path": "/fail"}',
+        '{"request_id": "not a request"}',
+        'not json',
+    ]))
+    entries, skipped = read_log(log)
+    summary = summarize(replay(api, entries, workers=2))
+
+    assert skipped == [2]
+    assert summary['/hello/{name}']['requests'] == 2
+    assert summary['/hello/{name}']['error_rate'] == 0
+    assert summary['/fail']['error_rate'] == 1
+
+
+PREFORK_APP = """
+import os
+from sengoku.api import API
+
+app = API()
+
+
+@app.route('/pid')
+def pid(req, resp):
+    resp.text = f'{VERSION} {os.getpid()}'
+"""
+
+
+def test_prefork_server_recycles_and_reloads_workers(tmpdir):
+    module = tmpdir.join('prefork_app.py')
+    module.write('VERSION = 1' + PREFORK_APP)
+    tmpdir.mkdir('static')
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'sengoku', 'serve', 'prefork_app:app', '--bind', '127.0.0.1:0', '--workers', '1',
+         '--max-requests', '2'],
+        cwd=str(tmpdir), env=env, stderr=subprocess.PIPE, text=True,
+    )
+    try:
+        port = re.search(r':(\d+) ', server.stderr.readline()).group(1)
+
+        def get():
+            return urllib.request.urlopen(f'http://127.0.0.1:{port}/pid', timeout=5).read().decode().split()
+
+        responses = [get() for _ in range(3)]
+        # the worker exits after 2 requests and is replaced
+        assert responses[0][1] == responses[1][1] != responses[2][1]
+
+        module.write('VERSION = 2' + PREFORK_APP)
+        server.send_signal(signal.SIGHUP)
+        assert 'Reloaded' in server.stderr.readline()
+        assert get()[0] == '2'
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(10) == 0
+
+
+def test_prefork_server_stops_when_the_workers_fail_to_boot(tmpdir):
+    tmpdir.join('failing_app.py').write("""
+from sengoku.api import API
+
+app = API()
+
+
+@app.on_startup
+def connect():
+    raise ConnectionError('the database is down')
+""")
+    tmpdir.mkdir('static')
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    server = subprocess.run(
+        [sys.executable, '-m', 'sengoku', 'serve', 'failing_app:app', '--bind', '127.0.0.1:0', '--workers', '1'],
+        cwd=str(tmpdir), env=env, capture_output=True, text=True, timeout=30,
+    )
+
+    assert server.returncode == 3
+    assert server.stderr.count('ConnectionError: the database is down') == 5
+    assert '5 workers in a row failed to boot, stopping' in server.stderr
+
+
+def test_app_is_frozen_once_it_serves(api, client):
+    @api.route('/home')
+    def home(req, resp):
+        resp.text = 'Hello'
+
+    assert client.get('http://testserver/home').text == 'Hello'
+    assert api.frozen
+
+    with pytest.raises(RuntimeError):
+        api.add_route('/about', home)
+    with pytest.raises(RuntimeError):
+        api.add_middleware(Middleware)
+    with pytest.raises(TypeError):
+        api.routes['/about'] = {}
+
+
+def test_threaded_server_sheds_load_when_the_queue_is_full(api):
+    release = threading.Event()
+
+    @api.route('/slow')
+    def slow(req, resp):
+        release.wait(5)
+        resp.text = 'done'
+
+    api.freeze()
+    listener = socket.create_server(('127.0.0.1', 0))
+    server = ThreadedWorkerServer(listener, api, threads=1, queue_size=1)
+    url = f'http://127.0.0.1:{listener.getsockname()[1]}/slow'
+    statuses = {}
+
+    def get(index):
+        try:
+            statuses[index] = urllib.request.urlopen(url, timeout=5).status
+        except urllib.error.HTTPError as e:
+            statuses[index] = e.code
+
+    clients = []
+    try:
+        for index in range(3):
+            clients.append(threading.Thread(target=get, args=(index,)))
+            clients[-1].start()
+            server.handle_request()
+            # the first connection is taken by the thread, the second one waits in the queue
+            while index == 0 and not server.connections.empty():
+                time.sleep(0.01)
+        assert server.rejected == 1
+    finally:
+        release.set()
+        for thread in clients:
+            thread.join()
+        server.server_close()
+        listener.close()
+
+    assert statuses == {0: 200, 1: 200, 2: 503}
+
+
+def _multipart_body(boundary):
+    return (
+        f'preamble\r\n--{boundary}\r\n'
+        'Content-Disposition: form-data; name="title"\r\n\r\n'
+        'Sengoku\r\n'
+        f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="upload"; filename="data.bin"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+        f'{"x" * 1000}\r\n--not-the-boundary{"y" * 1000}\r\n'
+        f'--{boundary}--\r\n'
+    ).encode()
+
+
+def test_iter_parts_streams_multipart_uploads(api, tmpdir):
+    boundary = 'b0undary'
+    saved = {}
+
+    @api.route('/upload', allowed_methods=['post'])
+    def upload(req, resp):
+        for part in req.iter_parts(chunk_size=7):
+            if part.filename is None:
+                saved[part.name] = part.text()
+            else:
+                saved['size'] = part.save(str(tmpdir.join(part.filename)))
+        resp.text = 'ok'
+
+    body = _multipart_body(boundary)
+    environ = make_environ('/upload', method='POST', body=body,
+                           headers={'Content-Type': f'multipart/form-data; boundary="{boundary}"'})
+    status, _, _ = run_wsgi(api, environ)
+
+    assert status == 200
+    assert saved == {'title': 'Sengoku', 'size': 2000 + len('\r\n--not-the-boundary')}
+    assert tmpdir.join('data.bin').read_binary() == f'{"x" * 1000}\r\n--not-the-boundary{"y" * 1000}'.encode()
+
+
+def test_truncated_multipart_body_is_a_bad_request(api):
+    @api.route('/upload', allowed_methods=['post'])
+    def upload(req, resp):
+        for part in req.iter_parts():
+            part.read()
+
+    body = _multipart_body('b0undary')[:-40]
+    environ = make_environ('/upload', method='POST', body=body,
+                           headers={'Content-Type': 'multipart/form-data; boundary=b0undary'})
+
+    assert run_wsgi(api, environ)[0] == 400
+
+
+def test_body_over_the_route_limit_is_rejected_before_it_is_read():
+    api = API(max_body_size=10)
+    called = []
+
+    @api.route('/small', allowed_methods=['post'])
+    def small(req, resp):
+        called.append(req.data)
+
+    @api.route('/large', allowed_methods=['post'], max_body_size=1000)
+    def large(req, resp):
+        resp.text = str(len(req.data))
+
+    body = io.BytesIO(b'x' * 100)
+    status, _, _ = run_wsgi(api, make_environ('/small', method='POST', body=b'x' * 100, **{'wsgi.input': body}))
+
+    assert status == 413
+    assert called == []
+    assert body.tell() == 0
+    status, _, response_body = run_wsgi(api, make_environ('/large', method='POST', body=b'x' * 100))
+    assert (status, response_body) == (200, b'100')
+
+
+def test_body_without_content_length_is_limited_while_read():
+    api = API(max_body_size=10)
+
+    @api.route('/upload', allowed_methods=['post'])
+    def upload(req, resp):
+        resp.text = str(len(req.data))
+
+    environ = make_environ('/upload', method='POST', body=b'x' * 100, **{'wsgi.input_terminated': True})
+    del environ['CONTENT_LENGTH']
+
+    assert run_wsgi(api, environ)[0] == 413
+
+
+def test_body_limit_applies_to_the_middlewares_and_stops_at_the_limit():
+    api = API()
+    seen = []
+
+    class AuditMiddleware(Middleware):
+        def process_request(self, req):
+            seen.append(len(req.data))
+
+    api.add_middleware(AuditMiddleware)
+
+    @api.route('/upload', allowed_methods=['post'], max_body_size=10)
+    def upload(req, resp):
+        resp.text = str(len(req.data))
+
+    body = io.BytesIO(b'x' * 1000)
+    environ = make_environ('/upload', method='POST', **{'wsgi.input': body, 'wsgi.input_terminated': True})
+    del environ['CONTENT_LENGTH']
+
+    assert run_wsgi(api, environ)[0] == 413
+    assert seen == []
+    # one byte past the limit, not the whole body
+    assert body.tell() == 11
+
+
+def test_chunked_multipart_form_is_limited_while_read():
+    api = API(max_body_size=100)
+
+    @api.route('/upload', allowed_methods=['post'])
+    def upload(req, resp):
+        resp.text = req.POST['file'].file.read().decode()
+
+    body, content_type = encode_multipart({'name': 'notes'}, {'file': ('notes.txt', b'x' * 500)})
+    environ = make_environ('/upload', method='POST', body=body, headers={'Content-Type': content_type},
+                           **{'wsgi.input_terminated': True})
+    del environ['CONTENT_LENGTH']
+
+    assert run_wsgi(api, environ)[0] == 413
+
+
+def test_asgi_body_over_the_limit_is_not_received():
+    api = API(max_body_size=10)
+
+    @api.route('/upload', allowed_methods=['post'])
+    def upload(req, resp):
+        resp.text = str(len(req.data))
+
+    assert asyncio.run(_asgi_request(api, 'POST', '/upload', body=b'x' * 5))[2] == b'5'
+    assert asyncio.run(_asgi_request(api, 'POST', '/upload', body=b'x' * 100))[0] == 413
+
+
+def test_http_error_raised_by_a_handler(api, client):
+    @api.route('/books/{book_id:d}')
+    def book(req, resp, book_id):
+        resp.json = {'id': book_id}
+        raise HTTPError('The book is sold out.', status_code=409, headers={'Retry-After': '3600'})
+
+    response = client.get('http://testserver/books/1')
+
+    assert response.status_code == 409
+    assert response.text == 'The book is sold out.'
+    assert response.headers['Retry-After'] == '3600'
+
+
+def test_handler_params_are_converted_from_their_annotations(api, client):
+    @api.route('/books/{book_id}')
+    def book(req, resp, book_id: int, page: int = Query(1), tags: list[str] = Query([]),
+             token: str | None = Header(None, alias='X-Token'), draft: bool = Query(False)):
+        resp.json = {'book_id': book_id, 'page': page, 'tags': tags, 'token': token, 'draft': draft}
+
+    response = client.get('http://testserver/books/7?page=2&tags=a&tags=b&draft=yes', headers={'X-Token': 'abc'})
+    assert response.json() == {'book_id': 7, 'page': 2, 'tags': ['a', 'b'], 'token': 'abc', 'draft': True}
+
+    assert client.get('http://testserver/books/7').json() == {
+        'book_id': 7, 'page': 1, 'tags': [], 'token': None, 'draft': False,
+    }
+    assert client.get('http://testserver/books/seven').status_code == 400
+    assert client.get('http://testserver/books/7?page=two').status_code == 400
+
+
+def test_unresolvable_annotations_are_rejected_when_the_route_is_added(api):
+    def count(req, resp, n: 'Missing'):
+        resp.text = str(n)
+
+    with pytest.raises(TypeError, match='Missing'):
+        api.add_route('/count/{n}', count)
+    with pytest.raises(TypeError):
+        Param()
+
+
+def test_bool_path_fields_and_list_headers(api, client):
+    @api.route('/flags/{flag:d}')
+    def flags(req, resp, flag: bool, accept: list[str] = Header([], alias='X-Accept')):
+        resp.json = {'flag': flag, 'accept': accept}
+
+    assert client.get('/flags/1', headers={'X-Accept': 'json, csv'}).json() == {'flag': True, 'accept': ['json', 'csv']}
+    assert client.get('/flags/0').json() == {'flag': False, 'accept': []}
+    assert client.get('/flags/7').status_code == 400
+
+
+def test_required_params_and_json_body_fields(api, client):
+    @api.route('/books', allowed_methods=['post'])
+    class BooksHandler:
+        async def post(self, req, resp, title: str = Body(), price: float = Body(), user_agent: str = Header()):
+            resp.json = {'title': title, 'price': price}
+
+    url = 'http://testserver/books'
+    headers = {'User-Agent': 'tests'}
+
+    assert client.post(url, json={'title': 'Sengoku', 'price': 10}, headers=headers).json() == {
+        'title': 'Sengoku', 'price': 10,
+    }
+    assert client.post(url, json={'title': 'Sengoku', 'price': 'free'}, headers=headers).status_code == 422
+    assert client.post(url, json={'title': 'Sengoku'}, headers=headers).status_code == 422
+    assert client.post(url, data='{', headers=headers).status_code == 400
+
+
+def test_handlers_without_annotations_are_not_wrapped(api):
+    def handler(req, resp, name):
+        resp.text = name
+
+    api.add_route('/hello/{name}', handler)
+
+    assert api.routes['/hello/{name}']['methods']['GET'] is handler
+
+
+def test_wsgi_middleware_transforms_the_body_lazily_and_closes_it(api):
+    from reverseware import Reverseware
+
+    produced = []
+    closed = []
+
+    class Lines:
+        def __iter__(self):
+            for index in range(3):
+                produced.append(index)
+                yield f'line{index}'.encode()
+
+        def close(self):
+            closed.append(True)
+
+    @api.route('/lines')
+    def lines(req, resp):
+        resp.body = Lines()
+
+    api.add_wsgi_middleware(Reverseware)
+    _, headers, app_iter = _wsgi_call(api, '/lines')
+
+    assert produced == []
+    assert next(iter(app_iter)) == b'0enil'
+    assert produced == [0]
+    app_iter.close()
+    assert closed == [True]
+
+
+def test_header_only_wsgi_middleware_passes_the_body_through(api, tmp_path):
+    report = tmp_path / 'report.csv'
+    report.write_bytes(b'a,b\n1,2\n')
+
+    class FileWrapper:
+        def __init__(self, file, block_size):
+            self.file = file
+
+    class PoweredBy(BodyTransformMiddleware):
+        def transform_headers(self, environ, status, headers):
+            return status, headers + [('X-Powered-By', 'sengoku')]
+
+    @api.route('/report')
+    def report_handler(req, res):
+        res.body = open(report, 'rb')
+
+    api.add_wsgi_middleware(PoweredBy)
+    _, headers, app_iter = _wsgi_call(api, '/report', **{'wsgi.file_wrapper': FileWrapper})
+
+    assert isinstance(app_iter, FileWrapper)
+    assert headers['X-Powered-By'] == 'sengoku'
+    assert headers['Content-Length'] == '8'
+    app_iter.file.close()
+
+
+def test_wsgi_middleware_keeps_the_length_of_a_body_it_passes_through(api):
+    class Redact(BodyTransformMiddleware):
+        def transform_body(self, environ, chunks):
+            if environ['PATH_INFO'] != '/secret':
+                return chunks
+            return (chunk.replace(b'password', b'********') for chunk in chunks)
+
+    @api.route('/public')
+    def public(req, res):
+        res.text = 'nothing to hide'
+
+    @api.route('/secret')
+    def secret(req, res):
+        res.text = 'the password'
+
+    api.add_wsgi_middleware(Redact)
+    _, public_headers, public_body = run_wsgi(api, make_environ('/public'))
+    _, secret_headers, secret_body = run_wsgi(api, make_environ('/secret'))
+
+    assert ('Content-Length', '15') in public_headers
+    assert public_body == b'nothing to hide'
+    assert 'content-length' not in [name.lower() for name, _ in secret_headers]
+    assert secret_body == b'the ********'
+
+
+def test_test_client_sends_params_cookies_and_follows_redirects(api, client):
+    @api.route('/login', allowed_methods=['post'])
+    def login(req, res):
+        res.webob.set_cookie('session', req.POST['user'])
+        res.status_code = 303
+        res.headers['Location'] = '/me?greet=1'
+
+    @api.route('/me')
+    def me(req, res):
+        res.json = {'user': req.cookies.get('session'), 'query': dict(req.GET), 'host': req.host}
+
+    response = client.post('/login', data={'user': 'xavier'})
+
+    assert response.status_code == 200
+    assert [redirect.status_code for redirect in response.history] == [303]
+    assert response.json() == {'user': 'xavier', 'query': {'greet': '1'}, 'host': 'testserver'}
+    assert response.headers['content-type'] == response.headers['Content-Type'] == 'application/json'
+    assert client.get('/me', params={'page': 2}).json()['query'] == {'page': '2'}
+    assert client.get('http://example.com:8080/me').json()['host'] == 'example.com:8080'
+    assert client.post('/login', data={'user': 'x'}, allow_redirects=False).status_code == 303
+
+
+def test_async_test_client_goes_through_asgi(api):
+    @api.route('/echo', allowed_methods=['post'])
+    async def echo(req, res):
+        res.json = {'body': req.json, 'scope': 'asgi.scope' in req.environ}
+
+    response = asyncio.run(AsyncTestClient(api).post('/echo', json={'a': 1}))
+
+    assert response.status_code == 200
+    assert response.json() == {'body': {'a': 1}, 'scope': True}
+
+
+def test_test_clients_encode_non_ascii_paths(api, client):
+    @api.route('/hello/{name}')
+    def hello(req, res, name):
+        res.json = {'name': name, 'raw_path': req.environ.get('asgi.scope', {}).get('raw_path', b'').decode()}
+
+    async_client = AsyncTestClient(api)
+    for path in ('/hello/%E6%97%A5', '/hello/日', '/hello/caf%C3%A9'):
+        expected = '日' if 'caf' not in path else 'café'
+        assert client.get(path).json()['name'] == expected
+        response = asyncio.run(async_client.get(path)).json()
+        assert response['name'] == expected
+        assert response['raw_path'] == ('/hello/caf%C3%A9' if 'caf' in path else '/hello/%E6%97%A5')
+
+
+def test_pytest_plugin_reuses_one_frozen_app(sengoku_app, sengoku_client, sengoku_async_client):
+    assert sengoku_app.frozen
+    assert sengoku_client.get('/greeting?name=sengoku').json() == {'greeting': 'hello sengoku'}
+    assert asyncio.run(sengoku_async_client.get('/greeting')).json() == {'greeting': 'hello world'}
+
+
+def test_optional_dependencies_are_imported_lazily(tmpdir):
+    script = '''
+import io
+import sys
+from sengoku.api import API
+from sengoku.asgi import run_wsgi
+
+lazy = ('requests', 'wsgiadapter', 'jinja2', 'whitenoise', 'parse', 'webob', 'brotli', 'orjson')
+# the parts of the framework (and of the stdlib) that a WSGI app which does not use them never loads
+unused = ('asyncio', 'cProfile', 'pstats', 'sengoku.caching', 'sengoku.testing')
+api = API()
+
+@api.route('/text')
+def text(req, res):
+    res.text = 'lean'
+
+environ = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': '/text', 'QUERY_STRING': '',
+           'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO()}
+assert run_wsgi(api, environ)[2] == b'lean'
+print(sorted(name for name in lazy + unused if name in sys.modules))
+api.precompile()
+print(sorted(name for name in lazy if name in sys.modules))
+'''
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    output = subprocess.run([sys.executable, '-c', script], cwd=str(tmpdir), env=env,
+                            capture_output=True, text=True, check=True).stdout
+
+    # the optional dependencies are imported by precompile when they are installed
+    installed = [name for name in ('brotli', 'orjson') if importlib.util.find_spec(name) is not None]
+    assert output.splitlines() == ['[]', str(sorted(['jinja2', 'webob', 'whitenoise', *installed]))]
+
+
+def test_background_tasks_run_after_the_wsgi_body_is_closed(api):
+    done = []
+    errors = []
+
+    def audit(action, user=None):
+        done.append((action, user))
+
+    async def warm_cache():
+        done.append('warmed')
+
+    def fail():
+        raise ValueError('smtp is down')
+
+    @api.route('/orders', allowed_methods=['post'])
+    def create_order(req, res):
+        res.add_background(audit, 'created', user='xavier')
+        res.add_background(warm_cache)
+        res.add_background(fail)
+        res.add_background(audit, 'never reached')
+        res.text = 'created'
+
+    api.add_exception_handler(lambda req, resp, e: errors.append((req.path, resp.text, str(e))))
+    _, _, app_iter = _wsgi_call(api, '/orders', method='POST')
+
+    assert b''.join(app_iter) == b'created'
+    assert done == []
+    app_iter.close()
+    api.shutdown()
+
+    assert done == [('created', 'xavier'), 'warmed']
+    assert errors == [('/orders', 'created', 'smtp is down')]
+
+
+def test_background_tasks_are_scheduled_on_the_event_loop(api):
+    done = []
+    errors = []
+
+    async def notify(name):
+        await asyncio.sleep(0)
+        done.append(f'notified {name}')
+
+    def fail():
+        raise ValueError('broken')
+
+    @api.route('/signup', allowed_methods=['post'])
+    async def signup(req, res):
+        res.add_background(notify, 'xavier')
+        res.add_background(done.append, 'logged')
+        res.text = 'welcome'
+
+    @api.route('/broken')
+    def broken(req, res):
+        res.add_background(fail)
+
+    async def exception_handler(req, resp, e):
+        errors.append(str(e))
+
+    api.add_exception_handler(exception_handler)
+
+    async def scenario():
+        client = AsyncTestClient(api)
+        response = await client.post('/signup')
+        await client.get('/broken')
+        await api.background.drain_async()
+        return response.text
+
+    assert asyncio.run(scenario()) == 'welcome'
+    assert done == ['notified xavier', 'logged']
+    assert errors == ['broken']
+
+
+def test_background_pool_applies_backpressure():
+    pool = BackgroundPool(max_workers=1, max_pending=1)
+    release = threading.Event()
+    submitted = []
+
+    pool.submit([(release.wait, (), {})], on_error=print)
+    second = threading.Thread(target=lambda: submitted.append(pool.submit([(int, (), {})], on_error=print)))
+    second.start()
+    second.join(0.2)
+
+    assert second.is_alive() and submitted == []
+    release.set()
+    second.join()
+    pool.shutdown()
+    assert submitted[0].done()
+
+
+def test_startup_and_shutdown_hooks_run_once_per_process(api, client):
+    events = []
+
+    @api.on_startup
+    def open_connections():
+        events.append(('startup', os.getpid()))
+
+    @api.on_startup
+    async def warm_up():
+        events.append('warmed up')
+
+    @api.on_shutdown
+    def close_connections():
+        events.append('shutdown')
+
+    @api.route('/events')
+    def events_handler(req, res):
+        res.json = len(events)
+
+    assert events == []
+    assert client.get('/events').json() == 2
+    assert client.get('/events').json() == 2
+    with pytest.raises(RuntimeError):
+        api.on_startup(print)
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # a forked worker runs the startup hooks again before its first request
+        os.write(write_fd, str(client.get('/events').json()).encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 16) == b'4'
+    os.close(read_fd)
+    os.close(write_fd)
+
+    api.shutdown()
+    api.shutdown()
+    assert events == [('startup', os.getpid()), 'warmed up', 'shutdown']
+
+
+def test_asgi_lifespan_runs_the_hooks(api):
+    events = []
+
+    @api.on_startup
+    async def startup():
+        await asyncio.sleep(0)
+        events.append('startup')
+
+    @api.on_shutdown
+    async def shutdown():
+        events.append('shutdown')
+
+    async def lifespan():
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+            if message['type'] == 'lifespan.startup.complete':
+                # a request between the startup and the shutdown does not run the hooks again
+                await _asgi_request(api, 'GET', '/')
+
+        await api.asgi({'type': 'lifespan'}, receive, send)
+        return sent
+
+    assert asyncio.run(lifespan()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert events == ['startup', 'shutdown']
+
+
+def test_resource_pool_checks_sqlite_connections_out_per_request(api, client, tmp_path):
+    database = str(tmp_path / 'books.db')
+    with sqlite3.connect(database) as connection:
+        connection.execute('CREATE TABLE books (title TEXT)')
+    connections = []
+
+    def connect():
+        connections.append(sqlite3.connect(database, check_same_thread=False))
+        return connections[-1]
+
+    pool = ResourcePool(connect, min_size=1, max_size=2, timeout=0.1,
+                        health_check=lambda connection: connection.execute('SELECT 1'),
+                        reset=lambda connection: connection.rollback())
+    api.on_startup(pool.open)
+    api.on_shutdown(pool.close)
+
+    @api.route('/books', allowed_methods=['get', 'post'])
+    def books(req, res, connection=Resource(pool)):
+        if req.method == 'POST':
+            connection.execute('INSERT INTO books VALUES (?)', (req.json['title'],))
+            if req.json.get('commit', True):
+                connection.commit()
+        res.json = [title for title, in connection.execute('SELECT title FROM books')]
+
+    @api.route('/count')
+    async def count(req, res, connection=Resource(pool)):
+        res.json = {'idle': pool.idle, 'size': pool.size}
+
+    assert client.get('/books').json() == []
+    assert client.post('/books', json={'title': 'Dune'}).json() == ['Dune']
+    # the transaction that was not committed is rolled back when the connection is given back
+    assert client.post('/books', json={'title': 'Draft', 'commit': False}).json() == ['Dune', 'Draft']
+    assert client.get('/books').json() == ['Dune']
+    assert len(connections) == 1
+    assert asyncio.run(AsyncTestClient(api).get('/count')).json() == {'idle': 0, 'size': 1}
+
+    # a connection that fails its health check is replaced
+    connections[0].close()
+    assert client.get('/books').json() == ['Dune']
+    assert len(connections) == 2 and pool.size == 1
+
+    held = [pool.acquire(), pool.acquire()]
+    assert client.get('/books').status_code == 503
+    with pytest.raises(PoolTimeout):
+        pool.acquire(timeout=0.01)
+    for connection in held:
+        pool.release(connection)
+
+    api.shutdown()
+    assert pool.size == 0